@@ -0,0 +1,110 @@
+# benchmarks/bench_memory.py
+#
+# 店舗データ 10,000 件あたりのメモリ使用量を比較する。
+#   - Notion ページ JSON をそのまま保持（fetch_all_entries）
+#   - StoreRecord（__slots__）に変換して保持（fetch_all_records）
+#
+#   python -m benchmarks.bench_memory [件数]
+import json
+import random
+import sys
+import tracemalloc
+
+from modules.store_record import StoreRecord
+
+TAG_POOL = ["デート向け", "落ち着いた", "カフェ", "居酒屋", "一人", "ラーメン", "静か", "友達", "作業向け", "コスパ"]
+TYPE_POOL = ["cafe", "bar", "ramen", "izakaya", "restaurant", "sushi"]
+
+
+def _rich_text(content: str) -> list:
+    """Notion API が返す rich_text 要素（装飾情報つき）"""
+    return [{
+        "type": "text",
+        "text": {"content": content, "link": None},
+        "annotations": {
+            "bold": False, "italic": False, "strikethrough": False,
+            "underline": False, "code": False, "color": "default",
+        },
+        "plain_text": content,
+        "href": None,
+    }]
+
+
+def _user(uid: str) -> dict:
+    return {"object": "user", "id": uid}
+
+
+def make_page_json(i: int, rnd: random.Random) -> str:
+    """Notion DB query が返す1ページ分の JSON 文字列"""
+    page = {
+        "object": "page",
+        "id": f"{i:08x}-0000-4000-8000-{i:012x}",
+        "created_time": "2025-01-01T00:00:00.000Z",
+        "last_edited_time": "2025-06-01T12:34:00.000Z",
+        "created_by": _user("11111111-2222-3333-4444-555555555555"),
+        "last_edited_by": _user("11111111-2222-3333-4444-555555555555"),
+        "cover": None,
+        "icon": {"type": "emoji", "emoji": "🍽️"},
+        "parent": {"type": "database_id", "database_id": "aaaaaaaa-bbbb-cccc-dddd-eeeeeeeeeeee"},
+        "archived": False,
+        "in_trash": False,
+        "url": f"https://www.notion.so/{i:032x}",
+        "public_url": None,
+        "properties": {
+            "店名": {"id": "title", "type": "title", "title": _rich_text(f"テスト食堂 {i}号店")},
+            "住所": {"id": "a1", "type": "rich_text", "rich_text": _rich_text(f"東京都千代田区丸の内{i % 9 + 1}-{i % 50}")},
+            "評価": {"id": "a2", "type": "number", "number": round(rnd.uniform(2.5, 5.0), 1)},
+            "料金": {"id": "a3", "type": "number", "number": rnd.randint(1, 4)},
+            "営業時間": {"id": "a4", "type": "rich_text", "rich_text": _rich_text("月曜日: 11時00分～22時00分\n火曜日: 11時00分～22時00分")},
+            "URL": {"id": "a5", "type": "url", "url": f"https://maps.google.com/?cid={i}"},
+            "公式サイト": {"id": "a6", "type": "url", "url": None},
+            "lat": {"id": "a7", "type": "number", "number": 35.6 + rnd.random() * 0.2},
+            "lng": {"id": "a8", "type": "number", "number": 139.6 + rnd.random() * 0.2},
+            "place_id": {"id": "a9", "type": "rich_text", "rich_text": _rich_text(f"ChIJ{i:023d}")},
+            "印象": {"id": "b1", "type": "rich_text", "rich_text": _rich_text("【良い点】\n・スープが濃厚\n\n【気になる点】\n・行列\n\n【まとめ】\n人気店")},
+            "感想": {"id": "b2", "type": "rich_text", "rich_text": _rich_text("また行きたい")},
+            "店タイプ": {"id": "b3", "type": "select", "select": {"id": "s1", "name": rnd.choice(TYPE_POOL), "color": "blue"}},
+            "サブタイプ": {"id": "b4", "type": "rich_text", "rich_text": _rich_text("コーヒーとスイーツ")},
+            "おすすめメニュー": {"id": "b5", "type": "rich_text", "rich_text": _rich_text("味玉ラーメン, 餃子, チャーハン")},
+            "Tags": {"id": "b6", "type": "multi_select", "multi_select": [
+                {"id": f"t{j}", "name": t, "color": "default"} for j, t in enumerate(rnd.sample(TAG_POOL, 3))
+            ]},
+        },
+    }
+    return json.dumps(page, ensure_ascii=False)
+
+
+def measure(build) -> tuple[int, object]:
+    """build() が返すオブジェクトが保持しているメモリ量（bytes）"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    obj = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(s.size_diff for s in after.compare_to(before, "filename"))
+    return size, obj
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    rnd = random.Random(0)
+
+    # API レスポンス相当（JSON 文字列）を先に作っておき、パース後の保持量だけを測る
+    raw = [make_page_json(i, rnd) for i in range(n)]
+
+    pages_bytes, _ = measure(lambda: [json.loads(r) for r in raw])
+    records_bytes, records = measure(lambda: [StoreRecord.from_page(json.loads(r)) for r in raw])
+
+    per_10k = 10_000 / n
+    print(f"stores: {n}")
+    print(f"{'form':<28} {'total(MB)':>10} {'per 10k(MB)':>12} {'per store(B)':>13}")
+    for label, size in [("Notion page JSON (dict)", pages_bytes), ("StoreRecord (__slots__)", records_bytes)]:
+        print(
+            f"{label:<28} {size / 1e6:>10.2f} {size * per_10k / 1e6:>12.2f}"
+            f" {size / n:>13.0f}"
+        )
+    print(f"reduction: {pages_bytes / records_bytes:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# benchmarks/bench_ranking.py
+#
+# /nearby のランキング処理を、旧方式（1件ずつ dict でスコア → 全件ソート）と
+# RankingEngine（配列でスコア → ヒープで top-k）で比較する。
+#
+#   python -m benchmarks.bench_ranking
+import random
+import time
+
+from modules.ranking import CandidateSet, RankingEngine, NEARBY_WEIGHTS
+from modules.store_record import project_pages
+from modules.utils import calc_distance
+
+SIZES = [1_000, 10_000, 100_000]
+TAG_POOL = ["デート向け", "落ち着いた", "カフェ", "居酒屋", "一人", "ラーメン", "静か", "友達"]
+
+
+def make_entries(n: int, seed: int = 0) -> list:
+    """fetch_all_entries() と同じ形の疑似ページを n 件作る"""
+    rnd = random.Random(seed)
+    entries = []
+    for i in range(n):
+        entries.append({
+            "id": f"page-{i}",
+            "properties": {
+                "店名": {"title": [{"text": {"content": f"店{i}"}}]},
+                "lat": {"number": 35.6 + rnd.random() * 0.2},
+                "lng": {"number": 139.6 + rnd.random() * 0.2},
+                "評価": {"number": round(rnd.uniform(2.5, 5.0), 1)},
+                "Tags": {"multi_select": [{"name": t} for t in rnd.sample(TAG_POOL, 3)]},
+            },
+        })
+    return entries
+
+
+def legacy_rank(entries, lat0, lng0, cond_words):
+    scored = []
+    for e in entries:
+        props = e["properties"]
+        lat = props.get("lat", {}).get("number")
+        lng = props.get("lng", {}).get("number")
+        if lat is None or lng is None:
+            continue
+        distance = calc_distance(lat0, lng0, lat, lng)
+        tags = [t["name"].lower() for t in props.get("Tags", {}).get("multi_select", [])]
+        score = sum(1 for cond in cond_words if cond in tags)
+        rating = props.get("評価", {}).get("number")
+        if rating:
+            score += (rating - 3.0) * 0.5
+        scored.append({"entry": e, "distance": distance, "score": score})
+    return sorted(scored, key=lambda x: (-x["score"], x["distance"]))[:3]
+
+
+def timed(fn, repeat=3):
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - t)
+    return best, result
+
+
+def main():
+    engine = RankingEngine(NEARBY_WEIGHTS)
+    lat0, lng0 = 35.68, 139.76
+    conds = ["静か", "カフェ"]
+
+    print(f"{'stores':>8} {'legacy(ms)':>12} {'build(ms)':>10} {'rank(ms)':>10} {'same top3':>10}")
+    for n in SIZES:
+        entries = make_entries(n)
+
+        t_legacy, legacy = timed(lambda: legacy_rank(entries, lat0, lng0, conds))
+        records = project_pages(entries)
+        t_build, cands = timed(lambda: CandidateSet.from_records(records))
+        t_rank, ranked = timed(
+            lambda: engine.rank(cands, {"lat": lat0, "lng": lng0, "conditions": conds}, k=3)
+        )
+
+        same = [x["entry"]["id"] for x in legacy] == [x["item"].page_id for x in ranked]
+        print(
+            f"{n:>8} {t_legacy * 1000:>12.1f} {t_build * 1000:>10.1f}"
+            f" {t_rank * 1000:>10.1f} {str(same):>10}"
+        )
+
+
+if __name__ == "__main__":
+    main()
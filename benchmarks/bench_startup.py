@@ -0,0 +1,65 @@
+# benchmarks/bench_startup.py
+#
+# 起動時間（import にかかる時間）の計測。
+# 各ターゲットを新しいプロセスで import し、中央値を表示する。
+#
+#   python -m benchmarks.bench_startup [回数]
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = [
+    ("modules", "import modules"),
+    ("modules + utils 参照", "import modules; modules.calc_distance"),
+    ("modules + analyze_store 参照", "import modules; modules.analyze_store"),
+    ("bot_line.line_bot", "import bot_line.line_bot"),
+    ("bot_discord.discord_bot", "import bot_discord.discord_bot"),
+    ("main", "import main"),
+]
+
+_SNIPPET = (
+    "import time; t = time.perf_counter(); {stmt}; "
+    "print(time.perf_counter() - t)"
+)
+
+
+def measure(stmt: str, runs: int) -> list[float]:
+    """stmt を新しいインタプリタで runs 回実行し、import 時間(秒)を返す"""
+    env = dict(os.environ)
+    env.setdefault("LINE_CHANNEL_SECRET", "dummy")
+    env.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "dummy")
+    env.setdefault("OPENAI_API_KEY", "dummy")
+
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, "-c", _SNIPPET.format(stmt=stmt)],
+            cwd=ROOT, env=env, capture_output=True, text=True,
+        )
+        if out.returncode != 0:
+            raise RuntimeError(out.stderr.strip().splitlines()[-1])
+        samples.append(float(out.stdout.strip().splitlines()[-1]))
+    return samples
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print(f"{'target':<32} {'median(ms)':>12} {'min(ms)':>10}")
+    for label, stmt in TARGETS:
+        try:
+            samples = measure(stmt, runs)
+        except RuntimeError as e:
+            print(f"{label:<32} {'error':>12}  {e}")
+            continue
+        print(
+            f"{label:<32} {statistics.median(samples) * 1000:>12.1f}"
+            f" {min(samples) * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+# benchmarks/bench_webhook_load.py
+#
+# LINE Webhook（/callback）の負荷試験。
+# X-Line-Signature で署名した本物と同じ形の Webhook を、実際の利用の流れ（セッション）に沿って
+# 目標 RPS で送り、スループット・エラー率・処理完了までの時間（結果が reply / push で届くまで）を測る。
+# 結果を reply で返せた割合（push の節約）も出す。
+#   - search : 🔍検索 → 店名 → 候補を選択 → 保存（感想なし）
+#   - recommend : 📍近くのおすすめ → 位置情報 → シチュエーション
+# Flask アプリは同じプロセス内の HTTP サーバーで動かし、LINE の reply / push API と
+# Google / OpenAI / Notion はスタブ（待ち時間だけ再現）に差し替える。
+#
+#   python -m benchmarks.bench_webhook_load [--rps 20] [--duration 30] [--latency-scale 1.0]
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+SECRET = "bench-secret"
+
+# 受付制御の上限は負荷試験の妨げになるので、既定では実質無制限にする（--admission で有効）
+_ADMISSION_ENV = {
+    "USER_RATE_PER_MIN": "1000000", "USER_BURST": "1000000",
+    "GLOBAL_RATE_PER_MIN": "1000000", "GLOBAL_BURST": "1000000",
+    "GLOBAL_MAX_CONCURRENT": "1000000",
+}
+
+# 上流 API の待ち時間（秒）。--latency-scale で一律に伸縮する
+UPSTREAM_LATENCY = {
+    "search_candidates": 0.15,
+    "search_nearby": 0.15,
+    "get_place_details": 0.2,
+    "analyze_store": 0.8,
+    "notion_upsert": 0.3,
+}
+
+
+# -----------------------------------------------
+# スタブ
+# -----------------------------------------------
+class FakeLineApi:
+    """
+    reply / push を記録するだけの LineBotApi。どちらもユーザーごとのキューに (時刻, "reply"|"push", messages) で入れる
+    （reply token は "<userId>:<乱数>" の形で作るので、そこから宛先が分かる）
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._lock = threading.Lock()
+        self.counts = {"reply": 0, "push": 0}
+
+    def queue_of(self, user_id) -> queue.Queue:
+        with self._lock:
+            return self._queues.setdefault(user_id, queue.Queue())
+
+    def _record(self, user_id, via, messages):
+        with self._lock:
+            self.counts[via] += 1
+        self.queue_of(user_id).put((time.perf_counter(), via, messages))
+
+    def reply_message(self, reply_token, messages):
+        self._record(reply_token.split(":", 1)[0], "reply", messages)
+
+    def push_message(self, user_id, messages):
+        self._record(user_id, "push", messages)
+
+
+def is_placeholder(messages) -> bool:
+    """「少々お待ちください」の案内（結果ではない）"""
+    return "お待ちください" in (getattr(messages, "text", None) or "")
+
+
+def install_stubs(scale: float) -> FakeLineApi:
+    """bot_line.line_bot を import する前に、上流 API をスタブに差し替える"""
+    import modules.google_api as google_api
+    import modules.ai_processing as ai_processing
+    import modules.embeddings as embeddings
+    import modules.outbox as outbox
+
+    def sleep(name):
+        time.sleep(UPSTREAM_LATENCY[name] * scale * random.uniform(0.7, 1.5))
+
+    def search_candidates(query):
+        sleep("search_candidates")
+        return [
+            {"name": f"{query} {i}号店", "place_id": f"P-{query}-{i}", "address": "東京都"}
+            for i in range(5)
+        ]
+
+    def search_candidates_page(query, page_token=None):
+        return search_candidates(query), None
+
+    def search_nearby(lat, lng, radius=500):
+        sleep("search_nearby")
+        return [
+            {
+                "name": f"近所の店{i}", "place_id": f"N-{i}", "address": "東京都",
+                "geometry": {"location": {"lat": lat + i * 1e-3, "lng": lng}},
+                "rating": 3.0 + i % 3, "types": ["restaurant"],
+            }
+            for i in range(10)
+        ]
+
+    def get_place_details(place_id, tiers=None):
+        sleep("get_place_details")
+        return {
+            "place_id": place_id, "name": f"店 {place_id}", "types": ["restaurant"],
+            "formatted_address": "東京都千代田区", "rating": 4.0,
+            "geometry": {"location": {"lat": 35.68, "lng": 139.76}},
+            "reviews": [{"text": "美味しい"}],
+        }
+
+    def analyze_store(name, types, reviews, place_id=None):
+        sleep("analyze_store")
+        return {
+            "summary": "【まとめ】\n美味しい", "store_type": {"type": "restaurant", "subtype": ""},
+            "recs": ["定食"], "tags": ["ランチ"], "source": "llm",
+        }
+
+    def notion_upsert(details, summary, tags, store_type, recs, comment):
+        sleep("notion_upsert")
+        return f"page-{details['place_id']}"
+
+    google_api.search_candidates = search_candidates
+    google_api.search_candidates_page = search_candidates_page
+    google_api.search_nearby = search_nearby
+    google_api.get_place_details = get_place_details
+    ai_processing.analyze_store = analyze_store
+    embeddings.store_similarity = lambda query, place_ids: None
+    outbox._shared_outbox = outbox.NotionOutbox(":memory:", writer=notion_upsert)
+
+    import bot_line.line_bot as line_bot
+
+    fake = FakeLineApi()
+    line_bot.get_line_bot_api = lambda: fake
+    return fake
+
+
+# -----------------------------------------------
+# Webhook 生成
+# -----------------------------------------------
+def _event(user_id: str, **fields) -> dict:
+    return {
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": f"{user_id}:{uuid.uuid4().hex}",
+        **fields,
+    }
+
+
+def text_event(user_id: str, text: str) -> dict:
+    return _event(user_id, type="message", message={
+        "id": str(random.getrandbits(48)), "type": "text", "text": text,
+        "quoteToken": uuid.uuid4().hex,
+    })
+
+
+def postback_event(user_id: str, data: str) -> dict:
+    return _event(user_id, type="postback", postback={"data": data})
+
+
+def location_event(user_id: str, lat: float, lng: float) -> dict:
+    return _event(user_id, type="message", message={
+        "id": str(random.getrandbits(48)), "type": "location",
+        "title": "現在地", "address": "東京都千代田区", "latitude": lat, "longitude": lng,
+    })
+
+
+def sign(body: str, secret: str = SECRET) -> str:
+    digest = hmac.new(secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+
+# -----------------------------------------------
+# セッション（1ステップ = Webhook 1件、expect_result なら結果が届くまでを計測）
+# -----------------------------------------------
+def search_session(user_id: str) -> list:
+    query = random.choice(["ラーメン", "カフェ", "寿司", "焼肉"])
+    place_id = f"P-{query}-{random.randrange(5)}"
+    return [
+        ("search.menu", text_event(user_id, "🔍検索"), False),
+        ("search.candidates", text_event(user_id, query), True),
+        ("search.select", postback_event(user_id, f"SELECT_PLACE|{place_id}"), True),
+        ("search.save", postback_event(user_id, f"SAVE_NO_COMMENT|{place_id}"), True),
+    ]
+
+
+def recommend_session(user_id: str) -> list:
+    return [
+        ("recommend.menu", text_event(user_id, "📍近くのおすすめ"), False),
+        ("recommend.location", location_event(user_id, 35.68, 139.76), False),
+        ("recommend.result", text_event(user_id, random.choice(["デート", "一人", "静か"])), True),
+    ]
+
+
+SESSIONS = [(search_session, 0.7), (recommend_session, 0.3)]
+
+
+# -----------------------------------------------
+# 実行
+# -----------------------------------------------
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.http = []         # (送信時刻, status, seconds)
+        self.jobs = {}         # step 名 -> [秒]
+        self.timeouts = {}
+        self.via = {"reply": 0, "push": 0}   # 結果がどちらで届いたか
+
+    def add_http(self, sent_at, status, seconds):
+        with self.lock:
+            self.http.append((sent_at, status, seconds))
+
+    def add_job(self, step, seconds, via=None):
+        with self.lock:
+            if via:
+                self.via[via] += 1
+            if seconds is None:
+                self.timeouts[step] = self.timeouts.get(step, 0) + 1
+            else:
+                self.jobs.setdefault(step, []).append(seconds)
+
+
+def run_session(url, steps, fake, results, job_timeout, think_time):
+    import requests
+
+    http = requests.Session()
+    for step, event, expect_result in steps:
+        body = json.dumps({"destination": "Ubench", "events": [event]}, ensure_ascii=False)
+        user_id = event["source"]["userId"]
+        q = fake.queue_of(user_id)
+        while not q.empty():
+            q.get_nowait()
+
+        t0 = time.perf_counter()
+        try:
+            res = http.post(url, data=body.encode("utf-8"), headers={
+                "Content-Type": "application/json", "X-Line-Signature": sign(body),
+            }, timeout=10)
+            status = res.status_code
+        except Exception:
+            status = 0
+        results.add_http(t0, status, time.perf_counter() - t0)
+        if status != 200:
+            return
+
+        if expect_result:
+            deadline = t0 + job_timeout
+            try:
+                while True:
+                    t_sent, via, messages = q.get(timeout=max(0.0, deadline - time.perf_counter()))
+                    if not is_placeholder(messages):
+                        break
+                results.add_job(step, t_sent - t0, via)
+            except queue.Empty:
+                results.add_job(step, None)
+                return
+
+        time.sleep(think_time * random.uniform(0.5, 1.5))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rps", type=float, default=20, help="目標リクエスト数/秒（Webhook 単位。セッションの開始間隔をここから決める）")
+    ap.add_argument("--duration", type=float, default=30, help="送信する時間（秒）")
+    ap.add_argument("--latency-scale", type=float, default=1.0, help="上流スタブの待ち時間の倍率")
+    ap.add_argument("--think-time", type=float, default=0.5, help="ステップ間の待ち（秒）")
+    ap.add_argument("--job-timeout", type=float, default=30)
+    ap.add_argument("--admission", action="store_true", help="受付制御を既定の上限のまま有効にする")
+    ap.add_argument("--port", type=int, default=0)
+    args = ap.parse_args()
+
+    os.environ["LINE_CHANNEL_SECRET"] = SECRET
+    os.environ.setdefault("LINE_CHANNEL_ACCESS_TOKEN", "bench")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ["OPENAI_USAGE_PATH"] = ""
+    if not args.admission:
+        os.environ.update(_ADMISSION_ENV)
+
+    fake = install_stubs(args.latency_scale)
+
+    import logging
+    from werkzeug.serving import make_server
+
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    from bot_line.line_bot import app
+
+    server = make_server("127.0.0.1", args.port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/callback"
+
+    # 1セッションあたりの平均 Webhook 数から、セッション開始の間隔を決める
+    avg_steps = sum(len(make("u")) * w for make, w in SESSIONS)
+    interval = avg_steps / args.rps
+    results = Results()
+    threads = []
+
+    print(f"target {args.rps:.1f} req/s for {args.duration:.0f}s ({1 / interval:.2f} sessions/s)")
+    t_start = time.perf_counter()
+    n = 0
+    while time.perf_counter() - t_start < args.duration:
+        make = random.choices([m for m, _ in SESSIONS], weights=[w for _, w in SESSIONS])[0]
+        steps = make(f"Ubench{n:08d}")
+        t = threading.Thread(
+            target=run_session,
+            args=(url, steps, fake, results, args.job_timeout, args.think_time),
+            daemon=True,
+        )
+        t.start()
+        threads.append(t)
+        n += 1
+        time.sleep(max(0.0, t_start + n * interval - time.perf_counter()))
+
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - t_start
+    server.shutdown()
+
+    sent = [t for t, _, _ in results.http]
+    statuses = [s for _, s, _ in results.http]
+    errors = sum(1 for s in statuses if s != 200)
+    http_times = [t for _, _, t in results.http]
+    span = max(sent) - min(sent) if len(sent) > 1 else elapsed
+
+    print(f"sessions: {n}  requests: {len(statuses)}  elapsed (incl. drain): {elapsed:.1f}s")
+    print(f"throughput: {len(statuses) / span:.1f} req/s  error rate: {errors / max(1, len(statuses)):.2%}")
+    print(
+        f"webhook response  p50 {percentile(http_times, 0.5):.1f}ms"
+        f"  p95 {percentile(http_times, 0.95):.1f}ms  p99 {percentile(http_times, 0.99):.1f}ms"
+    )
+    delivered = results.via["reply"] + results.via["push"]
+    print(
+        f"results via reply: {results.via['reply']}  via push: {results.via['push']}"
+        f"  ({results.via['reply'] / max(1, delivered):.0%} reply)"
+        f"  LINE API calls reply/push: {fake.counts['reply']}/{fake.counts['push']}"
+    )
+    print(f"{'job':<20} {'count':>6} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'timeout':>8}")
+    for step in sorted(set(results.jobs) | set(results.timeouts)):
+        times = results.jobs.get(step, [])
+        row = (
+            f"{percentile(times, 0.5):>9.0f} {percentile(times, 0.95):>9.0f} {percentile(times, 0.99):>9.0f}"
+            if times else f"{'-':>9} {'-':>9} {'-':>9}"
+        )
+        print(f"{step:<20} {len(times):>6} {row} {results.timeouts.get(step, 0):>8}")
+
+
+if __name__ == "__main__":
+    main()
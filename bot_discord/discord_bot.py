@@ -1,36 +1,127 @@
 # bot_discord/discord_bot.py
 
 import os
+import json
+import hashlib
+import asyncio
+from datetime import datetime
 import discord
 from discord import app_commands
 from discord.ui import Button, View
 
 # ====== 共通モジュール ======
 from modules import (
-    search_candidates,
+    CandidateCursor,
     get_place_details,
     geocode_address,
     analyze_store,
-    upsert_store,
+    enqueue_store,
     build_page_url,
-    fetch_all_entries,
+    fetch_all_records,
+    NotionReadError,
+    bbox_filter,
+    rating_filter,
+    and_filters,
     convert_price_level,
-    calc_distance,
+    RankingEngine,
+    CandidateSet,
+    NEARBY_WEIGHTS,
+    get_shared_tag_index,
+    search_saved_stores,
+    store_similarity,
+    trim_text,
+    get_prefetcher,
+    try_admit,
+    get_store_snapshot,
+    snapshot_candidates,
+    watch_recent_upserts,
+    JST,
 )
+from bot_discord.scheduler import WorkScheduler, QueueFull
+
 
 # ====== Discord Bot 本体 ======
-class MyBot(discord.Client):
+def _shard_options() -> dict:
+    """
+    DISCORD_SHARD_COUNT 未指定なら Discord の推奨シャード数で自動起動する。
+    複数プロセスに分ける場合は DISCORD_SHARD_IDS（例: "0,1"）でこのプロセスが受け持つシャードを指定。
+    """
+    options = {}
+    if os.getenv("DISCORD_SHARD_COUNT"):
+        options["shard_count"] = int(os.getenv("DISCORD_SHARD_COUNT"))
+        if os.getenv("DISCORD_SHARD_IDS"):
+            options["shard_ids"] = [int(i) for i in os.getenv("DISCORD_SHARD_IDS").split(",")]
+    return options
+
+
+class MyBot(discord.AutoShardedClient):
     def __init__(self):
         intents = discord.Intents.default()
-        super().__init__(intents=intents)
+        super().__init__(intents=intents, **_shard_options())
         self.tree = app_commands.CommandTree(self)
 
     async def setup_hook(self):
+        # スナップショットの書き出し後にこのプロセスで保存した店を /nearby に含める
+        # （import 時には notion_client を読み込まないよう、起動時に登録する）
+        watch_recent_upserts()
+
+        # コマンド定義が前回同期時から変わっていなければ sync をスキップ
+        digest = _command_tree_digest(self.tree, self.application_id)
+
+        if os.getenv("DISCORD_FORCE_SYNC") != "1" and _load_synced_digest() == digest:
+            print("Slash Commands unchanged, skip sync")
+            return
+
         await self.tree.sync()
+        _save_synced_digest(digest)
         print("Slash Commands Synced!")
 
+
+# --------------------------------------
+# コマンドツリーの同期状態
+# --------------------------------------
+TREE_SYNC_STATE_PATH = os.getenv("DISCORD_TREE_SYNC_STATE", ".discord_tree_sync")
+
+
+def _command_tree_digest(tree, application_id) -> str:
+    """コマンド定義（名前・説明・引数）からハッシュを作る"""
+    payload = {
+        "application_id": application_id,
+        "commands": sorted(
+            (c.to_dict(tree) for c in tree.get_commands()),
+            key=lambda c: c["name"]
+        ),
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def _load_synced_digest() -> str | None:
+    try:
+        with open(TREE_SYNC_STATE_PATH, encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _save_synced_digest(digest: str):
+    try:
+        with open(TREE_SYNC_STATE_PATH, "w", encoding="utf-8") as f:
+            f.write(digest)
+    except OSError as e:
+        print(f"[Discord BOT] sync state save failed: {e}")
+
+
 bot = MyBot()
 
+nearby_ranker = RankingEngine(NEARBY_WEIGHTS)
+
+# AI 解析の同時実行数（全体・サーバーごと）と順番待ち
+analysis_scheduler = WorkScheduler()
+
+# /nearby で Notion から取得するプロパティ
+NEARBY_PROPERTIES = ["店名", "place_id", "lat", "lng", "評価", "料金", "Tags", "店タイプ", "サブタイプ"]
+
 
 # --------------------------------------
 # Embed 作成
@@ -63,19 +154,92 @@ def build_embed(details, summary, tags, store_type, recs, notion_url):
 
 
 # --------------------------------------
-# 店保存処理（AI & Notion）
+# 受付制御
 # --------------------------------------
-async def process_save(interaction, place_id, comment):
+async def _admit(interaction, kind):
+    """受付制御を通ったら Ticket を返す。上限超過なら本人にだけ理由を返して None"""
+    ticket, rejected = try_admit(f"discord:{interaction.user.id}", kind)
+    if ticket is None:
+        if interaction.response.is_done():
+            await interaction.followup.send(rejected.message, ephemeral=True)
+        else:
+            await interaction.response.send_message(rejected.message, ephemeral=True)
+    return ticket
+
 
-    await interaction.followup.send("⏳ AI分析中...")
+def _guild_key(interaction):
+    """順番待ちの単位（DM はユーザーごと）"""
+    return interaction.guild_id or f"dm:{interaction.user.id}"
 
-    details = get_place_details(place_id)
 
-    result = analyze_store(details["name"], details.get("types", []), details.get("reviews", []))
+# --------------------------------------
+# 店保存処理（AI & Notion）
+# --------------------------------------
+async def process_save(interaction, place_id, comment, prefetch_key=None):
+    # AI 解析を伴うので受付制御を通す（応答は defer 済みなので followup で断る）
+    ticket = await _admit(interaction, "select")
+    if ticket is None:
+        return
+
+    with ticket:
+        guild_key = _guild_key(interaction)
+        queued = analysis_scheduler.would_wait(guild_key)
+        status = await interaction.followup.send(
+            "⏳ 順番待ち中..." if queued else "⏳ AI分析中...", wait=True
+        )
+        started = False
+        edit_lock = asyncio.Lock()
+
+        async def show_position(position):
+            async with edit_lock:
+                if not started:
+                    await status.edit(content=f"⏳ 混み合っています。順番待ち：{position}番目")
+
+        try:
+            async with analysis_scheduler.slot(guild_key, on_position=show_position):
+                async with edit_lock:
+                    started = True
+                    if queued:
+                        await status.edit(content="⏳ AI分析中...")
+                await _analyze_and_save(interaction, place_id, comment, prefetch_key)
+        except QueueFull:
+            await status.edit(content="🙏 いまAI解析が混み合っています。少し待ってからもう一度試してね！")
+
+
+async def _analyze_and_save(interaction, place_id, comment, prefetch_key):
+    # 候補選択中に先読みしていればその結果を使う（実行中ならイベントループを止めずに待つ）
+    prefetched = {}
+    if prefetch_key is not None:
+        prefetched = await asyncio.to_thread(get_prefetcher().take, prefetch_key, place_id) or {}
+
+    # 上流 API の呼び出しはスレッドで実行し、イベントループ（LINE と共有する場合もある）を止めない
+    details = prefetched.get("details") or await asyncio.to_thread(get_place_details, place_id)
+
+    result = prefetched.get("analysis") or await asyncio.to_thread(
+        analyze_store, details["name"], details.get("types", []), details.get("reviews", []),
+        place_id=details.get("place_id"),
+    )
     summary, tags, store_type, recs = result["summary"], result["tags"], result["store_type"], result["recs"]
 
-    page_id = upsert_store(details, summary, tags, store_type, recs, comment)
-    notion_url = build_page_url(page_id)
+    # Notion への書き込みは outbox に任せて、結果はすぐ表示する
+    loop = asyncio.get_running_loop()
+
+    def notify_new_page(new_page_id):
+        asyncio.run_coroutine_threadsafe(
+            interaction.followup.send(f"📒 Notion に反映しました: {build_page_url(new_page_id)}"), loop
+        )
+
+    def notify_failed(error):
+        asyncio.run_coroutine_threadsafe(
+            interaction.followup.send(f"❌ 「{details.get('name', '')}」を Notion に保存できませんでした。もう一度 /save してください。"),
+            loop,
+        )
+
+    page_id = await asyncio.to_thread(
+        enqueue_store, details, summary, tags, store_type, recs, comment,
+        on_created=notify_new_page, on_failed=notify_failed,
+    )
+    notion_url = build_page_url(page_id) if page_id else None
 
     embed = build_embed(details, summary, tags, store_type, recs, notion_url)
     await interaction.followup.send(embed=embed)
@@ -84,6 +248,9 @@ async def process_save(interaction, place_id, comment):
 # --------------------------------------
 # 候補選択 UI
 # --------------------------------------
+CANDIDATES_PER_PAGE = 6   # 選択ビューに並べる候補数（残りは「次の候補」で表示）
+
+
 class PlaceButton(Button):
     def __init__(self, label, place_id, callback, comment):
         super().__init__(label=label, style=discord.ButtonStyle.primary)
@@ -93,13 +260,36 @@ class PlaceButton(Button):
 
     async def callback(self, interaction):
         await interaction.response.defer()
+        self.view.stop()
         await self._callback(interaction, self.place_id, self.comment)
 
 
+class MoreButton(Button):
+    """次の候補ページを表示する（まだ取得していなければここで Text Search の続きを読む）"""
+
+    def __init__(self):
+        super().__init__(label="▶ 次の候補", style=discord.ButtonStyle.secondary)
+
+    async def callback(self, interaction):
+        await interaction.response.defer()
+        old = self.view
+        new_view = await old.next_view()
+        if new_view is None:
+            await interaction.followup.send("❌ これ以上の候補はありません。", ephemeral=True)
+            return
+        old.stop()
+        await interaction.edit_original_response(view=new_view)
+
+
 class PlaceSelectView(View):
-    def __init__(self, candidates, callback, comment):
+    def __init__(self, candidates, callback, comment, prefetch_key=None, cursor=None, page=0):
         super().__init__(timeout=60)
-        for c in candidates[:6]:
+        self.prefetch_key = prefetch_key
+        self.cursor = cursor
+        self.page = page
+        self._callback = callback
+        self._comment = comment
+        for c in candidates[:CANDIDATES_PER_PAGE]:
             self.add_item(
                 PlaceButton(
                     label=c["name"],
@@ -108,6 +298,25 @@ class PlaceSelectView(View):
                     comment=comment
                 )
             )
+        if cursor is not None and cursor.has_more(page, CANDIDATES_PER_PAGE):
+            self.add_item(MoreButton())
+
+    async def next_view(self) -> "PlaceSelectView | None":
+        """次のページのビュー（候補がなければ None）。取得済みのページは API を呼ばない"""
+        page = self.page + 1
+        candidates = await asyncio.to_thread(self.cursor.page, page, CANDIDATES_PER_PAGE)
+        if not candidates:
+            return None
+        if self.prefetch_key is not None:
+            get_prefetcher().start(self.prefetch_key, candidates)
+        return PlaceSelectView(
+            candidates, self._callback, self._comment, self.prefetch_key, self.cursor, page
+        )
+
+    async def on_timeout(self):
+        # 選ばれないまま期限切れ → 残っている先読みを取り消す
+        if self.prefetch_key is not None:
+            get_prefetcher().cancel(self.prefetch_key)
 
 
 # --------------------------------------
@@ -115,104 +324,187 @@ class PlaceSelectView(View):
 # --------------------------------------
 @bot.tree.command(name="save", description="飲食店を保存（AI解析＋Notion）")
 async def save(interaction, query: str, comment: str | None = None):
-    await interaction.response.defer(ephemeral=False)
+    ticket = await _admit(interaction, "search")
+    if ticket is None:
+        return
 
-    candidates = search_candidates(query)
+    with ticket:
+        await interaction.response.defer(ephemeral=False)
 
-    if not candidates:
-        await interaction.followup.send("❌ 店舗が見つかりませんでした。")
-        return
+        cursor = CandidateCursor(query)
+        candidates = await asyncio.to_thread(cursor.page, 0, CANDIDATES_PER_PAGE)
 
-    # 複数候補 → 選択
-    if len(candidates) > 1:
+        if not candidates:
+            await interaction.followup.send("❌ 店舗が見つかりませんでした。")
+            return
 
-        async def on_select(inter, selected_pid, comment_local):
-            await process_save(inter, selected_pid, comment_local)
+        # 複数候補 → 選択
+        if len(candidates) > 1 or cursor.has_more(0, CANDIDATES_PER_PAGE):
 
-        view = PlaceSelectView(candidates, on_select, comment)
-        await interaction.followup.send(
-            "🔎 複数の候補が見つかりました。選択してください。",
-            view=view
-        )
-        return
+            # 選択中に上位候補の詳細・AI解析を先読みする（キーは /save の実行ごと）
+            prefetch_key = f"discord:{interaction.id}"
 
-    # 1件 → そのまま保存
-    await process_save(interaction, candidates[0]["place_id"], comment)
+            async def on_select(inter, selected_pid, comment_local):
+                await process_save(inter, selected_pid, comment_local, prefetch_key)
+
+            view = PlaceSelectView(candidates, on_select, comment, prefetch_key, cursor)
+            await interaction.followup.send(
+                "🔎 複数の候補が見つかりました。選択してください。",
+                view=view
+            )
+            get_prefetcher().start(prefetch_key, candidates)
+            return
+
+        # 1件 → そのまま保存
+        await process_save(interaction, candidates[0]["place_id"], comment)
 
 
 # --------------------------------------
 # /nearby コマンド
 # --------------------------------------
-@bot.tree.command(name="nearby", description="近くのおすすめ店舗（距離＋タグ＋評価）")
-async def nearby(interaction, location: str, conditions: str = ""):
-    await interaction.response.defer(ephemeral=False)
+def _nearby_candidates(lat0, lng0, radius_km, min_rating, cond_words, match_all):
+    """
+    半径内（矩形、radius_km が None なら全域）・評価条件に合う店の CandidateSet と、条件ワードのタグ一致数。
+    店舗スナップショット（modules.snapshot）があれば memory-map した配列から、
+    なければ Notion から取得してタグインデックスで判定する。
+    スナップショットは書き出し間隔の分だけ古いので、このプロセスで保存した店は recent_records で補う
+    （他のプロセスで保存した店は次の書き出しまで出てこない）。
+    """
+    snap = get_store_snapshot()
+    if snap is not None:
+        return snapshot_candidates(snap, lat0, lng0, radius_km, min_rating, cond_words, match_all)
+
+    # Notion から半径内（矩形、半径の指定があるときだけ）・評価条件に合う店だけを必要な項目に絞って取得
+    records = fetch_all_records(
+        filter=and_filters(
+            bbox_filter(lat0, lng0, radius_km) if radius_km else None,
+            rating_filter(min_rating) if min_rating else None,
+        ),
+        properties=NEARBY_PROPERTIES,
+    )
 
-    cond_words = [c.lower() for c in conditions.split() if c.strip()]
+    # タグ条件はインデックスのビット演算で判定（部分一致）
+    index = get_shared_tag_index()
+    cands = CandidateSet.from_records(records)
+    slots = index.slots_of([r.page_id for r in cands.items])
 
-    # 住所 → 緯度経度（google_api.geocode_address を使用）
-    loc = geocode_address(location)
-    if not loc:
-        await interaction.followup.send("❌ 現在地を解析できません。")
-        return
+    # match_all：全条件を満たす店だけに絞り込む
+    if match_all and cond_words:
+        mask = index.query_mask(cond_words, slots, op="and")
+        cands, slots = cands.subset(mask), slots[mask]
+
+    return cands, index.match_counts(cond_words, slots)
 
-    lat0, lng0 = loc["lat"], loc["lng"]
 
-    # Notion 全件取得（notion_client.fetch_all_entries を使用）
-    entries = fetch_all_entries()
+def _rank_nearby(lat0, lng0, radius_km, min_rating, cond_words, conditions, match_all, open_at=None):
+    cands, tag_match_counts = _nearby_candidates(lat0, lng0, radius_km, min_rating, cond_words, match_all)
 
-    scored = []
-    for e in entries:
-        props = e["properties"]
+    # 条件文の埋め込み（OpenAI 呼び出し）との類似度
+    similarity = store_similarity(conditions, cands.place_ids)
 
-        lat = props.get("lat", {}).get("number")
-        lng = props.get("lng", {}).get("number")
-        if lat is None or lng is None:
-            continue
+    # タグ一致数 + 評価でスコアリングし、上位3件を取得
+    return nearby_ranker.rank(
+        cands,
+        {
+            "lat": lat0, "lng": lng0, "conditions": cond_words,
+            "max_distance_km": radius_km,
+            "tag_match_counts": tag_match_counts,
+            "semantic_similarity": similarity,
+            "open_at": open_at,
+        },
+        k=3,
+    )
 
-        distance = calc_distance(lat0, lng0, lat, lng)
 
-        tags = [t["name"].lower() for t in props.get("Tags", {}).get("multi_select", [])]
+@bot.tree.command(name="nearby", description="近くのおすすめ店舗（距離＋タグ＋評価）")
+async def nearby(
+    interaction,
+    location: str,
+    conditions: str = "",
+    match_all: bool = False,
+    radius_km: float | None = None,
+    min_rating: float | None = None,
+    open_now: bool = False,
+):
+    ticket = await _admit(interaction, "nearby")
+    if ticket is None:
+        return
 
-        score = 0
-        for cond in cond_words:
-            if cond in tags:
-                score += 1
+    with ticket:
+        await interaction.response.defer(ephemeral=False)
 
-        rating = props.get("評価", {}).get("number")
-        if rating:
-            score += (rating - 3.0) * 0.5
+        cond_words = [c.lower() for c in conditions.split() if c.strip()]
+
+        # 住所 → 緯度経度（google_api.geocode_address を使用）
+        loc = await asyncio.to_thread(geocode_address, location)
+        if not loc:
+            await interaction.followup.send("❌ 現在地を解析できません。")
+            return
+
+        lat0, lng0 = loc["lat"], loc["lng"]
+
+        # 候補の取得・タグ判定・スコアリングは店舗数に比例する処理なのでスレッドで実行し、
+        # ハートビート（シャードの接続維持）を止めない
+        try:
+            ranked = await asyncio.to_thread(
+                _rank_nearby, lat0, lng0, radius_km, min_rating, cond_words, conditions, match_all,
+                datetime.now(JST) if open_now else None,
+            )
+        except NotionReadError as e:
+            # 一部の店だけで順位を付けると結果が欠けるので、取得できなければ断る
+            print(f"[Discord BOT] nearby: {e}")
+            await interaction.followup.send("❌ 保存済みの店舗を取得できませんでした。時間をおいて試してください。")
+            return
+
+        if not ranked:
+            await interaction.followup.send("❌ 条件に合う店がありません")
+            return
+
+        for item in ranked:
+            r = item["item"]
+
+            notion_url = build_page_url(r.page_id)
+            embed = discord.Embed(
+                title=f"📍 {r.name}",
+                url=notion_url,
+                description=f"距離：{item['distance']:.2f} km\nスコア：{item['score']:.2f}",
+                color=0x00AA88
+            )
+            embed.add_field(name="評価", value=f"{r.rating if r.rating is not None else 'N/A'}★")
+            embed.add_field(name="料金", value=convert_price_level(r.price_level))
+            embed.add_field(name="タグ", value=", ".join(r.tags) or "なし", inline=False)
 
-        scored.append({
-            "entry": e,
-            "distance": distance,
-            "score": score
-        })
+            await interaction.followup.send(embed=embed)
 
-    ranked = sorted(scored, key=lambda x: (-x["score"], x["distance"]))[:3]
 
-    if not ranked:
-        await interaction.followup.send("❌ 条件に合う店がありません")
+# --------------------------------------
+# /search コマンド（保存済みの印象・感想・おすすめを全文検索）
+# --------------------------------------
+@bot.tree.command(name="search", description="保存した店を印象・感想・おすすめメニューから検索")
+async def search(interaction, keywords: str):
+    ticket = await _admit(interaction, "memo")
+    if ticket is None:
         return
 
-    for item in ranked:
-        e = item["entry"]
-        props = e["properties"]
+    with ticket:
+        await interaction.response.defer(ephemeral=False)
+
+        results = await asyncio.to_thread(search_saved_stores, keywords, limit=5)
+
+        if not results:
+            await interaction.followup.send(f"❌「{keywords}」に一致する店はありません")
+            return
 
-        name = props["店名"]["title"][0]["text"]["content"]
-        notion_url = build_page_url(e["id"])
         embed = discord.Embed(
-            title=f"📍 {name}",
-            url=notion_url,
-            description=f"距離：{item['distance']:.2f} km\nスコア：{item['score']:.2f}",
-            color=0x00AA88
-        )
-        embed.add_field(name="評価", value=f"{props.get('評価', {}).get('number', 'N/A')}★")
-        embed.add_field(name="料金", value=convert_price_level(props.get("料金", {}).get("number")))
-        embed.add_field(
-            name="タグ",
-            value=", ".join([t["name"] for t in props.get("Tags", {}).get("multi_select", [])]) or "なし",
-            inline=False
+            title=f"🔎「{keywords}」の検索結果",
+            color=0x8855FF
         )
+        for r in results:
+            embed.add_field(
+                name=f"📍 {r['name']}",
+                value=trim_text(f"{r['field']}：{r['snippet']}\n{build_page_url(r['page_id'])}", 1000),
+                inline=False
+            )
 
         await interaction.followup.send(embed=embed)
 
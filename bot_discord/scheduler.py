@@ -0,0 +1,138 @@
+# bot_discord/scheduler.py
+#
+# スラッシュコマンドの重い処理（AI 解析）の順番待ち。
+#   - 全体とサーバー（guild）ごとに同時実行数の上限を持つ
+#   - 空きがなければ FIFO で並び、順番が変わるたびに on_position で待ち順を知らせる
+#   - 1つのサーバーが枠を使い切っていても、他のサーバーの依頼は追い越して実行できる
+# すべてイベントループ上で動くのでロックは使わない（ブロッキング処理は呼び出し側で asyncio.to_thread）。
+import asyncio
+import os
+from collections import deque
+from contextlib import asynccontextmanager
+
+DISCORD_MAX_ANALYSES = int(os.getenv("DISCORD_MAX_ANALYSES", 4))
+DISCORD_GUILD_MAX_ANALYSES = int(os.getenv("DISCORD_GUILD_MAX_ANALYSES", 2))
+DISCORD_QUEUE_MAX = int(os.getenv("DISCORD_QUEUE_MAX", 50))
+
+
+class QueueFull(Exception):
+    """待ち行列が上限に達している"""
+
+
+class _Waiter:
+    __slots__ = ("guild_key", "future", "on_position", "position")
+
+    def __init__(self, guild_key, future, on_position):
+        self.guild_key = guild_key
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+
+
+class WorkScheduler:
+    def __init__(self, global_limit: int = DISCORD_MAX_ANALYSES,
+                 guild_limit: int = DISCORD_GUILD_MAX_ANALYSES, max_queue: int = DISCORD_QUEUE_MAX):
+        self.global_limit = global_limit
+        self.guild_limit = guild_limit
+        self.max_queue = max_queue
+        self._running = {}
+        self._running_total = 0
+        self._waiters = deque()
+        self.stats = {"immediate": 0, "waited": 0, "rejected": 0}
+
+    # ---------------------------
+    # 枠の管理
+    # ---------------------------
+    def _can_run(self, guild_key) -> bool:
+        return (
+            self._running_total < self.global_limit
+            and self._running.get(guild_key, 0) < self.guild_limit
+        )
+
+    def _acquire(self, guild_key):
+        self._running[guild_key] = self._running.get(guild_key, 0) + 1
+        self._running_total += 1
+
+    def _release(self, guild_key):
+        self._running_total -= 1
+        left = self._running.get(guild_key, 1) - 1
+        if left:
+            self._running[guild_key] = left
+        else:
+            self._running.pop(guild_key, None)
+        self._dispatch()
+
+    def _dispatch(self):
+        """空いた枠に、実行できる先頭の待ちを入れる"""
+        for waiter in list(self._waiters):
+            if self._running_total >= self.global_limit:
+                break
+            if self._running.get(waiter.guild_key, 0) < self.guild_limit:
+                self._waiters.remove(waiter)
+                self._acquire(waiter.guild_key)
+                waiter.future.set_result(None)
+        self._notify_positions()
+
+    def _notify_positions(self):
+        for i, waiter in enumerate(self._waiters, start=1):
+            if waiter.position != i:
+                waiter.position = i
+                if waiter.on_position is not None:
+                    asyncio.get_running_loop().create_task(_call_quietly(waiter.on_position, i))
+
+    # ---------------------------
+    # 公開 API
+    # ---------------------------
+    @asynccontextmanager
+    async def slot(self, guild_key, on_position=None):
+        """
+        実行枠を取る（async with で使う）。
+        待つことになったら on_position(待ち順) を await で呼ぶ（順番が変わるたび）。
+        待ち行列が一杯なら QueueFull。
+        """
+        if self._can_run(guild_key):
+            self._acquire(guild_key)
+            self.stats["immediate"] += 1
+        else:
+            if len(self._waiters) >= self.max_queue:
+                self.stats["rejected"] += 1
+                raise QueueFull()
+
+            waiter = _Waiter(guild_key, asyncio.get_running_loop().create_future(), on_position)
+            self._waiters.append(waiter)
+            self.stats["waited"] += 1
+            self._notify_positions()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    self._notify_positions()
+                elif waiter.future.done() and not waiter.future.cancelled():
+                    # 枠を渡された直後にキャンセルされた
+                    self._release(guild_key)
+                raise
+
+        try:
+            yield
+        finally:
+            self._release(guild_key)
+
+    def would_wait(self, guild_key) -> bool:
+        """いま slot() を呼ぶと待つことになるか"""
+        return not self._can_run(guild_key)
+
+    def snapshot(self) -> dict:
+        return {
+            "running": self._running_total,
+            "queued": len(self._waiters),
+            "running_by_guild": dict(self._running),
+            **self.stats,
+        }
+
+
+async def _call_quietly(fn, position):
+    try:
+        await fn(position)
+    except Exception as e:
+        print(f"[Scheduler] position callback failed: {e}")
@@ -3,7 +3,8 @@ import os
 import threading
 import math
 import time
-from flask import Flask, request, abort
+from datetime import datetime
+from flask import Flask, request, abort, send_file
 from linebot.models import LocationMessage
 
 from linebot import LineBotApi, WebhookHandler
@@ -14,11 +15,21 @@ from linebot.models import (
 
 # 共通モジュール
 from modules import (
-    search_candidates, search_nearby, get_place_details,
+    CandidateCursor, search_nearby, get_place_details,
     analyze_store,
-    upsert_store, build_page_url,
+    enqueue_store, build_page_url,
     build_photo_url, TYPE_ICON, SUBTYPE_ICON,
-    build_rating_stars, calc_distance,
+    build_rating_stars,
+    RankingEngine, CandidateSet, RECOMMEND_WEIGHTS, RECOMMEND_PRERANK_WEIGHTS,
+    search_saved_stores, fulltext_index_ready, trim_text,
+    store_similarity, get_prefetcher, try_admit,
+    JST,
+)
+from bot_line.responder import (
+    Responder, DeadlineEstimator, current_responder, schedule_deadline,
+)
+from modules.photo_cache import (
+    get_photo_cache, photo_proxy_enabled, verify_photo_request, PHOTO_FORMATS, PHOTO_WIDTHS,
 )
 
 app = Flask(__name__)
@@ -26,9 +37,32 @@ app = Flask(__name__)
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+_line_bot_api = None
+_line_bot_api_lock = threading.Lock()
+
+
+def get_line_bot_api():
+    """LineBotApi を初回利用時に生成して使い回す（起動時の初期化コストを避ける）"""
+    global _line_bot_api
+
+    if _line_bot_api is None:
+        with _line_bot_api_lock:
+            if _line_bot_api is None:
+                _line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+
+    return _line_bot_api
+
+
+# 結果を reply で返せた件数 / push した件数
+reply_stats = {"reply": 0, "push": 0}
+deadline_estimator = DeadlineEstimator()
+
+recommend_ranker = RankingEngine(RECOMMEND_WEIGHTS)
+recommend_preranker = RankingEngine(RECOMMEND_PRERANK_WEIGHTS)
+
+
 # ======================
 # 状態管理
 # ======================
@@ -36,6 +70,10 @@ user_state = {}   # user_id : { mode, place_id, details, summary, tags, store_ty
 
 USER_STATE_TTL = 1800  # セッション有効期限：30分
 
+# 店名検索の候補カーソル（「もっと見る」で続きを読む）。モードとは独立に持つ
+candidate_cursors = {}   # user_id : CandidateCursor
+CANDIDATES_PER_PAGE = 10
+
 
 def _cleanup_stale_sessions():
     """有効期限切れのセッションをメモリから削除する"""
@@ -44,15 +82,19 @@ def _cleanup_stale_sessions():
     for uid in expired:
         user_state.pop(uid, None)
 
+    expired = [uid for uid, c in list(candidate_cursors.items()) if now - c.touched_at > USER_STATE_TTL]
+    for uid in expired:
+        candidate_cursors.pop(uid, None)
+
 
 # ======================
 # 1. 候補一覧 Flex（キャンセル付き）
 # ======================
-def build_candidates_flex(candidates):
+def build_candidates_flex(candidates, next_page=None):
     bubbles = []
 
     # 候補
-    for c in candidates[:10]:
+    for c in candidates[:CANDIDATES_PER_PAGE]:
         bubble = {
             "type": "bubble",
             "size": "micro",
@@ -84,6 +126,36 @@ def build_candidates_flex(candidates):
         }
         bubbles.append(bubble)
 
+    # 続きの候補（押されたときに次のページを取得する）
+    if next_page is not None:
+        bubbles.append({
+            "type": "bubble",
+            "size": "micro",
+            "body": {
+                "type": "box",
+                "layout": "vertical",
+                "contents": [
+                    {"type": "text", "text": "もっと見る", "weight": "bold", "size": "md"},
+                    {"type": "text", "text": "この中にない場合はこちら", "size": "sm", "color": "#777777"},
+                ]
+            },
+            "footer": {
+                "type": "box",
+                "layout": "vertical",
+                "contents": [
+                    {
+                        "type": "button",
+                        "style": "secondary",
+                        "action": {
+                            "type": "postback",
+                            "label": "次の候補",
+                            "data": f"MORE_CANDIDATES|{next_page}"
+                        }
+                    }
+                ]
+            }
+        })
+
     # キャンセル
     cancel_bubble = {
         "type": "bubble",
@@ -206,6 +278,49 @@ def build_store_info_flex(details, summary, tags, store_type, recs, place_id):
     return bubble
 
 
+# ======================
+# 受付制御つきの非同期実行
+# ======================
+def _start_job(event, user_id, kind, ack_text, target, args):
+    """
+    受付制御（modules.admission）を通ったら target を別スレッドで実行する。
+    結果が期限内に出れば reply token で返し、間に合わなければ ack_text を reply して結果は push する
+    （bot_line.responder）。上限を超えていれば理由を返信して終わる。
+    """
+    ticket, rejected = try_admit(f"line:{user_id}", kind)
+    if ticket is None:
+        get_line_bot_api().reply_message(event.reply_token, TextSendMessage(rejected.message))
+        return False
+
+    responder = Responder(
+        get_line_bot_api, event.reply_token, user_id, TextSendMessage(ack_text), reply_stats
+    )
+    deadline = deadline_estimator.deadline(kind)
+
+    def run():
+        token = current_responder.set(responder)
+        started = time.monotonic()
+        try:
+            with ticket:
+                target(*args)
+        finally:
+            current_responder.reset(token)
+            deadline_estimator.record(kind, time.monotonic() - started)
+
+    threading.Thread(target=run).start()
+    schedule_deadline(deadline, responder.expire)
+    return True
+
+
+def _deliver(user_id, messages):
+    """ジョブの結果を送る（実行中のジョブなら reply token を優先し、それ以外は push）"""
+    responder = current_responder.get()
+    if responder is not None and responder.user_id == user_id:
+        responder.send(messages)
+    else:
+        get_line_bot_api().push_message(user_id, messages)
+
+
 # ======================
 # 3. Postback Handler
 # ======================
@@ -220,7 +335,9 @@ def handle_postback(event):
     # ===========================================
     if data in ["CANCEL", "CANCEL_SELECT"]:
         user_state.pop(user_id, None)
-        line_bot_api.reply_message(
+        candidate_cursors.pop(user_id, None)
+        get_prefetcher().cancel(user_id)
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage("🔄 キャンセルしたよ！また気になるお店を教えてね💗")
         )
@@ -230,38 +347,45 @@ def handle_postback(event):
     if data.startswith("SELECT_PLACE|"):
         _, place_id = data.split("|")
 
-        # （1）まず即返信（LINEはこれを待っている）
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🔎 店舗情報を読み込み中…少々お待ちください!!")
+        # 即返信（LINEはこれを待っている）→ 重たい処理はスレッドで別実行
+        _start_job(
+            event, user_id, "select",
+            "🔎 店舗情報を読み込み中…少々お待ちください!!",
+            process_store_selection_async, (user_id, place_id),
         )
+        return
+
+    # ---- 候補の続き ----
+    if data.startswith("MORE_CANDIDATES|"):
+        if user_id not in candidate_cursors:
+            get_line_bot_api().reply_message(
+                event.reply_token,
+                TextSendMessage("❌ セッションが切れています。もう一度検索してください。")
+            )
+            return
 
-        # （2）重たい処理はスレッドで別実行
-        threading.Thread(
-            target=process_store_selection_async,
-            args=(user_id, place_id)
-        ).start()
+        _, page = data.split("|")
+        _start_job(
+            event, user_id, "search",
+            "🔎 続きの候補を検索中…少々お待ちください!!",
+            process_candidate_page_async, (user_id, int(page)),
+        )
         return
 
     # ---- 保存（感想なし） ----
     if data.startswith("SAVE_NO_COMMENT|"):
-        # ① まず「保存中…」を即返す
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="📝 保存処理中…少々お待ちください!!")
+        # 「保存中…」を即返し、処理はスレッドで実行（タイムアウト防止）
+        _start_job(
+            event, user_id, "save",
+            "📝 保存処理中…少々お待ちください!!",
+            process_save_no_comment_async, (user_id,),
         )
-
-        # ② 処理はスレッドで実行（タイムアウト防止）
-        threading.Thread(
-            target=process_save_no_comment_async,
-            args=(user_id,)
-        ).start()
         return
 
     # ---- 保存しない ----
     if data.startswith("SAVE_NO"):
         user_state.pop(user_id, None)
-        line_bot_api.reply_message(
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage("了解！また別のお店を検索してね！")
         )
@@ -271,7 +395,7 @@ def handle_postback(event):
     if data.startswith("SAVE_WITH_COMMENT|"):
         # セッションが切れている場合の安全チェック
         if user_id not in user_state:
-            line_bot_api.reply_message(
+            get_line_bot_api().reply_message(
                 event.reply_token,
                 TextSendMessage("❌ セッションが切れています。もう一度検索してください。")
             )
@@ -280,7 +404,7 @@ def handle_postback(event):
         user_state[user_id]["mode"] = "waiting_comment"
         user_state[user_id]["_ts"] = time.time()
 
-        line_bot_api.reply_message(
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage("📝 感想を入力してください！\n不要なら「スキップ」と送ってね！")
         )
@@ -301,7 +425,8 @@ def handle_text_message(event):
     # ===========================================
     if text in ["キャンセル", "cancel", "やめる", "中止", "リセット"]:
         user_state.pop(user_id, None)
-        line_bot_api.reply_message(
+        get_prefetcher().cancel(user_id)
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage("🔄 キャンセルしたよ！またお店を検索してね💗")
         )
@@ -312,7 +437,7 @@ def handle_text_message(event):
     # ===========================================
     if text.startswith("🔍検索"):
         user_state[user_id] = {"mode": "search", "_ts": time.time()}
-        line_bot_api.reply_message(
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage("🔍 店名で検索するよ！\n調べたいお店の名前を送ってね。")
         )
@@ -323,7 +448,7 @@ def handle_text_message(event):
     # ===========================================
     if text.startswith("📍近くのおすすめ"):
         user_state[user_id] = {"mode": "recommend", "_ts": time.time()}
-        line_bot_api.reply_message(
+        get_line_bot_api().reply_message(
             event.reply_token,
             TextSendMessage(
                 "📍 おすすめ検索モードだよ！\n"
@@ -333,23 +458,33 @@ def handle_text_message(event):
         )
         return
 
+    # ===========================================
+    # 📝メモ検索（リッチメニュー） → 保存済み店舗の全文検索モード
+    # ===========================================
+    if text.startswith("📝メモ検索"):
+        user_state[user_id] = {"mode": "memo_search", "_ts": time.time()}
+        get_line_bot_api().reply_message(
+            event.reply_token,
+            TextSendMessage(
+                "📝 保存したお店を検索するよ！\n"
+                "印象・感想・おすすめメニューに含まれる言葉を送ってね。\n"
+                "（例：ラーメン 濃厚）"
+            )
+        )
+        return
+
     # ===========================================
     # ② 感想入力モード（SAVE_WITH_COMMENT）
     # ===========================================
     if user_state.get(user_id, {}).get("mode") == "waiting_comment":
         comment = "" if text.lower() == "スキップ" else text
 
-        # 即返信（LINEの制約）
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("📝 保存処理中…少々お待ちください!!")
+        # 即返信（LINEの制約）→ 保存処理は非同期で実行
+        _start_job(
+            event, user_id, "save",
+            "📝 保存処理中…少々お待ちください!!",
+            process_save_with_comment_async, (user_id, comment),
         )
-
-        # 保存処理は非同期で実行
-        threading.Thread(
-            target=process_save_with_comment_async,
-            args=(user_id, comment)
-        ).start()
         return
 
     # ===========================================
@@ -358,22 +493,44 @@ def handle_text_message(event):
     if user_state.get(user_id, {}).get("mode") == "search":
         query = text
 
-        # 即返信
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("🔎 店舗検索中…少々お待ちください!!")
+        # 即返信 → 非同期検索
+        _start_job(
+            event, user_id, "search",
+            "🔎 店舗検索中…少々お待ちください!!",
+            process_candidate_search_async, (user_id, query),
         )
 
-        # 非同期検索
-        threading.Thread(
-            target=process_candidate_search_async,
-            args=(user_id, query)
-        ).start()
-
         # 検索後はモードクリア（次の動作のため）
         user_state.pop(user_id, None)
         return
 
+    # ===========================================
+    # 📝メモ検索：検索語受信
+    # ===========================================
+    if user_state.get(user_id, {}).get("mode") == "memo_search":
+        user_state.pop(user_id, None)
+
+        # インデックス構築済みならその場で返信（数ms）。受付制御はジョブと同じく通す
+        if fulltext_index_ready():
+            ticket, rejected = try_admit(f"line:{user_id}", "memo")
+            if ticket is None:
+                get_line_bot_api().reply_message(event.reply_token, TextSendMessage(rejected.message))
+                return
+            with ticket:
+                get_line_bot_api().reply_message(
+                    event.reply_token,
+                    TextSendMessage(text=build_memo_search_text(text))
+                )
+            return
+
+        # 初回はインデックス構築（Notion 全件取得）があるので非同期
+        _start_job(
+            event, user_id, "memo",
+            "📝 検索中…少々お待ちください!!",
+            process_memo_search_async, (user_id, text),
+        )
+        return
+
     # ===========================================
     # おすすめ検索：シチュエーション受信
     # ===========================================
@@ -382,7 +539,7 @@ def handle_text_message(event):
 
         # 位置情報がまだの場合
         if "lat" not in state:
-            line_bot_api.reply_message(
+            get_line_bot_api().reply_message(
                 event.reply_token,
                 TextSendMessage(
                     "📍 まず位置情報を送ってね！\n"
@@ -396,17 +553,12 @@ def handle_text_message(event):
         user_state[user_id]["situation"] = situation
         user_state[user_id]["_ts"] = time.time()
 
-        # 即時応答
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage("🔎 おすすめ店舗を検索中…少々お待ちください！")
+        # 即時応答 → 非同期処理
+        _start_job(
+            event, user_id, "recommend",
+            "🔎 おすすめ店舗を検索中…少々お待ちください！",
+            process_recommend_search_async, (user_id,),
         )
-
-        # 非同期処理
-        threading.Thread(
-            target=process_recommend_search_async,
-            args=(user_id,)
-        ).start()
         return
 
     # ===========================================
@@ -416,46 +568,80 @@ def handle_text_message(event):
 
     query = text
 
-    # 即返信
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage("🔎 店舗検索中…少々お待ちください!!")
+    # 即返信 → 非同期検索
+    _start_job(
+        event, user_id, "search",
+        "🔎 店舗検索中…少々お待ちください!!",
+        process_candidate_search_async, (user_id, query),
     )
 
-    # 非同期検索
-    threading.Thread(
-        target=process_candidate_search_async,
-        args=(user_id, query)
-    ).start()
-
 
 # ======================
 # 店舗名から候補一覧検索（Google検索 → Flex生成 → push_message）
 # ======================
 def process_candidate_search_async(user_id, query):
-    candidates = search_candidates(query)
+    # 新しい検索ごとにカーソルを作り直す（2ページ目以降は「もっと見る」で取得）
+    candidate_cursors[user_id] = CandidateCursor(query)
+    process_candidate_page_async(user_id, 0)
+
+
+def process_candidate_page_async(user_id, page):
+    cursor = candidate_cursors.get(user_id)
+    candidates = cursor.page(page, CANDIDATES_PER_PAGE) if cursor else []
 
     if not candidates:
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text="❌ 店舗が見つからなかったよ…もう一度試してね！")
-        )
+        text = "❌ 店舗が見つからなかったよ…もう一度試してね！" if page == 0 else "❌ これ以上の候補は見つからなかったよ…"
+        _deliver(user_id, TextSendMessage(text=text))
         return
 
-    flex = build_candidates_flex(candidates)
+    next_page = page + 1 if cursor.has_more(page, CANDIDATES_PER_PAGE) else None
+    flex = build_candidates_flex(candidates, next_page)
 
-    line_bot_api.push_message(
+    _deliver(
         user_id,
         FlexSendMessage(alt_text="候補一覧", contents=flex)
     )
 
+    # ユーザーが選んでいる間に、表示中の候補の詳細・AI解析を先読みしておく
+    get_prefetcher().start(user_id, candidates)
+
+# ======================
+# メモ検索（全文検索 → テキスト生成）
+# ======================
+def build_memo_search_text(query):
+    results = search_saved_stores(query, limit=5)
+
+    if not results:
+        return f"❌「{query}」に一致するお店は見つからなかったよ…"
+
+    lines = [f"📝「{query}」の検索結果（{len(results)}件）"]
+    for i, r in enumerate(results, 1):
+        lines.append(
+            f"\n{i}. {r['name']}\n"
+            f"{r['field']}：{r['snippet']}\n"
+            f"{build_page_url(r['page_id'])}"
+        )
+
+    return trim_text("\n".join(lines), 4900)
+
+
+def process_memo_search_async(user_id, query):
+    _deliver(
+        user_id,
+        TextSendMessage(text=build_memo_search_text(query))
+    )
+
+
 # ======================
 # 店舗選択後の本処理（AI解析 → Flex生成 → push_message）
 # ======================
 def process_store_selection_async(user_id, place_id):
-    # 情報取得 & AI解析（1回のAPIコール）
-    details = get_place_details(place_id)
-    result = analyze_store(details["name"], details.get("types", []), details.get("reviews", []))
+    # 先読み済みならその結果を使う（なければ 情報取得 & AI解析）
+    prefetched = get_prefetcher().take(user_id, place_id) or {}
+    details = prefetched.get("details") or get_place_details(place_id)
+    result = prefetched.get("analysis") or analyze_store(
+        details["name"], details.get("types", []), details.get("reviews", []), place_id=place_id
+    )
 
     # 状態保存
     user_state[user_id] = {
@@ -470,35 +656,59 @@ def process_store_selection_async(user_id, place_id):
     }
 
     # Flexを作る
-    flex = build_store_info_flex(details, summary, tags, store_type, recs, place_id)
+    flex = build_store_info_flex(
+        details, result["summary"], result["tags"], result["store_type"], result["recs"], place_id
+    )
 
     # pushで最終結果を送信
-    line_bot_api.push_message(
+    _deliver(
         user_id,
         FlexSendMessage(alt_text="店舗情報", contents=flex)
     )
 
 
 # ======================
-# コメントなし保存処理（Notion保存 → push_message）
+# 保存（outbox に登録 → 即返信。Notion への反映はバックグラウンド）
 # ======================
-def process_save_no_comment_async(user_id):
-    state = user_state.get(user_id)
-    if not state:
-        return
+def _enqueue_save(user_id, state, comment, done_text):
+    def notify_new_page(page_id):
+        get_line_bot_api().push_message(
+            user_id,
+            TextSendMessage(text=f"📒 Notion に反映したよ！\n{build_page_url(page_id)}")
+        )
+
+    def notify_failed(error):
+        get_line_bot_api().push_message(
+            user_id,
+            TextSendMessage(text=f"❌「{state['details'].get('name', '')}」を Notion に保存できなかったよ…もう一度保存してね")
+        )
 
-    page_id = upsert_store(
+    # page_id が分かっている店ならURLはすぐ返す。分からなければ反映後にURLを送る
+    page_id = enqueue_store(
         state["details"], state["summary"],
         state["tags"], state["store_type"],
-        state["recs"], ""
+        state["recs"], comment,
+        on_created=notify_new_page,
+        on_failed=notify_failed,
     )
 
-    notion_url = build_page_url(page_id)
+    if page_id:
+        text = f"{done_text}\n{build_page_url(page_id)}"
+    else:
+        text = f"{done_text}\n（Notion への反映後にURLを送るね）"
+
+    _deliver(user_id, TextSendMessage(text=text))
 
-    line_bot_api.push_message(
-        user_id,
-        TextSendMessage(text=f"✔ 保存が完了しました！\n{notion_url}")
-    )
+
+# ======================
+# コメントなし保存処理（Notion保存 → push_message）
+# ======================
+def process_save_no_comment_async(user_id):
+    state = user_state.get(user_id)
+    if not state:
+        return
+
+    _enqueue_save(user_id, state, "", "✔ 保存が完了しました！")
 
     # 状態クリア
     user_state.pop(user_id, None)
@@ -512,18 +722,7 @@ def process_save_with_comment_async(user_id, comment):
     if not state:
         return
 
-    page_id = upsert_store(
-        state["details"], state["summary"],
-        state["tags"], state["store_type"],
-        state["recs"], comment,
-    )
-
-    url = build_page_url(page_id)
-
-    line_bot_api.push_message(
-        user_id,
-        TextSendMessage(text=f"✔ コメント付きで保存したよ！\n{url}")
-    )
+    _enqueue_save(user_id, state, comment, "✔ コメント付きで保存したよ！")
 
     user_state.pop(user_id, None)
 
@@ -548,7 +747,7 @@ def handle_location(event):
     user_state[user_id]["_ts"] = time.time()
 
     # 次はシチュエーション入力
-    line_bot_api.reply_message(
+    get_line_bot_api().reply_message(
         event.reply_token,
         TextSendMessage(
             "📌 位置情報ありがとう！\n"
@@ -574,41 +773,60 @@ def process_recommend_search_async(user_id):
     nearby_candidates = search_nearby(lat, lng, radius=500)
 
     if not nearby_candidates:
-        line_bot_api.push_message(
+        _deliver(
             user_id,
             TextSendMessage("❌ 近くにおすすめできる店舗が見つからなかったよ…")
         )
         return
 
-    ranked = []
+    analyzed = []
 
-    # ② 各店の詳細と推論（上位5件のみ、1店あたり1回のAPIコール）
-    for c in nearby_candidates[:5]:
-        details = get_place_details(c["place_id"])
+    # ② Nearby Search の評価・距離で事前に絞り込み、
+    #    詳細（レビュー含む）取得と推論は上位5件のみ（1店あたり1回のAPIコール）
+    shortlist = recommend_preranker.rank(
+        CandidateSet.from_analyzed([(c, {}, []) for c in nearby_candidates]),
+        {"lat": lat, "lng": lng},
+        k=5,
+    )
 
-        result = analyze_store(details["name"], details.get("types", []), details.get("reviews", []))
-        summary, tags, store_type, recs = result["summary"], result["tags"], result["store_type"], result["recs"]
+    for item in shortlist:
+        details = get_place_details(item["item"][0]["place_id"])
 
-        # ③ Notion 保存（初回のみ）
-        upsert_store(details, summary, tags, store_type, recs, "")
+        result = analyze_store(
+            details["name"], details.get("types", []), details.get("reviews", []), place_id=details["place_id"]
+        )
+        summary, tags, store_type, recs = result["summary"], result["tags"], result["store_type"], result["recs"]
 
-        # ④ スコア計算
-        score = calc_recommend_score(details, store_type, tags, lat, lng, situation)
+        # ③ Notion 保存（outbox 経由。応答は待たない）
+        #    AI 解析が縮退している間は、既存ページの要約を上書きしないよう保存しない
+        if result.get("source") != "degraded":
+            enqueue_store(details, summary, tags, store_type, recs, "")
 
-        ranked.append((score, details, summary, tags, store_type, recs))
+        analyzed.append((details, store_type, tags, summary, recs))
 
-    # スコア順に並べる
-    ranked.sort(reverse=True, key=lambda x: x[0])
+    # ④ スコア計算（評価・シチュエーション・距離・個人評価・タイプ一致）→ 上位3件
+    #    シチュエーションは保存時に作った埋め込みとの類似度で判定
+    #    いま営業している店を優先し、1件もなければ営業時間を問わずに選び直す
+    cands = CandidateSet.from_analyzed(analyzed)
+    context = {
+        "lat": lat, "lng": lng, "situation": situation,
+        "situation_similarity": store_similarity(situation, cands.place_ids),
+    }
+    ranked = (
+        recommend_ranker.rank(cands, dict(context, open_at=datetime.now(JST)), k=3)
+        or recommend_ranker.rank(cands, context, k=3)
+    )
 
     # ⑤ 上位3件を Flex Message で返す
     bubbles = []
-    for _, details, summary, tags, store_type, recs in ranked[:3]:
+    for item in ranked:
+        details, store_type, tags, summary, recs = item["item"]
         bubble = build_store_info_flex(
             details, summary, tags, store_type, recs, details["place_id"]
         )
         bubbles.append(bubble)
 
-    line_bot_api.push_message(
+    _deliver(
         user_id,
         FlexSendMessage(
             alt_text="おすすめ店舗",
@@ -620,87 +838,6 @@ def process_recommend_search_async(user_id):
     user_state.pop(user_id, None)
 
 
-# ======================
-# スコア計算関数
-# ======================
-def calc_recommend_score(details, store_type, tags, user_lat, user_lng, situation):
-    """
-    details: get_place_details() の返却値
-    store_type: infer_store_type() の返却値 { "type": "cafe", "subtype": "date" ... }
-    tags: classify_tags() の返却値（リスト）
-    user_lat, user_lng: ユーザー現在地
-    situation: "デート" / "一人" / "静か" / "友達" / "作業" など
-    """
-
-    # ===============
-    # ① Google評価 (0〜100)
-    # ===============
-    rating = details.get("rating", 0)  # 0〜5
-    google_score = rating * 20         # 0〜100
-
-    # ===============
-    # ② 距離スコア (0〜100)
-    # ===============
-    lat = details["geometry"]["location"]["lat"]
-    lng = details["geometry"]["location"]["lng"]
-
-    # calc_distance は km を返すので ×1000 でメートルに変換（utils.py の重複実装を排除）
-    d = calc_distance(user_lat, user_lng, lat, lng) * 1000
-
-    if d <= 100:
-        distance_score = 100
-    elif d <= 300:
-        distance_score = 80
-    elif d <= 600:
-        distance_score = 60
-    elif d <= 1000:
-        distance_score = 40
-    else:
-        distance_score = max(15, 10000 / d)
-
-    # ===============
-    # ③ シチュエーション適性スコア (0〜100)
-    # ===============
-    subtype = store_type.get("subtype", "")
-
-    situation_map = {
-        "デート": ["date", "romantic", "couple"],
-        "静か": ["quiet", "study", "relax"],
-        "作業": ["work", "study", "focus"],
-        "一人": ["solo", "casual", "quiet"],
-        "友達": ["friends", "group", "fun"]
-    }
-
-    if subtype in situation_map.get(situation, []):
-        situation_score = 100
-    else:
-        situation_score = 50 if situation in subtype else 30
-
-    # ===============
-    # ④ あなたの個人評価 (0〜100) → NotionDBの値があれば付与
-    # ===============
-    user_score_raw = details.get("user_rating", 0)
-    user_score = user_score_raw * 20  # 1〜5 → 20〜100
-
-    # ===============
-    # ⑤ 店タイプ一致スコア (0〜100)
-    # ===============
-    type_score = 100 if store_type.get("type") in tags else 50
-
-    # ===============
-    # ⑥ 最終スコア
-    # ===============
-    total_score = (
-        google_score * 0.40 +
-        situation_score * 0.30 +
-        distance_score * 0.15 +
-        user_score * 0.10 +
-        type_score * 0.05
-    )
-
-    return total_score
-
-
 # ======================
 # LINE Webhook エンドポイント
 # ======================
@@ -719,6 +856,40 @@ def callback():
     return "OK"
 
 
+# ======================
+# 写真プロキシ（Google Photo を縮小・キャッシュして配信）
+# ======================
+PHOTO_MAX_AGE = 60 * 60 * 24 * 365  # photo_reference・幅・形式ごとに内容は不変
+
+
+@app.route("/photo/<path:photo_reference>", methods=["GET"])
+def photo(photo_reference):
+    width = request.args.get("w", type=int) or 800
+    fmt = request.args.get("fmt", "jpeg")
+
+    if fmt not in PHOTO_FORMATS or width not in PHOTO_WIDTHS:
+        abort(400)
+
+    # 署名の鍵が無ければ配信しない（誰でも署名を作れてしまう）
+    if not photo_proxy_enabled():
+        abort(404)
+
+    # 自分で発行した URL 以外は受け付けない（API 呼び出しの踏み台にされないように）
+    if not verify_photo_request(photo_reference, width, fmt, request.args.get("sig")):
+        abort(403)
+
+    try:
+        path, etag = get_photo_cache().get(photo_reference, width, fmt)
+    except Exception as e:
+        print("Error in photo proxy:", e)
+        abort(502)
+
+    res = send_file(path, mimetype=PHOTO_FORMATS[fmt], etag=etag, max_age=PHOTO_MAX_AGE)
+    res.cache_control.public = True
+    res.cache_control.immutable = True
+    return res
+
+
 # ======================
 # Flask Run
 # ======================
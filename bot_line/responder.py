@@ -0,0 +1,137 @@
+# bot_line/responder.py
+#
+# reply token を使った高速応答。
+# 以前は必ず「少々お待ちください」を reply し、結果は push_message で送っていた（push は月間の通数上限を消費する）。
+# ここでは結果が期限（deadline）までに出れば reply token でそのまま返し、
+# 間に合わなかったときだけ「お待ちください」を reply → 結果を push する。
+# 期限は処理の種類ごとの最近の所要時間から決める（いつも遅い処理は待たずにすぐ案内を返す）。
+import contextvars
+import heapq
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# 結果を待つ最大時間（秒）。これより遅いことが多い処理は REPLY_DEADLINE_MIN だけ待つ
+REPLY_DEADLINE_MAX = float(os.getenv("REPLY_DEADLINE_MAX", 2.0))
+REPLY_DEADLINE_MIN = float(os.getenv("REPLY_DEADLINE_MIN", 0.3))
+REPLY_DEADLINE_QUANTILE = 0.8
+REPLY_EXPIRE_WORKERS = int(os.getenv("REPLY_EXPIRE_WORKERS", 4))   # 案内の reply を送るスレッド数
+
+# 実行中のジョブの Responder（ジョブ内の送信はこれを通す）
+current_responder = contextvars.ContextVar("current_responder", default=None)
+
+
+# -----------------------------------------------
+# 期限の予測
+# -----------------------------------------------
+class DeadlineEstimator:
+    """処理の種類ごとの所要時間（直近 window 件）から、結果を待つ時間を決める"""
+
+    def __init__(self, window: int = 50):
+        self._samples = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(kind, deque(maxlen=self._window)).append(seconds)
+
+    def deadline(self, kind: str) -> float:
+        with self._lock:
+            samples = sorted(self._samples.get(kind, ()))
+        if len(samples) < 5:
+            return REPLY_DEADLINE_MAX
+
+        expected = samples[int(len(samples) * REPLY_DEADLINE_QUANTILE)]
+        if expected > REPLY_DEADLINE_MAX:
+            return REPLY_DEADLINE_MIN
+        return max(REPLY_DEADLINE_MIN, min(REPLY_DEADLINE_MAX, expected * 1.1))
+
+
+# -----------------------------------------------
+# 期限切れの処理（1本のスレッドでまとめて待ち、呼び出しは別のスレッドに渡す）
+# -----------------------------------------------
+class _DeadlineTimer:
+    def __init__(self, workers: int = REPLY_EXPIRE_WORKERS):
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._seq = 0
+        # fn() は LINE API を呼ぶので、遅い呼び出しが他のユーザーの期限を遅らせないようタイマーでは実行しない
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="reply-expire")
+
+    def schedule(self, delay: float, fn):
+        with self._cond:
+            self._seq += 1
+            heapq.heappush(self._heap, (time.monotonic() + delay, self._seq, fn))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="reply-deadline", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    timeout = self._heap[0][0] - time.monotonic() if self._heap else None
+                    self._cond.wait(timeout)
+                _, _, fn = heapq.heappop(self._heap)
+            self._executor.submit(_call_quietly, fn)
+
+
+def _call_quietly(fn):
+    try:
+        fn()
+    except Exception as e:
+        print(f"[Responder] deadline callback failed: {e}")
+
+
+_timer = _DeadlineTimer()
+
+
+def schedule_deadline(delay: float, fn):
+    """delay 秒後に fn() を呼ぶ（待つスレッドは全体で1本、呼び出しは REPLY_EXPIRE_WORKERS 本で並行）"""
+    _timer.schedule(delay, fn)
+
+
+# -----------------------------------------------
+# Responder
+# -----------------------------------------------
+class Responder:
+    """
+    1つの reply token について、最初の送信を reply にするか push にするかを決める。
+    状態: pending → replied（結果を reply）/ placeholder（案内を reply、以降は push）
+    """
+
+    def __init__(self, api_getter, reply_token: str, user_id: str, placeholder, stats: dict):
+        self._api = api_getter
+        self.reply_token = reply_token
+        self.user_id = user_id
+        self._placeholder = placeholder
+        self._stats = stats
+        self._lock = threading.Lock()
+        self.state = "pending"
+
+    def send(self, messages):
+        """ジョブの結果を送る。期限前なら reply、過ぎていれば push"""
+        with self._lock:
+            use_reply = self.state == "pending"
+            if use_reply:
+                self.state = "replied"
+
+        if use_reply:
+            self._stats["reply"] += 1
+            self._api().reply_message(self.reply_token, messages)
+        else:
+            self._stats["push"] += 1
+            self._api().push_message(self.user_id, messages)
+
+    def expire(self):
+        """期限切れ：まだ何も返していなければ案内を reply する"""
+        with self._lock:
+            if self.state != "pending":
+                return
+            self.state = "placeholder"
+        self._api().reply_message(self.reply_token, self._placeholder)
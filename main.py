@@ -22,6 +22,35 @@ def run_line_bot():
 def main():
     print("=== Gourmet AI Integrator Starting ===")
 
+    # ----------------------------
+    # 前回送りきれなかった Notion 保存（outbox）の配送を再開
+    # ----------------------------
+    from modules.outbox import get_outbox
+    get_outbox().start()
+
+    # ----------------------------
+    # 保存済み店舗の評価・営業時間などを少しずつ更新（REFRESH_INTERVAL=0 で無効）
+    # ----------------------------
+    from modules.refresher import get_refresher, REFRESH_INTERVAL
+    if REFRESH_INTERVAL > 0 and os.getenv("GOOGLE_API_KEY") and os.getenv("NOTION_API_KEY"):
+        get_refresher().start()
+
+    # ----------------------------
+    # 埋め込み索引：保存時の埋め込み（upsert のリスナー）と Notion からの補完を起動時に始める
+    # ----------------------------
+    if os.getenv("NOTION_API_KEY"):
+        from modules.embeddings import get_embedding_index
+        get_embedding_index()
+
+    # ----------------------------
+    # 店舗スナップショット（ワーカー間で memory-map して共有）を定期的に書き出す
+    # 書き手は1プロセスだけにするため、SNAPSHOT_WRITER=1 を指定したプロセスでだけ起動する
+    # ----------------------------
+    from modules.snapshot import start_snapshot_exporter, SNAPSHOT_EXPORT_INTERVAL
+    if (os.getenv("SNAPSHOT_WRITER") == "1" and SNAPSHOT_EXPORT_INTERVAL > 0
+            and os.getenv("NOTION_API_KEY")):
+        start_snapshot_exporter()
+
     # ----------------------------
     # Discord Bot をサブスレッドで起動
     # ----------------------------
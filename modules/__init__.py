@@ -1,39 +1,132 @@
 # modules/__init__.py
+#
+# 公開関数はアクセスされた時点でサブモジュールを読み込む（遅延 import）。
+# openai / requests などの重い依存を、使わないツールや起動直後に
+# 読み込まないようにするため。
+import importlib
 
-# --- Google API ---
-from modules.google_api import (
-    search_candidates,
-    search_nearby,
-    get_place_details,
-    geocode_address,
-)
-
-# --- AI Processing ---
-from modules.ai_processing import (
-    summarize_reviews,
-    infer_store_type,
-    infer_recommendation,
-    classify_tags,
-    analyze_store,
-)
-
-# --- Notion 連携 ---
-from modules.notion_client import (
-    upsert_store,
-    build_page_url,
-    fetch_all_entries,
-)
-
-# --- Utils ---
-from modules.utils import (
-    build_photo_url,
-    TYPE_ICON,
-    SUBTYPE_ICON,
-    build_rating_stars,
-    convert_price_level,
-    calc_distance,
-    extract_number,
-    extract_text_without_numbers,
-    trim_text,
-    parse_location_query
-)
+_EXPORTS = {
+    # --- Google API ---
+    "search_candidates": "modules.google_api",
+    "search_candidates_page": "modules.google_api",
+    "CandidateCursor": "modules.google_api",
+    "search_nearby": "modules.google_api",
+    "get_place_details": "modules.google_api",
+    "geocode_address": "modules.google_api",
+    "invalidate_place_details": "modules.google_api",
+
+    # --- AI Processing ---
+    "summarize_reviews": "modules.ai_processing",
+    "infer_store_type": "modules.ai_processing",
+    "infer_recommendation": "modules.ai_processing",
+    "classify_tags": "modules.ai_processing",
+    "analyze_store": "modules.ai_processing",
+    "get_analysis_stats": "modules.ai_processing",
+    "classify_store_locally": "modules.local_classifier",
+
+    # --- Notion 連携 ---
+    "upsert_store": "modules.notion_client",
+    "build_page_url": "modules.notion_client",
+    "fetch_all_entries": "modules.notion_client",
+    "fetch_all_records": "modules.notion_client",
+    "iter_entries": "modules.notion_client",
+    "iter_records": "modules.notion_client",
+    "bbox_filter": "modules.notion_client",
+    "rating_filter": "modules.notion_client",
+    "tags_filter": "modules.notion_client",
+    "and_filters": "modules.notion_client",
+    "add_upsert_listener": "modules.notion_client",
+    "notify_page_updated": "modules.notion_client",
+    "NotionWriteError": "modules.notion_client",
+    "NotionReadError": "modules.notion_client",
+    "get_upsert_stats": "modules.notion_client",
+
+    # --- Notion Outbox ---
+    "enqueue_store": "modules.outbox",
+    "get_outbox": "modules.outbox",
+
+    # --- Store Record ---
+    "StoreRecord": "modules.store_record",
+
+    # --- Ranking ---
+    "RankingEngine": "modules.ranking",
+    "CandidateSet": "modules.ranking",
+    "register_feature": "modules.ranking",
+    "NEARBY_WEIGHTS": "modules.ranking",
+    "RECOMMEND_WEIGHTS": "modules.ranking",
+    "RECOMMEND_PRERANK_WEIGHTS": "modules.ranking",
+
+    # --- Tag Index ---
+    "TagIndex": "modules.tag_index",
+    "get_shared_tag_index": "modules.tag_index",
+
+    # --- Full-text Search ---
+    "search_saved_stores": "modules.fulltext",
+    "get_fulltext_index": "modules.fulltext",
+    "fulltext_index_ready": "modules.fulltext",
+
+    # --- Embeddings ---
+    "get_embedding_index": "modules.embeddings",
+    "search_similar_stores": "modules.embeddings",
+    "store_similarity": "modules.embeddings",
+
+    # --- Resilience ---
+    "is_available": "modules.resilience",
+    "breaker_states": "modules.resilience",
+    "UpstreamUnavailable": "modules.resilience",
+
+    # --- Admission ---
+    "try_admit": "modules.admission",
+    "get_openai_budget": "modules.admission",
+
+    # --- Prefetch ---
+    "get_prefetcher": "modules.prefetch",
+
+    # --- Bulk Import ---
+    "run_bulk_import": "modules.bulk_import",
+
+    # --- Refresh ---
+    "get_refresher": "modules.refresher",
+
+    # --- Store Snapshot ---
+    "get_store_snapshot": "modules.snapshot",
+    "export_snapshot": "modules.snapshot",
+    "watch_recent_upserts": "modules.snapshot",
+    "snapshot_candidates": "modules.snapshot",
+
+    # --- Review History ---
+    "get_review_store": "modules.review_store",
+
+    # --- Opening Hours ---
+    "hours_bitmap": "modules.opening_hours",
+    "is_open": "modules.opening_hours",
+    "JST": "modules.opening_hours",
+
+    # --- Utils ---
+    "build_photo_url": "modules.utils",
+    "TYPE_ICON": "modules.utils",
+    "SUBTYPE_ICON": "modules.utils",
+    "build_rating_stars": "modules.utils",
+    "convert_price_level": "modules.utils",
+    "calc_distance": "modules.utils",
+    "extract_number": "modules.utils",
+    "extract_text_without_numbers": "modules.utils",
+    "trim_text": "modules.utils",
+    "parse_location_query": "modules.utils",
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module_name = _EXPORTS.get(name)
+    if module_name is None:
+        raise AttributeError(f"module 'modules' has no attribute '{name}'")
+
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value  # 2回目以降は通常の属性参照になる
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,317 @@
+# modules/admission.py
+#
+# 受付制御（LINE / Discord 共通）。
+#   - ユーザーごと・全体のトークンバケット（一定時間あたりのリクエスト数）
+#   - ユーザーごと・全体の同時実行数
+#   - OpenAI の1日あたりトークン数・費用の予算（API レスポンスの usage から集計）
+# 上限を超えたリクエストは処理を始める前に、理由つきですぐ断る。
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from modules.opening_hours import JST
+from modules.resilience import UpstreamUnavailable
+
+# ---------------------------
+# 上限（環境変数で調整）
+# ---------------------------
+USER_RATE_PER_MIN = float(os.getenv("USER_RATE_PER_MIN", 10))     # 1ユーザーあたりのコスト/分
+USER_BURST = float(os.getenv("USER_BURST", 10))
+GLOBAL_RATE_PER_MIN = float(os.getenv("GLOBAL_RATE_PER_MIN", 120))
+GLOBAL_BURST = float(os.getenv("GLOBAL_BURST", 60))
+USER_MAX_CONCURRENT = int(os.getenv("USER_MAX_CONCURRENT", 2))
+GLOBAL_MAX_CONCURRENT = int(os.getenv("GLOBAL_MAX_CONCURRENT", 16))
+
+OPENAI_DAILY_TOKENS = int(os.getenv("OPENAI_DAILY_TOKENS", 2_000_000))
+OPENAI_DAILY_COST_USD = float(os.getenv("OPENAI_DAILY_COST_USD", 1.0))
+OPENAI_USAGE_PATH = os.getenv("OPENAI_USAGE_PATH", "data/openai_usage.json")
+
+# 処理の種類ごとのコスト（トークンバケットから引く量）と、OpenAI を使うかどうか
+JOB_KINDS = {
+    "search": {"cost": 1, "ai": False},
+    "select": {"cost": 2, "ai": True},
+    "save": {"cost": 1, "ai": False},
+    "memo": {"cost": 1, "ai": False},
+    "nearby": {"cost": 1, "ai": False},
+    "recommend": {"cost": 5, "ai": True},   # analyze_store を最大5回呼ぶ
+}
+
+# 100万トークンあたりの料金（USD）: (入力, 出力)
+OPENAI_PRICES = {
+    "gpt-4o-mini": (0.15, 0.60),
+    "text-embedding-3-small": (0.02, 0.0),
+}
+
+
+# -----------------------------------------------
+# トークンバケット
+# -----------------------------------------------
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, amount: float) -> float:
+        """取れたら 0、足りなければ溜まるまでの秒数を返す（取らない）"""
+        now = time.monotonic()
+        self._refill(now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def give_back(self, amount: float):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+# -----------------------------------------------
+# 1時間あたりの予算（直近1時間の使用数。先読み・定期更新などのバックグラウンド処理用）
+# -----------------------------------------------
+class HourlyBudget:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._used = deque()
+        self._lock = threading.Lock()
+
+    def try_spend(self) -> bool:
+        now = time.time()
+        with self._lock:
+            while self._used and now - self._used[0] > 3600:
+                self._used.popleft()
+            if len(self._used) >= self.limit:
+                return False
+            self._used.append(now)
+            return True
+
+
+# -----------------------------------------------
+# OpenAI の日次予算
+# -----------------------------------------------
+class BudgetExceeded(UpstreamUnavailable):
+    """今日の OpenAI 予算を使い切った（AI 解析は縮退応答になる）"""
+
+
+class OpenAIBudget:
+    """日本時間の日付ごとにトークン数・費用を集計する（再起動しても引き継ぐ）"""
+
+    def __init__(self, path: str | None = OPENAI_USAGE_PATH,
+                 daily_tokens: int = OPENAI_DAILY_TOKENS, daily_cost: float = OPENAI_DAILY_COST_USD):
+        self.path = path
+        self.daily_tokens = daily_tokens
+        self.daily_cost = daily_cost
+        self._lock = threading.Lock()
+        self._usage = {"date": "", "tokens": 0, "cost": 0.0, "calls": 0}
+        if path and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    self._usage.update(json.load(f))
+            except (OSError, ValueError) as e:
+                print(f"[Budget] failed to load {path}: {e}")
+
+    def _roll(self):
+        today = datetime.now(JST).strftime("%Y-%m-%d")
+        if self._usage["date"] != today:
+            self._usage = {"date": today, "tokens": 0, "cost": 0.0, "calls": 0}
+
+    def exhausted(self) -> bool:
+        with self._lock:
+            self._roll()
+            return self._usage["tokens"] >= self.daily_tokens or self._usage["cost"] >= self.daily_cost
+
+    def check(self):
+        if self.exhausted():
+            raise BudgetExceeded("daily OpenAI budget exhausted")
+
+    def record(self, model: str, usage):
+        """API レスポンスの usage（prompt_tokens / completion_tokens）を加算する"""
+        if usage is None:
+            return
+        prompt = getattr(usage, "prompt_tokens", 0) or 0
+        completion = getattr(usage, "completion_tokens", 0) or 0
+        price_in, price_out = OPENAI_PRICES.get(model, OPENAI_PRICES["gpt-4o-mini"])
+
+        with self._lock:
+            self._roll()
+            self._usage["tokens"] += prompt + completion
+            self._usage["cost"] += (prompt * price_in + completion * price_out) / 1_000_000
+            self._usage["calls"] += 1
+            self._save()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._roll()
+            return dict(self._usage, daily_tokens=self.daily_tokens, daily_cost=self.daily_cost)
+
+    def _save(self):
+        if not self.path:
+            return
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self._usage, f)
+        os.replace(tmp, self.path)
+
+
+# -----------------------------------------------
+# 受付制御
+# -----------------------------------------------
+class Rejected:
+    """断った理由（message はユーザーにそのまま見せる）"""
+
+    def __init__(self, reason: str, message: str, retry_after: float = 0.0):
+        self.reason = reason
+        self.message = message
+        self.retry_after = retry_after
+
+    def __repr__(self):
+        return f"Rejected({self.reason!r}, retry_after={self.retry_after:.1f})"
+
+
+class Ticket:
+    """受け付けた処理の枠。処理が終わったら release() する（with 文でも可）"""
+
+    def __init__(self, controller: "AdmissionController", user_key: str):
+        self._controller = controller
+        self._user_key = user_key
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self._user_key)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class AdmissionController:
+    def __init__(self, budget: OpenAIBudget | None = None):
+        self._lock = threading.Lock()
+        self._user_buckets = {}
+        self._global_bucket = TokenBucket(GLOBAL_RATE_PER_MIN / 60, GLOBAL_BURST)
+        self._running = {}
+        self._running_total = 0
+        self._budget = budget
+        self.stats = {"admitted": 0, "rejected": 0}
+
+    @property
+    def budget(self) -> OpenAIBudget:
+        if self._budget is None:
+            self._budget = get_openai_budget()
+        return self._budget
+
+    def try_admit(self, user_key: str, kind: str) -> tuple[Ticket | None, Rejected | None]:
+        """
+        処理を始めてよいか判定する。
+        受け付けたら (Ticket, None)、断ったら (None, Rejected) を返す。
+        """
+        spec = JOB_KINDS[kind]
+        rejected = self._check(user_key, spec)
+        with self._lock:
+            self.stats["rejected" if rejected else "admitted"] += 1
+        if rejected:
+            print(f"[Admission] reject {user_key} {kind}: {rejected}")
+            return None, rejected
+        return Ticket(self, user_key), None
+
+    def _check(self, user_key: str, spec: dict) -> Rejected | None:
+        if spec["ai"] and self.budget.exhausted():
+            return Rejected(
+                "budget",
+                "🙏 今日はAI解析の上限に達したよ。明日またお試しください！",
+            )
+
+        cost = spec["cost"]
+        with self._lock:
+            if self._running.get(user_key, 0) >= USER_MAX_CONCURRENT:
+                return Rejected("user_concurrency", "⏳ 前のリクエストを処理中だよ。終わってからもう一度送ってね！")
+            if self._running_total >= GLOBAL_MAX_CONCURRENT:
+                return Rejected("global_concurrency", "🙏 いま混み合っているよ。少し待ってからもう一度試してね！", 5.0)
+
+            bucket = self._user_buckets.get(user_key)
+            if bucket is None:
+                self._prune_buckets()
+                bucket = self._user_buckets[user_key] = TokenBucket(USER_RATE_PER_MIN / 60, USER_BURST)
+
+            wait = bucket.try_take(cost)
+            if wait:
+                return Rejected(
+                    "user_rate",
+                    f"⏳ リクエストが多すぎるよ。{int(wait) + 1}秒ほど待ってからもう一度試してね！",
+                    wait,
+                )
+
+            wait = self._global_bucket.try_take(cost)
+            if wait:
+                bucket.give_back(cost)
+                return Rejected(
+                    "global_rate",
+                    f"🙏 いま混み合っているよ。{int(wait) + 1}秒ほど待ってからもう一度試してね！",
+                    wait,
+                )
+
+            self._running[user_key] = self._running.get(user_key, 0) + 1
+            self._running_total += 1
+            return None
+
+    def _prune_buckets(self):
+        """満タンに戻ったユーザーのバケットは持っていても意味がないので捨てる"""
+        if len(self._user_buckets) < 10_000:
+            return
+        now = time.monotonic()
+        for key, bucket in list(self._user_buckets.items()):
+            bucket._refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._user_buckets[key]
+
+    def _release(self, user_key: str):
+        with self._lock:
+            self._running_total -= 1
+            left = self._running.get(user_key, 1) - 1
+            if left:
+                self._running[user_key] = left
+            else:
+                self._running.pop(user_key, None)
+
+
+# -----------------------------------------------
+# 共有インスタンス
+# -----------------------------------------------
+_shared_budget = None
+_shared_admission = None
+_shared_lock = threading.Lock()
+
+
+def get_openai_budget() -> OpenAIBudget:
+    global _shared_budget
+
+    with _shared_lock:
+        if _shared_budget is None:
+            _shared_budget = OpenAIBudget()
+        return _shared_budget
+
+
+def get_admission() -> AdmissionController:
+    global _shared_admission
+
+    with _shared_lock:
+        if _shared_admission is None:
+            _shared_admission = AdmissionController()
+        return _shared_admission
+
+
+def try_admit(user_key: str, kind: str) -> tuple[Ticket | None, Rejected | None]:
+    return get_admission().try_admit(user_key, kind)
@@ -1,25 +1,63 @@
 # modules/ai_processing.py
 import os
 import json
-from openai import OpenAI
+import threading
+
+from modules.local_classifier import classify_store_locally, LOCAL_CLASSIFIER_THRESHOLD
+from modules.resilience import call, is_available, POLICIES, UpstreamUnavailable
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-client_ai = OpenAI(api_key=OPENAI_API_KEY)
+CHAT_MODEL = "gpt-4o-mini"
+
+# 口コミがなく要約を作らなかったときの印象テキスト
+NO_REVIEW_SUMMARY = "【まとめ】\n口コミがまだないため、要約はありません。"
+
+# OpenAI が使えないとき（ブレーカー open・再試行しても失敗）の印象テキスト
+DEGRADED_SUMMARY = "【まとめ】\nAI 解析が一時的に利用できないため、要約はありません。"
+
+_client_ai = None
+_client_lock = threading.Lock()
+
+
+# -----------------------------------------------
+# 共通：OpenAI クライアント（初回利用時に生成）
+# -----------------------------------------------
+def get_client():
+    """OpenAI クライアントを初回呼び出し時に生成して使い回す"""
+    global _client_ai
+
+    if _client_ai is None:
+        with _client_lock:
+            if _client_ai is None:
+                from openai import OpenAI
+                # タイムアウト・再試行は modules.resilience 側で管理する
+                _client_ai = OpenAI(
+                    api_key=OPENAI_API_KEY,
+                    timeout=POLICIES["openai"].timeout,
+                    max_retries=0,
+                )
+
+    return _client_ai
 
 
 # -----------------------------------------------
 # 共通：Chat Completion Wrapper（JSON強制返却）
 # -----------------------------------------------
 def _request_json(prompt: str):
-    """OpenAI API に JSON形式で返すよう強制して送信"""
-    res = client_ai.chat.completions.create(
-        model="gpt-4o-mini",
+    """OpenAI API に JSON形式で返すよう強制して送信（日次予算を超えていれば BudgetExceeded）"""
+    from modules.admission import get_openai_budget
+
+    budget = get_openai_budget()
+    budget.check()
+    res = call("openai", lambda: get_client().chat.completions.create(
+        model=CHAT_MODEL,
         response_format={"type": "json_object"},
         messages=[
             {"role": "system", "content": "必ず JSON のみ返してください。"},
             {"role": "user", "content": prompt}
         ]
-    )
+    ))
+    budget.record(CHAT_MODEL, getattr(res, "usage", None))
     content = res.choices[0].message.content
     return json.loads(content)
 
@@ -134,17 +172,203 @@ Google Types: {types}
     return data.get("tags", [])
 
 
+# -----------------------------------------------
+# 高速パスの利用状況（LLM 呼び出しをどれだけ省けたか）
+# -----------------------------------------------
+_analysis_stats = {
+    "total": 0, "llm_full": 0, "llm_summary_only": 0, "llm_incremental": 0,
+    "no_llm": 0, "reused": 0, "degraded": 0,
+}
+_stats_lock = threading.Lock()
+
+
+def _count(kind: str):
+    with _stats_lock:
+        _analysis_stats["total"] += 1
+        _analysis_stats[kind] += 1
+
+
+def get_analysis_stats() -> dict:
+    """
+    analyze_store の内訳と、LLM 呼び出し・分類を省略できた割合を返す。
+    llm_calls_avoided: LLM を一度も呼ばなかった割合（前回の結果の再利用を含む）
+    classification_avoided: 店タイプ・タグをローカル分類で済ませた割合
+    """
+    with _stats_lock:
+        stats = dict(_analysis_stats)
+
+    total = stats["total"] or 1
+    stats["llm_calls_avoided"] = (stats["no_llm"] + stats["reused"]) / total
+    stats["classification_avoided"] = (stats["no_llm"] + stats["llm_summary_only"]) / total
+    return stats
+
+
+def _log_analysis(name: str, path: str, confidence: float):
+    s = get_analysis_stats()
+    print(
+        f"[AI] analyze_store {name}: {path} (local confidence={confidence:.2f}) / "
+        f"LLM calls avoided {s['no_llm'] + s['reused']}/{s['total']} ({s['llm_calls_avoided']:.0%}), "
+        f"classification avoided {s['classification_avoided']:.0%}"
+    )
+
+
+def _format_summary(data: dict) -> str:
+    summary = "【良い点】\n"
+    summary += "\n".join([f"・{p}" for p in data.get("positive", [])])
+    summary += "\n\n【気になる点】\n"
+    summary += "\n".join([f"・{n}" for n in data.get("negative", [])])
+    summary += "\n\n【まとめ】\n" + data.get("conclusion", "")
+    return summary
+
+
+# -----------------------------------------------
+# AI：口コミ要約 + おすすめのみ（分類はローカルで確定済みのとき）
+# -----------------------------------------------
+def _summarize_with_recommendations(name: str, types: list[str], joined: str) -> dict:
+    prompt = f"""
+以下の店情報を元に、口コミの要約とおすすめメニューを JSON で生成してください。
+
+店名: {name}
+Google Types: {types}
+口コミ:
+{joined}
+
+出力(JSON):
+{{
+  "positive": ["良い点1", "良い点2"],
+  "negative": ["気になる点1"],
+  "conclusion": "一言まとめ",
+  "recommendations": ["メニュー1", "メニュー2", "メニュー3"]
+}}
+"""
+    return _request_json(prompt)
+
+
+# -----------------------------------------------
+# AI：前回の解析結果を新しい口コミで更新（差分解析）
+# -----------------------------------------------
+def _update_with_new_reviews(name: str, types: list[str], previous: dict, joined: str) -> dict:
+    prompt = f"""
+以下は店の前回の分析結果と、その後に追加された口コミです。
+前回の内容を土台に、新しい口コミで変わった点・増えた点だけを反映して、同じ形式の JSON を返してください。
+新しい口コミで触れられていない項目は前回のまま残してください。
+
+店名: {name}
+Google Types: {types}
+前回の分析(JSON):
+{json.dumps(previous, ensure_ascii=False)}
+
+新しい口コミ:
+{joined}
+"""
+    return _request_json(prompt)
+
+
+def _result_from_data(data: dict, local: dict, confident: bool, source: str) -> dict:
+    """LLM の JSON から analyze_store の返却値を作る（分類はローカルで確定済みならそちらを使う）"""
+    if confident or "store_type" not in data:
+        store_type, tags = local["store_type"], local["tags"]
+    else:
+        store_type = {"type": data.get("store_type", ""), "subtype": data.get("sub_type", "")}
+        tags = data.get("tags", [])
+    return {
+        "summary": _format_summary(data),
+        "store_type": store_type,
+        "recs": data.get("recommendations", []),
+        "tags": tags,
+        "source": source,
+    }
+
+
 # -----------------------------------------------
 # AI：一括分析（4項目を1回のAPIコールで取得）
 # -----------------------------------------------
-def analyze_store(name: str, types: list[str], reviews: list) -> dict:
+def analyze_store(name: str, types: list[str], reviews: list, place_id: str | None = None) -> dict:
     """
-    口コミ・タイプ・店名から、サマリー・タグ・店タイプ・おすすめを1回のAPIコールで生成。
+    口コミ・タイプ・店名から、サマリー・タグ・店タイプ・おすすめを生成する。
     返却値: { "summary": str, "store_type": {"type": ..., "subtype": ...}, "recs": [...], "tags": [...] }
+
+    まずローカル分類（modules.local_classifier）を行い、
+      - 信頼度が閾値以上かつ口コミなし → LLM を呼ばない
+      - 信頼度が閾値以上 → 要約とおすすめだけを LLM で生成
+      - それ以外 → 従来どおり全項目を1回の LLM 呼び出しで生成
+    place_id を渡すと口コミ履歴（modules.review_store）を使い、解析済みの店は
+      - 新しい口コミがない → 前回の結果をそのまま返す（LLM を呼ばない）
+      - 新しい口コミがある → 前回の結果と新しい口コミだけを渡して更新する
+    OpenAI が使えないときは前回の結果か、ローカル分類だけの縮退結果（source="degraded"）を返す。
     """
+    local = classify_store_locally(name, types, reviews)
+    confident = local["confidence"] >= LOCAL_CLASSIFIER_THRESHOLD
+
     texts = [r.get("text", "") for r in reviews if r.get("text")]
     joined = "\n".join(texts)
 
+    history = previous = None
+    if place_id:
+        from modules.review_store import get_review_store
+        history = get_review_store()
+        history.add_reviews(place_id, reviews)
+        previous = history.get_analysis(place_id)
+        # 未反映の口コミ（以前の解析が失敗した分も含む）を入力にする
+        pending = history.pending_reviews(place_id)
+        if previous is None and pending:
+            texts = [r["text"] for r in pending]
+            joined = "\n".join(texts)
+
+    if previous is not None:
+        if not pending:
+            _count("reused")
+            _log_analysis(name, "previous result (no new reviews)", local["confidence"])
+            return _result_from_data(previous, local, confident, "history")
+    elif confident and not texts:
+        _count("no_llm")
+        _log_analysis(name, "local only", local["confidence"])
+        return {
+            "summary": NO_REVIEW_SUMMARY,
+            "store_type": local["store_type"],
+            "recs": [],
+            "tags": local["tags"],
+            "source": "local",
+        }
+
+    try:
+        if not is_available("openai"):
+            raise UpstreamUnavailable("openai circuit open")
+        if previous is not None:
+            data = _update_with_new_reviews(
+                name, types, previous, "\n".join(r["text"] for r in pending)
+            )
+            _count("llm_incremental")
+            _log_analysis(name, f"LLM update ({len(pending)} new reviews)", local["confidence"])
+            result = _result_from_data(data, local, confident, "llm+history")
+        else:
+            data, result = _analyze_with_llm(name, types, joined, local, confident)
+    except UpstreamUnavailable as e:
+        _count("degraded")
+        _log_analysis(name, f"degraded ({e})", local["confidence"])
+        if previous is not None:
+            return _result_from_data(previous, local, confident, "history")
+        return {
+            "summary": DEGRADED_SUMMARY,
+            "store_type": local["store_type"],
+            "recs": [],
+            "tags": local["tags"],
+            "source": "degraded",
+        }
+
+    if history is not None:
+        history.save_analysis(place_id, data, pending)
+    return result
+
+
+def _analyze_with_llm(name: str, types: list[str], joined: str, local: dict, confident: bool) -> tuple[dict, dict]:
+    """(LLM の JSON, analyze_store の返却値) を返す"""
+    if confident:
+        data = _summarize_with_recommendations(name, types, joined)
+        _count("llm_summary_only")
+        _log_analysis(name, "local + LLM summary", local["confidence"])
+        return data, _result_from_data(data, local, confident, "local+llm")
+
     prompt = f"""
 以下の店情報を元に、JSON形式で全ての分析を一度に生成してください。
 
@@ -166,16 +390,6 @@ Google Types: {types}
 """
 
     data = _request_json(prompt)
-
-    summary = "【良い点】\n"
-    summary += "\n".join([f"・{p}" for p in data.get("positive", [])])
-    summary += "\n\n【気になる点】\n"
-    summary += "\n".join([f"・{n}" for n in data.get("negative", [])])
-    summary += "\n\n【まとめ】\n" + data.get("conclusion", "")
-
-    return {
-        "summary": summary,
-        "store_type": {"type": data.get("store_type", ""), "subtype": data.get("sub_type", "")},
-        "recs": data.get("recommendations", []),
-        "tags": data.get("tags", []),
-    }
+    _count("llm_full")
+    _log_analysis(name, "LLM", local["confidence"])
+    return data, _result_from_data(data, local, confident, "llm")
@@ -0,0 +1,366 @@
+# modules/bulk_import.py
+#
+# 店舗リストの一括取り込み（/save を1件ずつ実行する代わり）。
+# CSV / JSON の店名・Google マップ URL・place_id を読み、
+#   resolve（search_candidates で place_id を決める）→ details → analyze → upsert
+# の段ごとに同時実行数を決めたパイプラインで処理する。
+#   - 進み具合は SQLite のチェックポイントに1件ごと・1段ごとに書くので、途中で落ちても続きから再開できる
+#   - Notion に既にある place_id、同じ取り込み内で重複した place_id は飛ばす
+#
+#   python -m modules.bulk_import stores.csv [--checkpoint data/import.db] [--retry-failed]
+import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs, unquote
+
+IMPORT_CHECKPOINT_PATH = os.getenv("IMPORT_CHECKPOINT_PATH", "data/import.db")
+
+# 段ごとの同時実行数（analyze は OpenAI、upsert は Notion のレート制限に合わせて小さめ）
+STAGE_WORKERS = {
+    "resolve": int(os.getenv("IMPORT_RESOLVE_WORKERS", 4)),
+    "details": int(os.getenv("IMPORT_DETAILS_WORKERS", 4)),
+    "analyze": int(os.getenv("IMPORT_ANALYZE_WORKERS", 2)),
+    "upsert": int(os.getenv("IMPORT_UPSERT_WORKERS", 2)),
+}
+STAGES = tuple(STAGE_WORKERS)
+
+# 終わった状態（これ以外は active）
+FINAL_STATUSES = ("done", "duplicate", "not_found", "failed")
+
+_HEADER_KEYS = {"place_id", "url", "query", "name"}
+_PLACE_ID_RE = re.compile(r"^(ChIJ|GhIJ|EiI|Ei[A-Za-z])[\w-]{10,}$")
+
+
+# -----------------------------------------------
+# 入力の解釈
+# -----------------------------------------------
+def parse_entry(text: str) -> tuple[str, str]:
+    """
+    1件分の入力を ("place_id", id) か ("query", 検索語) にする。
+    Google マップの URL は query_place_id / place_id: を優先し、なければ /place/<店名>/ を検索語にする。
+    """
+    text = text.strip()
+    if _PLACE_ID_RE.match(text):
+        return "place_id", text
+
+    if text.startswith(("http://", "https://")):
+        url = urlparse(text)
+        params = parse_qs(url.query)
+        if params.get("query_place_id"):
+            return "place_id", params["query_place_id"][0]
+        for key in ("q", "query"):
+            for value in params.get(key, []):
+                if value.startswith("place_id:"):
+                    return "place_id", value[len("place_id:"):]
+                if value:
+                    return "query", value
+
+        match = re.search(r"/maps/place/([^/@]+)", url.path)
+        if match:
+            return "query", unquote(match.group(1)).replace("+", " ")
+
+    return "query", text
+
+
+def load_entries(path: str) -> list[dict]:
+    """
+    CSV / JSON の店舗リストを [{"input": str, "comment": str}] にする。
+      - CSV：ヘッダーに query / name / url / place_id のどれか（なければ1列目）、comment は任意
+      - JSON：文字列の配列、または上と同じキーを持つオブジェクトの配列
+    """
+    with open(path, encoding="utf-8-sig") as f:
+        if path.endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = [r for r in csv.reader(f) if r]
+            header = [c.strip().lower() for c in rows[0]] if rows else []
+            if _HEADER_KEYS & set(header):
+                rows = [dict(zip(header, r)) for r in rows[1:]]
+            else:
+                rows = [r[0] for r in rows]
+
+    entries = []
+    for row in rows:
+        if isinstance(row, str):
+            text, comment = row, ""
+        else:
+            text = next(
+                (row[k] for k in ("place_id", "url", "query", "name") if row.get(k)),
+                next(iter(row.values()), ""),
+            )
+            comment = row.get("comment") or ""
+        if text and text.strip():
+            entries.append({"input": text.strip(), "comment": comment.strip()})
+    return entries
+
+
+# -----------------------------------------------
+# チェックポイント
+# -----------------------------------------------
+class ImportCheckpoint:
+    """1件ごとの進み具合（次に実行する段・途中結果）を保存する"""
+
+    def __init__(self, path: str = IMPORT_CHECKPOINT_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS items ("
+                "input TEXT PRIMARY KEY, seq INTEGER NOT NULL, comment TEXT NOT NULL DEFAULT '', "
+                "stage TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'active', "
+                "place_id TEXT, payload TEXT, error TEXT, updated_at REAL NOT NULL)"
+            )
+
+    def add(self, entries: list[dict]) -> int:
+        """未登録の入力だけ追加する（同じ入力は1件として扱う）。追加した件数を返す"""
+        now = time.time()
+        with self._lock, self._conn:
+            seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM items").fetchone()[0]
+            before = self._conn.total_changes
+            for entry in entries:
+                seq += 1
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO items (input, seq, comment, stage, updated_at) "
+                    "VALUES (?, ?, ?, 'resolve', ?)",
+                    (entry["input"], seq, entry.get("comment", ""), now),
+                )
+            return self._conn.total_changes - before
+
+    def retry_failed(self) -> int:
+        """failed を、失敗した段からやり直す状態に戻す"""
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "UPDATE items SET status = 'active', error = NULL WHERE status = 'failed'"
+            ).rowcount
+
+    def active(self) -> list[dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT input, comment, stage, place_id, payload FROM items "
+                "WHERE status = 'active' ORDER BY seq"
+            ).fetchall()
+        return [
+            {"input": r[0], "comment": r[1], "stage": r[2], "place_id": r[3],
+             "payload": json.loads(r[4]) if r[4] else {}}
+            for r in rows
+        ]
+
+    def claimed_place_ids(self) -> set:
+        """この取り込みで処理中・処理済みの place_id"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT place_id FROM items WHERE place_id IS NOT NULL AND status IN ('active', 'done')"
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def save(self, item: dict, status: str = "active", error: str | None = None):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE items SET stage = ?, status = ?, place_id = ?, payload = ?, error = ?, updated_at = ? "
+                "WHERE input = ?",
+                (item["stage"], status, item.get("place_id"),
+                 json.dumps(item["payload"], ensure_ascii=False) if item["payload"] else None,
+                 error, time.time(), item["input"]),
+            )
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT CASE WHEN status = 'active' THEN stage ELSE status END, COUNT(*) "
+                "FROM items GROUP BY 1"
+            ).fetchall()
+        return dict(rows)
+
+
+# -----------------------------------------------
+# パイプライン
+# -----------------------------------------------
+class BulkImporter:
+    def __init__(self, checkpoint: ImportCheckpoint, workers: dict | None = None,
+                 existing_place_ids: set | None = None, progress_interval: float = 5.0):
+        self.checkpoint = checkpoint
+        self.workers = dict(STAGE_WORKERS, **(workers or {}))
+        self._existing = existing_place_ids
+        self.progress_interval = progress_interval
+        self._claim_lock = threading.Lock()
+        self._claimed = set()
+        self._outstanding = 0
+        self._cond = threading.Condition()
+
+    # ---------------------------
+    # 各段
+    # ---------------------------
+    def _resolve(self, item):
+        kind, value = parse_entry(item["input"])
+        if kind == "place_id":
+            place_id = value
+        else:
+            from modules.google_api import search_candidates
+            candidates = search_candidates(value)
+            if not candidates:
+                return "not_found"
+            place_id = candidates[0]["place_id"]
+
+        # Notion に既にある店・この取り込みで先に出てきた店は飛ばす
+        with self._claim_lock:
+            if place_id in self._existing or place_id in self._claimed:
+                item["place_id"] = place_id
+                return "duplicate"
+            self._claimed.add(place_id)
+
+        item["place_id"] = place_id
+        return None
+
+    def _details(self, item):
+        from modules.google_api import get_place_details
+        details = get_place_details(item["place_id"])
+        if not details.get("name"):
+            raise RuntimeError("details not available")
+        item["payload"]["details"] = details
+        return None
+
+    def _analyze(self, item):
+        from modules.ai_processing import analyze_store
+        details = item["payload"]["details"]
+        result = analyze_store(
+            details["name"], details.get("types", []), details.get("reviews", []), place_id=details.get("place_id")
+        )
+        if result.get("source") == "degraded":
+            # 縮退結果は保存しない（--retry-failed でやり直す）
+            raise RuntimeError("analysis degraded (OpenAI unavailable or over budget)")
+
+        # 以降はレビュー・写真は不要なので、チェックポイントには upsert に使う項目だけ残す
+        from modules.outbox import slim_details
+        item["payload"] = {
+            "details": slim_details(details),
+            "analysis": {k: result[k] for k in ("summary", "tags", "store_type", "recs")},
+        }
+        return None
+
+    def _upsert(self, item):
+        # outbox は通さずに直接書く。結果（done / failed）をこの段でチェックポイントに残して
+        # --retry-failed で再開できるようにするためと、書き込みの同時実行数を IMPORT_UPSERT_WORKERS で
+        # 決めるため。重複は resolve 段で除き、同じ店への同時保存は upsert_store の place_id ロックで直列化される
+        from modules.notion_client import upsert_store
+        a = item["payload"]["analysis"]
+        upsert_store(item["payload"]["details"], a["summary"], a["tags"], a["store_type"], a["recs"], item["comment"])
+        item["payload"] = {}
+        return "done"
+
+    # ---------------------------
+    # 実行
+    # ---------------------------
+    def _step(self, item):
+        stage = item["stage"]
+        try:
+            final = getattr(self, f"_{stage}")(item)
+        except Exception as e:
+            print(f"[Import] {item['input']}: {stage} failed: {e}")
+            self.checkpoint.save(item, "failed", f"{stage}: {e}")
+            self._finish()
+            return
+
+        if final is None:
+            item["stage"] = STAGES[STAGES.index(stage) + 1]
+            self.checkpoint.save(item)
+            self._executors[item["stage"]].submit(self._step, item)
+        else:
+            self.checkpoint.save(item, final)
+            self._finish()
+
+    def _finish(self):
+        with self._cond:
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+    def _load_existing(self) -> set:
+        # 一部だけで判定すると保存済みの店を重複して作るので、取得に失敗したら NotionReadError で中断する
+        from modules.notion_client import iter_records
+        return {r.place_id for r in iter_records(properties=["place_id"]) if r.place_id}
+
+    def run(self, max_in_flight: int | None = None) -> dict:
+        """active の項目をすべて処理し、状態ごとの件数を返す"""
+        existing = self._existing if self._existing is not None else self._load_existing()
+        self._claimed = self.checkpoint.claimed_place_ids()
+        # 途中まで進んでいた項目の place_id は自分のものなので、既存扱いにしない
+        self._existing = set(existing) - self._claimed
+
+        items = self.checkpoint.active()
+        # 先の段の項目が多く溜まりすぎないよう、同時に流す件数を抑える
+        max_in_flight = max_in_flight or sum(self.workers.values()) * 2
+        self._executors = {
+            stage: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"import-{stage}")
+            for stage, n in self.workers.items()
+        }
+
+        started = time.monotonic()
+        last_report = started
+        try:
+            for item in items:
+                with self._cond:
+                    while self._outstanding >= max_in_flight:
+                        self._cond.wait(1.0)
+                    self._outstanding += 1
+                self._executors[item["stage"]].submit(self._step, item)
+
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    self.report(started)
+
+            with self._cond:
+                while self._outstanding:
+                    self._cond.wait(self.progress_interval)
+                    if self._outstanding:
+                        self.report(started)
+        finally:
+            for executor in self._executors.values():
+                executor.shutdown(wait=True)
+
+        self.report(started)
+        return self.checkpoint.counts()
+
+    def report(self, started: float):
+        counts = self.checkpoint.counts()
+        total = sum(counts.values())
+        finished = sum(counts.get(s, 0) for s in FINAL_STATUSES)
+        elapsed = time.monotonic() - started
+        parts = "  ".join(f"{k}={counts[k]}" for k in (*STAGES, *FINAL_STATUSES) if counts.get(k))
+        print(f"[Import] {finished}/{total} ({elapsed:.0f}s)  {parts}")
+
+
+def run_bulk_import(path: str, checkpoint_path: str = IMPORT_CHECKPOINT_PATH,
+                    workers: dict | None = None, retry_failed: bool = False) -> dict:
+    """店舗リストを取り込む（同じチェックポイントで再実行すると続きから）。状態ごとの件数を返す"""
+    checkpoint = ImportCheckpoint(checkpoint_path)
+    added = checkpoint.add(load_entries(path))
+    if retry_failed:
+        print(f"[Import] retry {checkpoint.retry_failed()} failed items")
+    print(f"[Import] {added} new entries from {path}")
+    return BulkImporter(checkpoint, workers).run()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="店舗リスト（CSV / JSON）を Notion に一括取り込みする")
+    ap.add_argument("path")
+    ap.add_argument("--checkpoint", default=IMPORT_CHECKPOINT_PATH)
+    ap.add_argument("--retry-failed", action="store_true", help="失敗した項目をやり直す")
+    for stage, n in STAGE_WORKERS.items():
+        ap.add_argument(f"--{stage}-workers", type=int, default=n)
+    args = ap.parse_args()
+
+    workers = {stage: getattr(args, f"{stage}_workers") for stage in STAGES}
+    counts = run_bulk_import(args.path, args.checkpoint, workers, args.retry_failed)
+    print(json.dumps(counts, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
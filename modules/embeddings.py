@@ -0,0 +1,421 @@
+# modules/embeddings.py
+#
+# 保存済み店舗の「印象・タグ・サブタイプ」を埋め込みベクトルにして保持し、
+# 自然文のクエリ（例：「夜遅くまで静かに作業できる店」）とのコサイン類似度で検索する。
+# ベクトルは正規化済み float32 の行列として .npy に保存し、memory-map で読み込む。
+# 保存のたびに行列全体を書き直さないよう、更新はメモリ上で行い EMBEDDING_FLUSH_DELAY 秒ごとにまとめて書き出す。
+# upsert_store からの更新はキューに積んで専用スレッドで埋め込む（保存側は埋め込み API を待たない）。
+import atexit
+import hashlib
+import json
+import os
+import queue
+import threading
+from abc import ABC, abstractmethod
+import numpy as np
+
+EMBEDDING_DIR = os.getenv("EMBEDDING_DIR", "data/embeddings")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", 256))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+EMBED_BATCH_SIZE = 256
+EMBEDDING_FLUSH_DELAY = float(os.getenv("EMBEDDING_FLUSH_DELAY", 30))   # 更新後にファイルへ書き出すまでの待ち（秒）
+
+
+# -----------------------------------------------
+# 埋め込みプロバイダ
+# -----------------------------------------------
+class EmbeddingProvider(ABC):
+    """テキスト列 → 正規化済みベクトル行列 (len(texts), dim)"""
+
+    name = "base"
+    dim = EMBEDDING_DIM
+
+    @abstractmethod
+    def embed(self, texts: list[str]) -> np.ndarray:
+        ...
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAI Embeddings API（dimensions 指定で次元を縮めて保存サイズを抑える）"""
+
+    name = "openai"
+
+    def __init__(self, model: str = EMBEDDING_MODEL, dim: int = EMBEDDING_DIM):
+        self.model = model
+        self.dim = dim
+        self.name = f"openai:{model}"
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        from modules.ai_processing import get_client
+        from modules.admission import get_openai_budget
+        from modules.resilience import call
+
+        budget = get_openai_budget()
+        budget.check()
+        res = call("openai", lambda: get_client().embeddings.create(
+            model=self.model, input=texts, dimensions=self.dim
+        ))
+        budget.record(self.model, getattr(res, "usage", None))
+        vecs = np.array([d.embedding for d in res.data], dtype=np.float32)
+        return _normalize(vecs)
+
+
+class HashingEmbeddingProvider(EmbeddingProvider):
+    """
+    API を使わない決定的なスタブ。
+    文字 2-gram をハッシュで次元に割り当てる（テスト・オフライン用）。
+    """
+
+    name = "hashing"
+
+    def __init__(self, dim: int = EMBEDDING_DIM):
+        self.dim = dim
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vecs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            text = (text or "").lower()
+            for i in range(max(len(text) - 1, 1)):
+                h = hashlib.blake2b(text[i:i + 2].encode("utf-8"), digest_size=8).digest()
+                idx = int.from_bytes(h[:4], "little") % self.dim
+                vecs[row, idx] += 1.0 if h[4] & 1 else -1.0
+        return _normalize(vecs)
+
+
+def get_embedding_provider() -> EmbeddingProvider:
+    """EMBEDDING_PROVIDER（openai / hashing）に応じたプロバイダを返す"""
+    name = os.getenv("EMBEDDING_PROVIDER") or ("openai" if os.getenv("OPENAI_API_KEY") else "hashing")
+    if name == "openai":
+        return OpenAIEmbeddingProvider()
+    if name == "hashing":
+        return HashingEmbeddingProvider()
+    raise ValueError(f"unknown EMBEDDING_PROVIDER: {name}")
+
+
+def _normalize(vecs: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs / np.where(norms == 0, 1, norms)
+
+
+# -----------------------------------------------
+# 埋め込み対象テキスト
+# -----------------------------------------------
+def build_store_text(summary: str, tags: list[str], subtype: str) -> str:
+    """店舗1件の埋め込み対象テキスト（サブタイプ・タグ・印象）"""
+    return f"{subtype}\n{' '.join(tags)}\n{summary}".strip()
+
+
+def _record_store_text(record) -> tuple[str, str]:
+    """StoreRecord から (place_id, 埋め込み対象テキスト) を取り出す"""
+    return record.place_id, build_store_text(record.summary, record.tags, record.subtype)
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+# -----------------------------------------------
+# ベクトル索引（place_id → 行）
+# -----------------------------------------------
+class EmbeddingIndex:
+    """
+    正規化済みベクトル行列と place_id の対応表。
+    保存は vectors.npy + meta.json（一時ファイル → os.replace で原子的に差し替え）。
+    行列は余裕を持たせたバッファに追記し（足りなくなったら倍に広げる）、書き出しは flush_delay 秒ごとにまとめる。
+    """
+
+    def __init__(self, provider: EmbeddingProvider, path: str | None = EMBEDDING_DIR,
+                 flush_delay: float = EMBEDDING_FLUSH_DELAY):
+        self.provider = provider
+        self.path = path
+        self.flush_delay = flush_delay
+        self._ids = []       # row -> place_id
+        self._hashes = []    # row -> 埋め込み元テキストのハッシュ
+        self._rows = {}      # place_id -> row
+        self._vectors = np.zeros((0, provider.dim), dtype=np.float32)
+        self._buffer = None  # 書き込み可能なバッファ（_vectors はその先頭 len 行）。読み込み直後は None
+        self._dirty = False
+        self._flush_timer = None
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self._ids)
+
+    # ---------------------------
+    # 永続化
+    # ---------------------------
+    def _load(self):
+        meta_path = os.path.join(self.path, "meta.json")
+        vec_path = os.path.join(self.path, "vectors.npy")
+        if not (os.path.exists(meta_path) and os.path.exists(vec_path)):
+            return
+
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+
+        # プロバイダや次元が変わったら作り直す
+        if meta.get("provider") != self.provider.name or meta.get("dim") != self.provider.dim:
+            return
+
+        self._vectors = np.load(vec_path, mmap_mode="r")
+        self._ids = meta["ids"]
+        self._hashes = meta["hashes"]
+        self._rows = {pid: i for i, pid in enumerate(self._ids)}
+
+    def flush(self):
+        """未保存の更新をファイルに書き出す"""
+        with self._write_lock:
+            self._flush_timer = None
+            if self._dirty:
+                self._save()
+                self._dirty = False
+
+    def _schedule_flush(self):
+        """_write_lock を持った状態で呼ぶ"""
+        self._dirty = True
+        if not self.path or self._flush_timer is not None:
+            return
+        if self.flush_delay <= 0:
+            self._save()
+            self._dirty = False
+            return
+        self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+
+    def _writable_rows(self, extra: int) -> np.ndarray:
+        """あと extra 行追記できるバッファを返す（_write_lock を持った状態で呼ぶ）"""
+        n = len(self._ids)
+        if self._buffer is None or len(self._buffer) < n + extra:
+            capacity = max(64, (n + extra) * 2)
+            buf = np.zeros((capacity, self.provider.dim), dtype=np.float32)
+            buf[:n] = self._vectors   # memory-map や古いバッファから一度だけコピー
+            self._buffer = buf
+        return self._buffer
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(self.path, exist_ok=True)
+
+        vec_tmp = os.path.join(self.path, "vectors.npy.tmp")
+        with open(vec_tmp, "wb") as f:
+            np.save(f, np.ascontiguousarray(self._vectors))
+
+        meta_tmp = os.path.join(self.path, "meta.json.tmp")
+        with open(meta_tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "provider": self.provider.name,
+                "dim": self.provider.dim,
+                "ids": self._ids,
+                "hashes": self._hashes,
+            }, f, ensure_ascii=False)
+
+        os.replace(vec_tmp, os.path.join(self.path, "vectors.npy"))
+        os.replace(meta_tmp, os.path.join(self.path, "meta.json"))
+
+    # ---------------------------
+    # 更新
+    # ---------------------------
+    def add_many(self, items: list[tuple[str, str]], overwrite_concurrent: bool = True) -> int:
+        """
+        (place_id, テキスト) の列を登録する。
+        テキストが前回と同じ店は埋め込みをスキップする。返却値は埋め込んだ件数。
+        overwrite_concurrent=False なら、埋め込んでいる間に別の書き込みが入った店はそちらを残す
+        （Notion から読んだ古いかもしれない内容で補完するとき）。
+        """
+        # 埋め込み API はロックの外で呼ぶ。書き込みは _write_lock で直列化し、検索側とは最後の差し替えだけ _lock で排他する
+        with self._write_lock:
+            todo = {}
+            for place_id, text in items:
+                if not place_id or not text:
+                    continue
+                h = _text_hash(text)
+                row = self._rows.get(place_id)
+                seen = self._hashes[row] if row is not None else None
+                if seen == h:
+                    continue
+                todo[place_id] = (text, h, seen)
+
+        if not todo:
+            return 0
+
+        texts = [t for t, _, _ in todo.values()]
+        vecs = np.vstack([
+            self.provider.embed(texts[i:i + EMBED_BATCH_SIZE])
+            for i in range(0, len(texts), EMBED_BATCH_SIZE)
+        ])
+
+        with self._write_lock:
+            fresh = {}
+            for (place_id, (_, h, seen)), vec in zip(todo.items(), vecs):
+                row = self._rows.get(place_id)
+                if not overwrite_concurrent and (self._hashes[row] if row is not None else None) != seen:
+                    continue
+                fresh[place_id] = (h, vec)
+            if not fresh:
+                return 0
+
+            # 追記は検索側が持っている行（先頭 len 行）の外に書くので、差し替えまでは見えない
+            new_count = sum(1 for place_id in fresh if place_id not in self._rows)
+            buf = self._writable_rows(new_count)
+            ids, hashes, rows = list(self._ids), list(self._hashes), dict(self._rows)
+            for place_id, (h, vec) in fresh.items():
+                row = rows.get(place_id)
+                if row is None:
+                    row = rows[place_id] = len(ids)
+                    ids.append(place_id)
+                    hashes.append(h)
+                else:
+                    hashes[row] = h
+                buf[row] = vec
+
+            with self._lock:
+                self._vectors, self._ids, self._hashes, self._rows = buf[:len(ids)], ids, hashes, rows
+
+            self._schedule_flush()
+            return len(fresh)
+
+    def add(self, place_id: str, summary: str, tags: list[str], subtype: str) -> bool:
+        """店舗1件を登録する（保存時に呼ぶ）"""
+        return self.add_many([(place_id, build_store_text(summary, tags, subtype))]) > 0
+
+    def add_record(self, record):
+        """StoreRecord を埋め込み待ちのキューに積む（upsert のリスナー。待たない）"""
+        self._queue.put(_record_store_text(record))
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._drain, name="embedding-worker", daemon=True)
+                    self._worker.start()
+
+    def _drain(self):
+        """キューの店をまとめて埋め込む（同じ店が続けて積まれたら最後の内容だけ）"""
+        while True:
+            batch = dict([self._queue.get()])
+            while len(batch) < EMBED_BATCH_SIZE:
+                try:
+                    place_id, text = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch[place_id] = text
+            try:
+                self.add_many(list(batch.items()))
+            except Exception as e:
+                print(f"[Embedding] embed on save failed ({len(batch)} stores): {e}")
+
+    # ---------------------------
+    # 検索
+    # ---------------------------
+    def embed_query(self, text: str) -> np.ndarray:
+        return self.provider.embed([text])[0]
+
+    def similarity(self, query: str, place_ids: list[str]) -> np.ndarray:
+        """
+        place_ids の各店舗とクエリのコサイン類似度。
+        未登録の店舗は NaN。
+        """
+        with self._lock:
+            vectors, row_map = self._vectors, self._rows
+
+        out = np.full(len(place_ids), np.nan)
+        rows = np.array([row_map.get(pid, -1) for pid in place_ids], dtype=np.int64)
+        known = rows >= 0
+        if not known.any():
+            return out
+
+        q = self.embed_query(query)
+        out[known] = np.asarray(vectors[rows[known]]) @ q
+        return out
+
+    def query(self, text: str, k: int = 5) -> list[tuple[str, float]]:
+        """クエリに近い店舗を上位 k 件 [(place_id, 類似度), ...] で返す"""
+        from modules.ranking import top_k
+
+        with self._lock:
+            vectors, ids = self._vectors, self._ids
+
+        if not ids:
+            return []
+
+        scores = np.asarray(vectors) @ self.embed_query(text)
+        return [(ids[i], float(scores[i])) for i in top_k(scores, k)]
+
+
+# -----------------------------------------------
+# 共有インデックス（Notion DB から補完 + upsert で同期）
+# -----------------------------------------------
+_shared_index = None
+_shared_lock = threading.Lock()
+
+
+_backfill_done = threading.Event()
+
+
+def _backfill(index: EmbeddingIndex):
+    """Notion の全件のうち、未登録・変更のあった店だけ埋め込む（バックグラウンド）"""
+    from modules.notion_client import fetch_all_records
+
+    try:
+        records = fetch_all_records(properties=["place_id", "印象", "Tags", "サブタイプ"])
+        # 補完中に保存された店は、保存時の埋め込みを残す
+        count = index.add_many([_record_store_text(r) for r in records], overwrite_concurrent=False)
+        index.flush()
+        print(f"[Embedding] backfill done ({count} embedded, {len(index)} total)")
+    except Exception as e:
+        print(f"[Embedding] backfill failed: {e}")
+    finally:
+        _backfill_done.set()
+
+
+def embedding_index_ready() -> bool:
+    """Notion からの補完が終わっているか（終わるまでは保存済みファイルの分だけで類似度を出す）"""
+    return _backfill_done.is_set()
+
+
+def get_embedding_index() -> EmbeddingIndex:
+    """
+    共有の埋め込み索引を返す（待たない）。
+    初回に保存済みファイルを読み込み、未登録・変更のあった店の埋め込みはバックグラウンドで補完する。
+    補完が終わるまで、未登録の店の類似度は NaN（類似度なしとして扱われる）。
+    以降は upsert_store のたびに該当店だけ（バックグラウンドで）埋め込む。
+    保存時の埋め込みを取りこぼさないよう、main.py が起動時に呼ぶ。
+    """
+    global _shared_index
+
+    with _shared_lock:
+        if _shared_index is None:
+            from modules.notion_client import add_upsert_listener
+
+            index = EmbeddingIndex(get_embedding_provider())
+            add_upsert_listener(index.add_record)
+            atexit.register(index.flush)
+            threading.Thread(target=_backfill, args=(index,), name="embedding-backfill", daemon=True).start()
+            _shared_index = index
+
+        return _shared_index
+
+
+def search_similar_stores(query: str, k: int = 5) -> list[tuple[str, float]]:
+    """自然文クエリに近い保存済み店舗を返す [(place_id, 類似度), ...]"""
+    return get_embedding_index().query(query, k)
+
+
+def store_similarity(query: str, place_ids: list[str]) -> np.ndarray | None:
+    """
+    query と各店舗の類似度（未登録は NaN）。
+    埋め込みに失敗した場合は None を返し、呼び出し側は従来の判定で続行する。
+    """
+    if not query or not place_ids:
+        return None
+    try:
+        return get_embedding_index().similarity(query, place_ids)
+    except Exception as e:
+        print(f"[Embedding Error] {e}")
+        return None
@@ -0,0 +1,329 @@
+# modules/fulltext.py
+#
+# 保存済み店舗の 印象 / 感想 / おすすめメニュー をローカルで全文検索する。
+# SQLite FTS5 に 2-gram 化したテキストを入れ、bm25 でランキングする。
+# （日本語は単語区切りがないため、文字 2-gram で部分一致検索できるようにする）
+# Notion で直接編集された分や、他のプロセス（refresher・bulk_import）の書き込みは
+# last_edited_time を使って FULLTEXT_RESYNC_INTERVAL ごとに差分で取り込む。
+#
+#   python -m modules.fulltext rebuild    # 作り直す（Notion で削除したページを消すときなど）
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from datetime import datetime, timedelta, timezone
+
+FULLTEXT_DB_PATH = os.getenv("FULLTEXT_DB_PATH", "data/fulltext.db")
+FULLTEXT_RESYNC_INTERVAL = int(os.getenv("FULLTEXT_RESYNC_INTERVAL", 600))   # 差分取り込みの間隔（秒）、0 で無効
+
+# last_edited_time は分単位に丸められるので、前回の同期時刻より少し前から取り直す
+_RESYNC_MARGIN = timedelta(minutes=2)
+
+# 検索対象の Notion プロパティ → カラム名
+FIELDS = {
+    "店名": "name",
+    "印象": "impression",
+    "感想": "comment",
+    "おすすめメニュー": "menu",
+}
+
+# カラム名 → StoreRecord の属性
+_RECORD_ATTRS = {
+    "name": "name",
+    "impression": "summary",
+    "comment": "comment",
+    "menu": "recommendations",
+}
+
+# bm25 の列ごとの重み（店名・感想・おすすめを印象より重く）
+BM25_WEIGHTS = (2.0, 1.0, 1.5, 1.5)
+
+_TOKEN_RUN = re.compile(r"\w+")
+
+
+# -----------------------------------------------
+# 2-gram 化
+# -----------------------------------------------
+def to_bigrams(text: str) -> list[str]:
+    """テキストを正規化し、連続する文字列ごとに文字 2-gram に分割する"""
+    grams = []
+    for run in _TOKEN_RUN.findall(unicodedata.normalize("NFKC", text or "").lower()):
+        if len(run) == 1:
+            grams.append(run)
+        else:
+            grams.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return grams
+
+
+def _build_match_query(query: str) -> str | None:
+    """検索語を FTS5 の MATCH 式に変換する（空白区切りの語は AND）"""
+    phrases = []
+    for word in query.split():
+        grams = to_bigrams(word)
+        if not grams:
+            continue
+        if len(grams) == 1 and len(grams[0]) == 1:
+            phrases.append(f'"{grams[0]}"*')  # 1文字は前方一致
+        else:
+            phrases.append('"' + " ".join(grams) + '"')
+    return " AND ".join(phrases) or None
+
+
+def _snippet(text: str, query: str, width: int = 40) -> str:
+    """最初に一致した語の前後を切り出す（一致しなければ先頭）"""
+    norm = unicodedata.normalize("NFKC", text).lower()
+    pos = -1
+    for word in query.split():
+        pos = norm.find(unicodedata.normalize("NFKC", word).lower())
+        if pos >= 0:
+            break
+
+    start = max(0, pos - width // 2) if pos >= 0 else 0
+    body = text[start:start + width].replace("\n", " ")
+    return ("…" if start > 0 else "") + body + ("…" if start + width < len(text) else "")
+
+
+# -----------------------------------------------
+# 全文検索インデックス
+# -----------------------------------------------
+class FullTextIndex:
+    """SQLite FTS5 による店舗テキストの全文検索"""
+
+    def __init__(self, path: str = FULLTEXT_DB_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        cols = ", ".join(FIELDS.values())
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS docs ("
+                "id INTEGER PRIMARY KEY, page_id TEXT UNIQUE NOT NULL, "
+                + ", ".join(f"{c} TEXT" for c in FIELDS.values()) + ")"
+            )
+            self._conn.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS docs_fts USING fts5({cols}, "
+                "tokenize='unicode61 remove_diacritics 0')"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    # ---------------------------
+    # 更新
+    # ---------------------------
+    def upsert(self, page_id: str, texts: dict[str, str]):
+        """店舗1件のテキストを登録／差し替える（texts はカラム名 → 本文）"""
+        with self._lock, self._conn:
+            self._write(page_id, texts)
+
+    def _write(self, page_id: str, texts: dict[str, str]):
+        # 呼び出し側で _lock とトランザクションを持つこと
+        values = [texts.get(c, "") or "" for c in FIELDS.values()]
+        grams = [" ".join(to_bigrams(v)) for v in values]
+        cols = ", ".join(FIELDS.values())
+        marks = ", ".join("?" for _ in FIELDS)
+
+        row = self._conn.execute("SELECT id FROM docs WHERE page_id = ?", (page_id,)).fetchone()
+        if row:
+            doc_id = row[0]
+            self._conn.execute(
+                f"UPDATE docs SET ({cols}) = ({marks}) WHERE id = ?", (*values, doc_id)
+            )
+            self._conn.execute("DELETE FROM docs_fts WHERE rowid = ?", (doc_id,))
+        else:
+            doc_id = self._conn.execute(
+                f"INSERT INTO docs (page_id, {cols}) VALUES (?, {marks})", (page_id, *values)
+            ).lastrowid
+
+        self._conn.execute(
+            f"INSERT INTO docs_fts (rowid, {cols}) VALUES (?, {marks})", (doc_id, *grams)
+        )
+
+    @staticmethod
+    def _texts(record) -> dict[str, str]:
+        return {col: getattr(record, attr) for col, attr in _RECORD_ATTRS.items()}
+
+    def upsert_record(self, record):
+        """StoreRecord から登録する"""
+        self.upsert(record.page_id, self._texts(record))
+
+    def _apply(self, records: list, started: datetime, replace: bool = False):
+        """取得し終えた records を1つのトランザクションで書き込み、synced_at を進める"""
+        with self._lock, self._conn:
+            if replace:
+                self._conn.execute("DELETE FROM docs")
+                self._conn.execute("DELETE FROM docs_fts")
+            for record in records:
+                self._write(record.page_id, self._texts(record))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('synced_at', ?)", (started.isoformat(),)
+            )
+
+    # ---------------------------
+    # Notion との同期
+    # ---------------------------
+    def _meta(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def rebuild(self) -> int:
+        """
+        Notion の全件から作り直す。件数を返す。
+        全件を取得し終えてから1つのトランザクションで差し替える（取得に失敗したら NotionReadError で、
+        今の内容も synced_at もそのまま）。
+        """
+        from modules.notion_client import fetch_all_records
+
+        started = datetime.now(timezone.utc)
+        records = fetch_all_records(properties=list(FIELDS))
+        self._apply(records, started, replace=True)
+        return len(records)
+
+    def resync(self) -> int:
+        """前回の同期以降に Notion で編集されたページを取り込む（未同期なら rebuild）。件数を返す"""
+        from modules.notion_client import iter_records
+
+        synced_at = self._meta("synced_at")
+        if synced_at is None:
+            return self.rebuild()
+
+        started = datetime.now(timezone.utc)
+        since = datetime.fromisoformat(synced_at) - _RESYNC_MARGIN
+        query_filter = {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since.isoformat()}}
+        # 途中で失敗したら（NotionReadError）何も書かず、次回も同じ synced_at から取り直す
+        records = list(iter_records(filter=query_filter, properties=list(FIELDS)))
+        self._apply(records, started)
+        return len(records)
+
+    # ---------------------------
+    # 検索
+    # ---------------------------
+    def search(self, query: str, limit: int = 5) -> list[dict]:
+        """
+        bm25 順に検索結果を返す。
+        返却値: [{"page_id", "name", "field", "snippet", "score"}, ...]
+        """
+        match = _build_match_query(query)
+        if not match:
+            return []
+
+        weights = ", ".join(str(w) for w in BM25_WEIGHTS)
+        cols = ", ".join(f"d.{c}" for c in FIELDS.values())
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT d.page_id, {cols}, bm25(docs_fts, {weights}) AS score "
+                "FROM docs_fts JOIN docs d ON d.id = docs_fts.rowid "
+                "WHERE docs_fts MATCH ? ORDER BY score LIMIT ?",
+                (match, limit),
+            ).fetchall()
+
+        results = []
+        for page_id, name, *texts, score in rows:
+            texts = dict(zip(list(FIELDS)[1:], texts))
+            norm_words = [unicodedata.normalize("NFKC", w).lower() for w in query.split()]
+
+            # 一致した項目を優先してスニペットを作る
+            field, body = next(
+                (
+                    (f, t) for f, t in texts.items()
+                    if t and any(w in unicodedata.normalize("NFKC", t).lower() for w in norm_words)
+                ),
+                next(((f, t) for f, t in texts.items() if t), ("店名", name)),
+            )
+
+            results.append({
+                "page_id": page_id,
+                "name": name,
+                "field": field,
+                "snippet": _snippet(body, query) if body else "",
+                "score": -score,
+            })
+
+        return results
+
+
+# -----------------------------------------------
+# 共有インデックス（Notion DB から構築 + upsert で同期）
+# -----------------------------------------------
+_shared_index = None
+_shared_lock = threading.Lock()
+_resync_state = {"last": 0.0, "running": False}
+
+
+def fulltext_index_ready() -> bool:
+    """共有インデックスが構築済みか（未構築なら初回検索で Notion 全件取得が走る）"""
+    return _shared_index is not None
+
+
+def _resync_in_background(index: FullTextIndex):
+    def run():
+        try:
+            count = index.resync()
+            if count:
+                print(f"[FullText] resynced {count} pages from Notion")
+        except Exception as e:
+            print(f"[FullText] resync failed: {e}")
+        finally:
+            with _shared_lock:
+                _resync_state["running"] = False
+
+    threading.Thread(target=run, name="fulltext-resync", daemon=True).start()
+
+
+def get_fulltext_index() -> FullTextIndex:
+    """
+    共有の全文検索インデックスを返す。
+    DB ファイルが空なら Notion の全件から構築し、以降は upsert_store で同期する。
+    他の経路の変更は FULLTEXT_RESYNC_INTERVAL ごとにバックグラウンドで差分を取り込む（検索は待たない）。
+    """
+    global _shared_index
+
+    with _shared_lock:
+        if _shared_index is None:
+            from modules.notion_client import add_upsert_listener, NotionReadError
+
+            index = FullTextIndex()
+            if len(index) == 0:
+                try:
+                    index.rebuild()
+                except NotionReadError as e:
+                    # synced_at がないままなので、次の差分取り込みで作り直す
+                    print(f"[FullText] rebuild failed: {e}")
+            _resync_state["last"] = time.time()
+
+            add_upsert_listener(index.upsert_record)
+            _shared_index = index
+
+        if (
+            FULLTEXT_RESYNC_INTERVAL > 0 and not _resync_state["running"]
+            and time.time() - _resync_state["last"] > FULLTEXT_RESYNC_INTERVAL
+        ):
+            _resync_state["running"] = True
+            _resync_state["last"] = time.time()
+            _resync_in_background(_shared_index)
+
+        return _shared_index
+
+
+def search_saved_stores(query: str, limit: int = 5) -> list[dict]:
+    """保存済み店舗を全文検索する（共有インデックスを使用）"""
+    return get_fulltext_index().search(query, limit)
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ("rebuild", "resync"):
+        print("usage: python -m modules.fulltext rebuild|resync")
+        sys.exit(1)
+    index = FullTextIndex()
+    count = index.rebuild() if sys.argv[1] == "rebuild" else index.resync()
+    print(f"{sys.argv[1]}: {count} pages")
@@ -1,32 +1,84 @@
 # modules/google_api.py
 import os
-import requests
+import threading
+import time
+from collections import OrderedDict
+
+from modules.resilience import request, UpstreamUnavailable
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 SEARCH_LANGUAGE = "ja"
 
+# ---------------------------
+# Details API のフィールド階層
+# ---------------------------
+# 呼び出し側は必要な階層だけを指定する（レスポンスサイズ・課金 SKU を抑えるため）
+DETAIL_TIERS = {
+    "basic": ("name", "place_id", "formatted_address", "geometry", "types", "url", "photos"),
+    "contact": ("opening_hours", "website"),
+    "atmosphere": ("rating", "price_level", "user_ratings_total"),
+    "reviews": ("reviews",),
+}
+ALL_TIERS = tuple(DETAIL_TIERS)
+
+# 階層ごとのキャッシュ有効期限（秒）
+DETAIL_TIER_TTL = {
+    "basic": 24 * 3600,
+    "contact": 6 * 3600,
+    "atmosphere": 3600,
+    "reviews": 6 * 3600,
+}
+DETAIL_CACHE_MAX = 2000
+
+# Text Search の次ページ取得（トークンが有効になるまでの待ち）
+PAGE_TOKEN_RETRIES = 3
+PAGE_TOKEN_DELAY = 1.0
+
+_detail_cache = OrderedDict()   # (place_id, tier) -> (取得時刻, {field: value})
+_detail_cache_lock = threading.Lock()
+
 
 # ---------------------------
 # Text Search（店舗候補検索）
 # ---------------------------
-def search_candidates(query: str) -> list:
-    """Google Places TextSearch API で店候補を検索"""
+def search_candidates_page(query: str, page_token: str | None = None) -> tuple[list, str | None]:
+    """
+    Text Search の1ページ（最大20件）と次ページのトークンを返す。
+    page_token を渡すとその続きを取得する（query は無視される）。
+    """
+    if page_token:
+        url = (
+            "https://maps.googleapis.com/maps/api/place/textsearch/json"
+            f"?pagetoken={page_token}&key={GOOGLE_API_KEY}"
+        )
+    else:
+        url = (
+            "https://maps.googleapis.com/maps/api/place/textsearch/json"
+            f"?query={query}&language={SEARCH_LANGUAGE}&key={GOOGLE_API_KEY}"
+        )
 
-    url = (
-        "https://maps.googleapis.com/maps/api/place/textsearch/json"
-        f"?query={query}&language={SEARCH_LANGUAGE}&key={GOOGLE_API_KEY}"
-    )
+    # next_page_token は発行直後だと INVALID_REQUEST になるので、少し待って取り直す
+    for attempt in range(PAGE_TOKEN_RETRIES + 1):
+        try:
+            res = request("google_places", "GET", url)
+        except UpstreamUnavailable as e:
+            print(f"[Google TextSearch Error] {e}")
+            return [], None
 
-    res = requests.get(url)
-    if res.status_code != 200:
-        print(f"[Google TextSearch Error] HTTP {res.status_code}")
-        return []
+        if res.status_code != 200:
+            print(f"[Google TextSearch Error] HTTP {res.status_code}")
+            return [], None
+
+        data = res.json()
+        status = data.get("status")
+        if page_token and status == "INVALID_REQUEST" and attempt < PAGE_TOKEN_RETRIES:
+            time.sleep(PAGE_TOKEN_DELAY)
+            continue
+        break
 
-    data = res.json()
-    status = data.get("status")
     if status not in ("OK", "ZERO_RESULTS"):
         print(f"[Google TextSearch Error] status={status}: {data.get('error_message', '')}")
-        return []
+        return [], None
 
     candidates = []
     for item in data.get("results", []):
@@ -36,7 +88,62 @@ def search_candidates(query: str) -> list:
             "address": item.get("formatted_address", "")
         })
 
-    return candidates
+    return candidates, data.get("next_page_token")
+
+
+def search_candidates(query: str) -> list:
+    """Google Places TextSearch API で店候補を検索（1ページ目のみ）"""
+    return search_candidates_page(query)[0]
+
+
+class CandidateCursor:
+    """
+    Text Search の結果を必要になった分だけ読み進めるカーソル（セッションに保存して使う）。
+    取得済みのページは保持しておき、前のページに戻っても API は呼ばない。
+    """
+
+    def __init__(self, query: str, fetch_page=None):
+        self.query = query
+        self.items = []
+        self._fetch_page = fetch_page or search_candidates_page
+        self._next_token = None
+        self._started = False
+        self._exhausted = False
+        self._seen = set()
+        self._lock = threading.Lock()
+        self.fetches = 0
+        self.touched_at = time.time()
+
+    def _fetch_next(self):
+        if self._started and not self._next_token:
+            self._exhausted = True
+            return
+
+        page, token = self._fetch_page(self.query, self._next_token)
+        self._started = True
+        self.fetches += 1
+        self._next_token = token
+        if not token:
+            self._exhausted = True
+
+        # ページをまたいだ重複は除く
+        for c in page:
+            if c.get("place_id") and c["place_id"] not in self._seen:
+                self._seen.add(c["place_id"])
+                self.items.append(c)
+
+    def page(self, index: int, size: int) -> list:
+        """index 番目（0 始まり）のページ。足りない分だけ次のページを取得する"""
+        end = (index + 1) * size
+        with self._lock:
+            self.touched_at = time.time()
+            while len(self.items) < end and not self._exhausted:
+                self._fetch_next()
+            return self.items[index * size:end]
+
+    def has_more(self, index: int, size: int) -> bool:
+        """index 番目のページより後ろに候補がある（かもしれない）か"""
+        return len(self.items) > (index + 1) * size or not self._exhausted
 
 
 # ---------------------------
@@ -51,7 +158,12 @@ def search_nearby(lat: float, lng: float, radius: int = 500) -> list:
         f"&language={SEARCH_LANGUAGE}&key={GOOGLE_API_KEY}"
     )
 
-    res = requests.get(url)
+    try:
+        res = request("google_places", "GET", url)
+    except UpstreamUnavailable as e:
+        print(f"[Google NearbySearch Error] {e}")
+        return []
+
     if res.status_code != 200:
         print(f"[Google NearbySearch Error] HTTP {res.status_code}")
         return []
@@ -62,12 +174,17 @@ def search_nearby(lat: float, lng: float, radius: int = 500) -> list:
         print(f"[Google NearbySearch Error] status={status}: {data.get('error_message', '')}")
         return []
 
+    # Nearby Search の結果には位置・評価も含まれるので、詳細取得前の絞り込みに使う
     candidates = []
     for item in data.get("results", []):
         candidates.append({
             "name": item.get("name"),
             "place_id": item.get("place_id"),
-            "address": item.get("vicinity", "")
+            "address": item.get("vicinity", ""),
+            "geometry": item.get("geometry", {}),
+            "rating": item.get("rating"),
+            "price_level": item.get("price_level"),
+            "types": item.get("types", []),
         })
 
     return candidates
@@ -84,7 +201,12 @@ def geocode_address(address: str) -> dict | None:
         f"?address={address}&language={SEARCH_LANGUAGE}&key={GOOGLE_API_KEY}"
     )
 
-    res = requests.get(url)
+    try:
+        res = request("google_geocode", "GET", url)
+    except UpstreamUnavailable as e:
+        print(f"[Google Geocode Error] {e}")
+        return None
+
     if res.status_code != 200:
         print(f"[Google Geocode Error] HTTP {res.status_code}")
         return None
@@ -105,19 +227,70 @@ def geocode_address(address: str) -> dict | None:
 # ---------------------------
 # Details API（詳細取得）
 # ---------------------------
-def get_place_details(place_id: str) -> dict:
-    """Google Places Details API で店舗の詳細情報を取得する"""
+def _cache_get(place_id: str, tier: str) -> dict | None:
+    with _detail_cache_lock:
+        hit = _detail_cache.get((place_id, tier))
+        if hit is None:
+            return None
+        fetched_at, fields = hit
+        if time.time() - fetched_at > DETAIL_TIER_TTL[tier]:
+            del _detail_cache[(place_id, tier)]
+            return None
+        _detail_cache.move_to_end((place_id, tier))
+        return fields
+
 
+def _cache_put(place_id: str, tier: str, fields: dict):
+    with _detail_cache_lock:
+        _detail_cache[(place_id, tier)] = (time.time(), fields)
+        _detail_cache.move_to_end((place_id, tier))
+        while len(_detail_cache) > DETAIL_CACHE_MAX:
+            _detail_cache.popitem(last=False)
+
+
+def invalidate_place_details(place_id: str, tiers=ALL_TIERS):
+    """指定した階層のキャッシュを破棄する（評価の再取得などに使う）"""
+    with _detail_cache_lock:
+        for tier in tiers:
+            _detail_cache.pop((place_id, tier), None)
+
+
+def get_place_details(place_id: str, tiers=ALL_TIERS) -> dict:
+    """
+    Google Places Details API で店舗の詳細情報を取得する。
+    tiers: 必要なフィールド階層（"basic" / "contact" / "atmosphere" / "reviews"）。
+    階層ごとにキャッシュし、足りない階層だけを1回のリクエストで取得する。
+    """
+    if isinstance(tiers, str):
+        tiers = (tiers,)
+
+    result = {}
+    missing = []
+    for tier in tiers:
+        cached = _cache_get(place_id, tier)
+        if cached is None:
+            missing.append(tier)
+        else:
+            result.update(cached)
+
+    if not missing:
+        return result
+
+    fields = ",".join(f for tier in missing for f in DETAIL_TIERS[tier])
     url = (
         "https://maps.googleapis.com/maps/api/place/details/json"
         f"?place_id={place_id}"
-        "&fields=name,place_id,formatted_address,opening_hours,"
-        "website,url,rating,reviews,types,price_level,geometry,photos"
+        f"&fields={fields}"
         f"&language={SEARCH_LANGUAGE}"
         f"&key={GOOGLE_API_KEY}"
     )
 
-    res = requests.get(url)
+    try:
+        res = request("google_places", "GET", url)
+    except UpstreamUnavailable as e:
+        print(f"[Google Details Error] {e}")
+        return {}
+
     if res.status_code != 200:
         print(f"[Google Details Error] HTTP {res.status_code}")
         return {}
@@ -128,4 +301,10 @@ def get_place_details(place_id: str) -> dict:
         print(f"[Google Details Error] status={status}: {data.get('error_message', '')}")
         return {}
 
-    return data.get("result", {})
+    fetched = data.get("result", {})
+    for tier in missing:
+        part = {f: fetched[f] for f in DETAIL_TIERS[tier] if f in fetched}
+        _cache_put(place_id, tier, part)
+        result.update(part)
+
+    return result
@@ -0,0 +1,163 @@
+# modules/local_classifier.py
+#
+# Google Types・店名・口コミのキーワードから 店タイプ / サブタイプ / タグ を
+# ルールと辞書だけで推定する（LLM を呼ばずに済む場合の高速パス）。
+# 店タイプは utils.TYPE_ICON、サブタイプは utils.SUBTYPE_ICON のキーと同じ語彙を使う。
+import os
+import re
+import unicodedata
+
+# この信頼度以上なら LLM による分類を省略する
+LOCAL_CLASSIFIER_THRESHOLD = float(os.getenv("LOCAL_CLASSIFIER_THRESHOLD", 0.75))
+
+# ---------------------------
+# 店名キーワード → 店タイプ（店名に含まれていればほぼ確定）
+# ---------------------------
+NAME_LEXICON = {
+    "ramen": ["ラーメン", "らーめん", "拉麺", "中華そば", "つけ麺", "麺屋", "らぁ麺"],
+    "sushi": ["寿司", "鮨", "すし", "鮓", "sushi"],
+    "yakiniku": ["焼肉", "焼き肉", "ホルモン", "yakiniku"],
+    "izakaya": ["居酒屋", "酒場", "炉端", "串焼", "焼鳥", "焼き鳥", "やきとり"],
+    "coffee": ["珈琲", "コーヒー", "coffee", "espresso", "ロースター"],
+    "cafe": ["カフェ", "喫茶", "cafe", "café"],
+    "bar": ["バー", "bar", "pub", "パブ", "ビアホール"],
+    "italian": ["イタリアン", "トラットリア", "リストランテ", "オステリア", "ピッツァ", "pizza", "パスタ"],
+    "french": ["フレンチ", "ブラッスリー", "french"],
+    "bistro": ["ビストロ", "bistro"],
+    "fastfood": ["バーガー", "burger", "マクドナルド", "ケンタッキー", "モスバーガー"],
+}
+
+# ---------------------------
+# Google Types → 店タイプ（汎用の restaurant / food は手がかりにならない）
+# ---------------------------
+GOOGLE_TYPE_MAP = {
+    "cafe": "cafe",
+    "bakery": "cafe",
+    "bar": "bar",
+    "night_club": "bar",
+    "meal_takeaway": "fastfood",
+}
+GENERIC_TYPES = {"restaurant", "food", "point_of_interest", "establishment", "meal_delivery"}
+
+# 店名から推定した店タイプと Google Types の店タイプが「一致」とみなす組み合わせ
+TYPE_AGREEMENT = {"coffee": {"cafe"}}
+
+# ---------------------------
+# 口コミキーワード → サブタイプ（SUBTYPE_ICON の語彙）
+# ---------------------------
+SUBTYPE_LEXICON = {
+    "スイーツ": ["スイーツ", "ケーキ", "パフェ", "デザート", "タルト", "プリン", "パンケーキ"],
+    "軽食": ["軽食", "サンド", "トースト", "ベーグル", "モーニング", "ランチセット"],
+    "デート": ["デート", "カップル", "記念日", "彼女", "彼氏"],
+    "おしゃれ": ["おしゃれ", "オシャレ", "お洒落", "雰囲気が良", "インスタ", "映え"],
+    "静か": ["静か", "落ち着", "ゆっくり", "作業", "読書", "一人で"],
+    "カジュアル": ["気軽", "カジュアル", "リーズナブル", "安い", "コスパ", "ボリューム"],
+    "居酒屋": ["飲み会", "居酒屋", "日本酒", "焼酎", "生ビール", "おつまみ"],
+}
+
+# 店タイプ → タグに入れる日本語ラベル
+TYPE_LABELS = {
+    "cafe": "カフェ", "coffee": "コーヒー", "bar": "バー", "ramen": "ラーメン",
+    "yakiniku": "焼肉", "sushi": "寿司", "restaurant": "レストラン", "french": "フレンチ",
+    "italian": "イタリアン", "izakaya": "居酒屋", "fastfood": "ファストフード", "bistro": "ビストロ",
+}
+
+
+def _norm(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def _name_pattern(word: str) -> re.Pattern:
+    """英字の語は単語境界で一致させる（barbecue の bar に一致させない）。それ以外は部分一致"""
+    w = _norm(word)
+    if re.fullmatch(r"[a-z0-9à-ÿ' ]+", w):
+        return re.compile(rf"(?<![a-z0-9à-ÿ]){re.escape(w)}(?![a-z0-9à-ÿ])")
+    return re.compile(re.escape(w))
+
+
+_NAME_PATTERNS = [
+    (_name_pattern(w), store_type) for store_type, words in NAME_LEXICON.items() for w in words
+]
+
+
+# -----------------------------------------------
+# 店タイプ推定
+# -----------------------------------------------
+def _name_type(name: str) -> str | None:
+    """
+    店名の辞書一致から店タイプを推定する。
+    長い語の一部になっている短い語の一致は捨て（バーガー の中の バー）、残りのうち最も長い一致を採る。
+    """
+    n = _norm(name)
+    hits = [(m.start(), m.end(), t) for pattern, t in _NAME_PATTERNS for m in pattern.finditer(n)]
+    kept = [
+        h for h in hits
+        if not any(o[0] <= h[0] and h[1] <= o[1] and o[1] - o[0] > h[1] - h[0] for o in hits)
+    ]
+    if not kept:
+        return None
+    return max(kept, key=lambda h: (h[1] - h[0], -h[0]))[2]
+
+
+def _infer_type(name: str, types: list[str]) -> tuple[str, float]:
+    """(店タイプ, 信頼度) を返す"""
+    google_type = next((GOOGLE_TYPE_MAP[t] for t in types if t in GOOGLE_TYPE_MAP), None)
+
+    name_type = _name_type(name)
+    if name_type:
+        if google_type and (google_type == name_type or google_type in TYPE_AGREEMENT.get(name_type, ())):
+            return name_type, 0.95
+        # 店名だけの一致は閾値未満にとどめ、分類は LLM で確かめる
+        return name_type, 0.7
+
+    if google_type:
+        return google_type, 0.85
+
+    if any(t not in GENERIC_TYPES for t in types):
+        return "restaurant", 0.5
+    return "restaurant", 0.3
+
+
+# -----------------------------------------------
+# サブタイプ・タグ推定
+# -----------------------------------------------
+def _keyword_hits(text: str) -> dict[str, int]:
+    """サブタイプごとの口コミ内キーワード出現数"""
+    t = _norm(text)
+    hits = {}
+    for subtype, words in SUBTYPE_LEXICON.items():
+        count = sum(t.count(_norm(w)) for w in words)
+        if count:
+            hits[subtype] = count
+    return hits
+
+
+def classify_store_locally(name: str, types: list[str], reviews: list) -> dict:
+    """
+    ルールと辞書で店を分類する。
+    返却値: { "store_type": {"type", "subtype"}, "tags": [...], "confidence": 0〜1 }
+    """
+    store_type, type_conf = _infer_type(name, types)
+
+    texts = [r.get("text", "") for r in reviews if r.get("text")]
+    hits = _keyword_hits(name + "\n" + "\n".join(texts))
+    ranked = sorted(hits.items(), key=lambda kv: -kv[1])
+
+    subtype = ranked[0][0] if ranked else ""
+    tags = [TYPE_LABELS.get(store_type, store_type)] + [s for s, _ in ranked[:3]]
+
+    # サブタイプの根拠が弱いほど信頼度を下げる（口コミがまだない新しい店は、根拠がなくても下げない）
+    if not texts:
+        confidence = type_conf
+    elif not ranked:
+        confidence = type_conf * 0.8
+    elif ranked[0][1] >= 2:
+        confidence = type_conf
+    else:
+        confidence = type_conf * 0.9
+
+    return {
+        "store_type": {"type": store_type, "subtype": subtype},
+        "tags": tags,
+        "confidence": round(confidence, 3),
+    }
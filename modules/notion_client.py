@@ -1,12 +1,79 @@
 # modules/notion_client.py
 import os
 import json
-import requests
+import math
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote
 from typing import List, Dict, Optional
 
+from modules.store_record import StoreRecord
+from modules.resilience import request, UpstreamUnavailable
+
 NOTION_API_KEY = os.getenv("NOTION_API_KEY")
 NOTION_DB_ID = os.getenv("MAIN_DATABASE_ID")
 NOTION_VERSION = "2022-06-28"
+PROPERTY_IDS_RETRY_INTERVAL = float(os.getenv("NOTION_PROPERTY_IDS_RETRY", 60))   # スキーマ取得に失敗した後、再取得しない時間（秒）
+
+# 営業時間の週ビットマップ（16進）を入れる rich_text プロパティ（DB にあるときだけ使う）
+OPENING_CODE_PROPERTY = "営業時間コード"
+
+# upsert 成功時に呼ばれるコールバック（ローカルの索引などを同期するため）
+_upsert_listeners = []
+
+# place_id → page_id（作成直後は DB query に出てこないことがあるため、自前でも覚えておく）
+_page_ids = {}
+
+# place_id ごとの保存を直列化するロック（place_id のハッシュで固定本数に割り当てる）
+PLACE_LOCK_STRIPES = 64
+_place_locks = [threading.Lock() for _ in range(PLACE_LOCK_STRIPES)]
+
+# page_id → {プロパティ名: 最後に書き込んだ値のハッシュ}（同じ内容の再書き込みを省くため。プロセス内のみ）
+# 最近書き込んだ FINGERPRINT_CACHE_SIZE ページ分だけ覚える（古いものは全項目を書き直すだけ）
+FINGERPRINT_CACHE_SIZE = int(os.getenv("NOTION_FINGERPRINT_CACHE_SIZE", 5000))
+_fingerprints = OrderedDict()
+_fingerprints_lock = threading.Lock()
+upsert_stats = {"created": 0, "full": 0, "partial": 0, "skipped": 0}
+_upsert_stats_lock = threading.Lock()
+
+
+class NotionWriteError(Exception):
+    """ページの作成・更新に失敗した"""
+
+
+class NotionReadError(Exception):
+    """DB の query に失敗した（途中までのページは返している。全件が前提の処理は結果を捨てること）"""
+
+
+# -----------------------------------------------
+# Hook：upsert 成功時の通知
+# -----------------------------------------------
+def add_upsert_listener(fn):
+    """upsert_store の成功後に fn(record) を呼ぶよう登録する（record は StoreRecord）"""
+    if fn not in _upsert_listeners:
+        _upsert_listeners.append(fn)
+
+
+def _notify_upsert(page_id: str, props: dict):
+    _notify_record(StoreRecord.from_page({"id": page_id, "properties": props}))
+
+
+def notify_page_updated(page: dict):
+    """
+    upsert_store 以外で更新したページ（PATCH のレスポンスなど、全プロパティを含むもの）を
+    upsert のリスナーに知らせる。一部のプロパティだけを渡すと、リスナー側で他の項目が空になる。
+    """
+    _notify_record(StoreRecord.from_page(page))
+
+
+def _notify_record(record: StoreRecord):
+    for fn in list(_upsert_listeners):
+        try:
+            fn(record)
+        except Exception as e:
+            print(f"[Notion] upsert listener failed: {e}")
 
 
 # -----------------------------------------------
@@ -31,8 +98,34 @@ def build_page_url(page_id: str) -> str:
 # -----------------------------------------------
 # Check：place_id から既存ページ検索
 # -----------------------------------------------
+def remember_page_id(place_id: str, page_id: str):
+    """place_id に対応する page_id を登録する（outbox の永続化した対応表から復元するときなど）"""
+    _page_ids[place_id] = page_id
+
+
+def known_page_id(place_id: str) -> Optional[str]:
+    """このプロセスで分かっている page_id（Notion には問い合わせない）"""
+    return _page_ids.get(place_id)
+
+
+def _place_lock(place_id: str) -> threading.Lock:
+    digest = hashlib.blake2b(place_id.encode("utf-8"), digest_size=4).digest()
+    return _place_locks[int.from_bytes(digest, "little") % PLACE_LOCK_STRIPES]
+
+
 def find_page_by_place_id(place_id: str) -> Optional[str]:
     """place_id が一致する Notion ページを返す（なければ None）"""
+    try:
+        return _lookup_page_id(place_id)
+    except NotionWriteError as e:
+        print(f"[Notion Error] find_page_by_place_id: {e}")
+        return None
+
+
+def _lookup_page_id(place_id: str) -> Optional[str]:
+    """find_page_by_place_id と同じだが、検索の失敗は例外にする（失敗を「なし」と誤って新規作成しないため）"""
+    if place_id in _page_ids:
+        return _page_ids[place_id]
 
     query = {
         "filter": {
@@ -42,45 +135,251 @@ def find_page_by_place_id(place_id: str) -> Optional[str]:
     }
 
     url = f"https://api.notion.com/v1/databases/{NOTION_DB_ID}/query"
-    res = requests.post(url, headers=_headers(), data=json.dumps(query))
+    try:
+        res = request("notion", "POST", url, idempotent=True, headers=_headers(), data=json.dumps(query))
+    except UpstreamUnavailable as e:
+        raise NotionWriteError(f"query by place_id: {e}") from e
 
     if res.status_code != 200:
-        print(f"[Notion Error] find_page_by_place_id: HTTP {res.status_code}: {res.text}")
-        return None
+        raise NotionWriteError(f"query by place_id: HTTP {res.status_code}: {res.text}")
 
     results = res.json().get("results", [])
     if not results:
         return None
 
+    _page_ids[place_id] = results[0]["id"]
     return results[0]["id"]
 
 
 # -----------------------------------------------
-# 全件取得（ページネーション対応）
+# DB スキーマ：プロパティ名 → プロパティID
 # -----------------------------------------------
-def fetch_all_entries() -> list:
-    """Notion DB の全店舗データをページネーションで全件取得する"""
+_property_ids = None
+_property_ids_failed_at = 0.0
+
+
+def _get_property_ids() -> dict:
+    """DB のプロパティ名 → ID の対応表（初回のみ取得。失敗したらしばらくは空の表を返す）"""
+    global _property_ids, _property_ids_failed_at
+
+    if _property_ids is None:
+        if time.monotonic() - _property_ids_failed_at < PROPERTY_IDS_RETRY_INTERVAL:
+            return {}
+
+        url = f"https://api.notion.com/v1/databases/{NOTION_DB_ID}"
+        try:
+            res = request("notion", "GET", url, headers=_headers())
+        except UpstreamUnavailable as e:
+            print(f"[Notion Error] retrieve database: {e}")
+            _property_ids_failed_at = time.monotonic()
+            return {}
+
+        if res.status_code != 200:
+            print(f"[Notion Error] retrieve database: HTTP {res.status_code}: {res.text}")
+            _property_ids_failed_at = time.monotonic()
+            return {}
+
+        # ID は URL エンコード済みで返るので、クエリパラメータ用に元に戻しておく
+        _property_ids = {
+            name: unquote(prop["id"]) for name, prop in res.json().get("properties", {}).items()
+        }
+
+    return _property_ids
+
+
+# -----------------------------------------------
+# クエリ用フィルタ
+# -----------------------------------------------
+def bbox_filter(lat: float, lng: float, radius_km: float) -> dict:
+    """中心 (lat, lng) から半径 radius_km を囲む緯度経度の矩形フィルタ"""
+    d_lat = radius_km / 111.32
+    d_lng = radius_km / (111.32 * max(math.cos(math.radians(lat)), 0.01))
+
+    return {"and": [
+        {"property": "lat", "number": {"greater_than_or_equal_to": lat - d_lat}},
+        {"property": "lat", "number": {"less_than_or_equal_to": lat + d_lat}},
+        {"property": "lng", "number": {"greater_than_or_equal_to": lng - d_lng}},
+        {"property": "lng", "number": {"less_than_or_equal_to": lng + d_lng}},
+    ]}
+
+
+def rating_filter(min_rating: float) -> dict:
+    """Google評価が min_rating 以上"""
+    return {"property": "評価", "number": {"greater_than_or_equal_to": min_rating}}
+
+
+def tags_filter(tags: list[str], match_all: bool = False) -> dict | None:
+    """Tags に指定タグを含む（match_all=True で全タグ、False でいずれか）"""
+    conds = [{"property": "Tags", "multi_select": {"contains": t}} for t in tags if t]
+    if not conds:
+        return None
+    if len(conds) == 1:
+        return conds[0]
+    return {"and": conds} if match_all else {"or": conds}
+
+
+def and_filters(*filters) -> dict | None:
+    """複数のフィルタを AND で結合する（None は無視、入れ子の and は平坦化）"""
+    conds = []
+    for f in filters:
+        if not f:
+            continue
+        conds.extend(f["and"] if list(f) == ["and"] else [f])
+
+    if not conds:
+        return None
+    return conds[0] if len(conds) == 1 else {"and": conds}
+
+
+# -----------------------------------------------
+# ストリーミング取得（フィルタ・取得プロパティ指定）
+# -----------------------------------------------
+def iter_entries(filter: dict | None = None, properties: list[str] | None = None,
+                 sorts: list | None = None, page_size: int = 100):
+    """
+    Notion DB のページを1件ずつ返すジェネレータ。
+    filter / sorts は Notion の database query にそのまま渡し、
+    properties を指定すると該当プロパティだけを取得する（filter_properties）。
+    途中で取得に失敗したら NotionReadError（それまでに返したページで打ち切らない）。
+    """
 
     url = f"https://api.notion.com/v1/databases/{NOTION_DB_ID}/query"
-    results = []
-    payload = {}
+    params = None
+    if properties:
+        ids = _get_property_ids()
+        params = [("filter_properties", ids[name]) for name in properties if name in ids]
+
+    payload = {"page_size": page_size}
+    if filter:
+        payload["filter"] = filter
+    if sorts:
+        payload["sorts"] = sorts
 
     while True:
-        res = requests.post(url, headers=_headers(), data=json.dumps(payload))
+        # database query は読み取りなので POST でも再試行してよい
+        try:
+            res = request(
+                "notion", "POST", url, idempotent=True,
+                headers=_headers(), params=params, data=json.dumps(payload),
+            )
+        except UpstreamUnavailable as e:
+            raise NotionReadError(f"query database: {e}") from e
 
         if res.status_code != 200:
-            print(f"[Notion Error] fetch_all_entries: HTTP {res.status_code}: {res.text}")
-            break
+            raise NotionReadError(f"query database: HTTP {res.status_code}: {res.text}")
 
         data = res.json()
-        results.extend(data.get("results", []))
+        yield from data.get("results", [])
 
         if not data.get("has_more"):
-            break
+            return
+
+        payload["start_cursor"] = data.get("next_cursor")
 
-        payload = {"start_cursor": data.get("next_cursor")}
 
-    return results
+def iter_records(filter: dict | None = None, properties: list[str] | None = None,
+                 sorts: list | None = None):
+    """iter_entries の StoreRecord 版（生の JSON はページ単位で捨てる）"""
+    for page in iter_entries(filter=filter, properties=properties, sorts=sorts):
+        yield StoreRecord.from_page(page)
+
+
+# -----------------------------------------------
+# 全件取得（ページネーション対応）
+# -----------------------------------------------
+def fetch_all_entries() -> list:
+    """Notion DB の全店舗データをページネーションで全件取得する（失敗したら NotionReadError）"""
+    return list(iter_entries())
+
+
+# -----------------------------------------------
+# 全件取得（StoreRecord に変換）
+# -----------------------------------------------
+def fetch_all_records(filter: dict | None = None, properties: list[str] | None = None) -> list[StoreRecord]:
+    """Notion DB の店舗を StoreRecord の列で返す（filter / properties・失敗時の例外は iter_entries と同じ）"""
+    return list(iter_records(filter=filter, properties=properties))
+
+
+# -----------------------------------------------
+# Google 由来で変わりうる項目（評価・料金・営業時間・公式サイト）
+# -----------------------------------------------
+def hours_text(details: dict) -> str:
+    return "\n".join(details.get("opening_hours", {}).get("weekday_text", []))
+
+
+def google_detail_props(details: dict) -> dict:
+    """
+    Details の評価・料金・営業時間・公式サイトを Notion properties にする。
+    DB に「営業時間コード」プロパティがあれば、営業時間の週ビットマップ（modules.opening_hours）も保存する。
+    """
+    props = {
+        "評価": {"number": details.get("rating")},
+        "料金": {"number": details.get("price_level")},
+        "営業時間": {"rich_text": [{"text": {"content": hours_text(details)}}]},
+        "公式サイト": {"url": details.get("website")},
+    }
+
+    if OPENING_CODE_PROPERTY in _get_property_ids():
+        from modules.opening_hours import hours_bitmap, bitmap_to_hex
+        code = bitmap_to_hex(hours_bitmap(details))
+        props[OPENING_CODE_PROPERTY] = {"rich_text": [{"text": {"content": code}}]}
+
+    return props
+
+
+def patch_page_properties(page_id: str, props: dict) -> dict:
+    """既存ページの指定したプロパティだけを更新し、更新後のページ（全プロパティ）を返す。失敗時は NotionWriteError"""
+    url = f"https://api.notion.com/v1/pages/{page_id}"
+    try:
+        res = request("notion", "PATCH", url, headers=_headers(), data=json.dumps({"properties": props}))
+    except UpstreamUnavailable as e:
+        raise NotionWriteError(f"update page: {e}") from e
+
+    if res.status_code != 200:
+        raise NotionWriteError(f"update page: HTTP {res.status_code}: {res.text}")
+
+    _remember_fingerprints(page_id, props)
+    return res.json()
+
+
+# -----------------------------------------------
+# 書き込み済みの内容（フィンガープリント）
+# -----------------------------------------------
+def _fingerprint(value) -> bytes:
+    raw = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).digest()
+
+
+def _remember_fingerprints(page_id: str, props: dict):
+    with _fingerprints_lock:
+        known = _fingerprints.setdefault(page_id, {})
+        _fingerprints.move_to_end(page_id)
+        for name, value in props.items():
+            known[name] = _fingerprint(value)
+        while len(_fingerprints) > FINGERPRINT_CACHE_SIZE:
+            _fingerprints.popitem(last=False)
+
+
+def _changed_props(page_id: str, props: dict) -> dict | None:
+    """前回書き込んだ内容と違うプロパティだけを返す（このページに書いた記録がなければ None）"""
+    with _fingerprints_lock:
+        known = _fingerprints.get(page_id)
+        if known is None:
+            return None
+        _fingerprints.move_to_end(page_id)
+        return {name: value for name, value in props.items() if known.get(name) != _fingerprint(value)}
+
+
+def get_upsert_stats() -> dict:
+    """upsert_store の書き込み件数（新規 / 全項目 / 差分のみ / 省略）"""
+    with _upsert_stats_lock:
+        return dict(upsert_stats)
+
+
+def _count_upsert(key: str):
+    # upsert_store は複数のスレッド（LINE / Discord / outbox / refresher）から呼ばれる
+    with _upsert_stats_lock:
+        upsert_stats[key] += 1
 
 
 # -----------------------------------------------
@@ -97,15 +396,18 @@ def upsert_store(
     """
     NotionDB に飲食店データを Upsert（Insert or Update）する。
     Discord と LINE 両方から利用可能。
+    同じ place_id の upsert は直列化し、ページが2つできないようにする。
+    失敗時は NotionWriteError を送出する。
     """
+    with _place_lock(details["place_id"]):
+        return _upsert_store_locked(details, summary, tags, store_type, recommendations, comment)
 
+
+def _upsert_store_locked(details, summary, tags, store_type, recommendations, comment) -> str:
     place_id = details["place_id"]
-    page_id = find_page_by_place_id(place_id)
+    page_id = _lookup_page_id(place_id)
 
     # --------- 保存データ（Notion properties）---------
-    hours = details.get("opening_hours", {}).get("weekday_text", [])
-    hours_text = "\n".join(hours)
-
     geo = details.get("geometry", {}).get("location", {})
 
     props = {
@@ -115,11 +417,8 @@ def upsert_store(
         "住所": {
             "rich_text": [{"text": {"content": details.get("formatted_address", "")}}]
         },
-        "評価": {"number": details.get("rating")},
-        "料金": {"number": details.get("price_level")},
-        "営業時間": {"rich_text": [{"text": {"content": hours_text}}]},
+        **google_detail_props(details),
         "URL": {"url": details.get("url")},
-        "公式サイト": {"url": details.get("website")},
         "lat": {"number": geo.get("lat")},
         "lng": {"number": geo.get("lng")},
         "place_id": {"rich_text": [{"text": {"content": place_id}}]},
@@ -135,15 +434,17 @@ def upsert_store(
         "Tags": {"multi_select": [{"name": t} for t in tags]},
     }
 
-    # --------- 既存 → 更新 ---------
+    # --------- 既存 → 更新（前回書き込んだ内容から変わった項目だけ）---------
     if page_id:
-        url = f"https://api.notion.com/v1/pages/{page_id}"
-        body = {"properties": props}
-        res = requests.patch(url, headers=_headers(), data=json.dumps(body))
+        changed = _changed_props(page_id, props)
+        if changed == {}:
+            _count_upsert("skipped")
+            return page_id
 
-        if res.status_code != 200:
-            print(f"[Notion Error] update page: HTTP {res.status_code}: {res.text}")
+        patch_page_properties(page_id, props if changed is None else changed)
+        _count_upsert("full" if changed is None or len(changed) == len(props) else "partial")
 
+        _notify_upsert(page_id, props)
         return page_id
 
     # --------- 新規作成 ---------
@@ -152,13 +453,23 @@ def upsert_store(
         "properties": props
     }
 
-    res = requests.post(
-        "https://api.notion.com/v1/pages",
-        headers=_headers(),
-        data=json.dumps(create_body)
-    )
+    # 作成は冪等ではないのでここでは再試行しない（outbox が page_id の確認後に再送する）
+    try:
+        res = request(
+            "notion", "POST", "https://api.notion.com/v1/pages",
+            headers=_headers(),
+            data=json.dumps(create_body)
+        )
+    except UpstreamUnavailable as e:
+        raise NotionWriteError(f"create page: {e}") from e
 
     if res.status_code != 200:
-        print(f"[Notion Error] create page: HTTP {res.status_code}: {res.text}")
+        raise NotionWriteError(f"create page: HTTP {res.status_code}: {res.text}")
+
+    page_id = res.json()["id"]
+    _page_ids[place_id] = page_id
+    _remember_fingerprints(page_id, props)
+    _count_upsert("created")
+    _notify_upsert(page_id, props)
 
-    return res.json()["id"]
+    return page_id
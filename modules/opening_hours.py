@@ -0,0 +1,172 @@
+# modules/opening_hours.py
+#
+# 営業時間を週単位のビットマップ（15分 × 7日 = 672 ビット = 84 バイト）にする。
+# 保存時に一度だけ作っておけば、「いま営業中か」「T 時に営業しているか」は1ビットの参照で判定できる。
+#   - Google Details の opening_hours.periods を優先し、なければ weekday_text（日本語・英語）を解析する
+#   - 日付の並びは月曜始まり（datetime.weekday() と同じ）、時刻は日本時間
+#   - 解析できない店は「不明」として None を返す（絞り込みでは除外しない）
+import re
+from datetime import datetime, timedelta, timezone
+import numpy as np
+
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+WEEK_SLOTS = 7 * SLOTS_PER_DAY
+BITMAP_BYTES = WEEK_SLOTS // 8
+
+JST = timezone(timedelta(hours=9))
+
+_DAY_NAMES = {
+    "月": 0, "火": 1, "水": 2, "木": 3, "金": 4, "土": 5, "日": 6,
+    "mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6,
+}
+_CLOSED_WORDS = ("定休日", "休業", "closed")
+_ALL_DAY_WORDS = ("24 時間営業", "24時間営業", "open 24 hours")
+# 午前/午後は数字の前（日本語）、AM/PM は後ろ（英語）につく
+_TIME_RE = re.compile(
+    r"(午前|午後)?\s*(\d{1,2})\s*(?:[:：時]\s*(\d{2})\s*分?)?\s*(am|pm|午前|午後)?", re.IGNORECASE
+)
+_LINE_RE = re.compile(r"\s*([^:：]+)[:：]\s*(.*)")
+_RANGE_SPLIT_RE = re.compile(r"\s*[～〜~–—-]\s*")
+
+
+def _set_range(bits: np.ndarray, start: int, end: int):
+    """週の分（0〜10080）で [start, end) を営業中にする。end < start は日曜→月曜の折り返し"""
+    start_slot = start // SLOT_MINUTES
+    end_slot = -(-end // SLOT_MINUTES)
+    if end_slot <= start_slot:
+        bits[start_slot:] = 1
+        bits[:end_slot] = 1
+    else:
+        bits[start_slot:end_slot] = 1
+
+
+def _pack(bits: np.ndarray) -> bytes:
+    return np.packbits(bits, bitorder="little").tobytes()
+
+
+# -----------------------------------------------
+# 解析
+# -----------------------------------------------
+def bitmap_from_periods(periods: list) -> bytes | None:
+    """Google の periods（day: 0=日曜、time: "HHMM"）から作る"""
+    if not periods:
+        return None
+
+    bits = np.zeros(WEEK_SLOTS, dtype=np.uint8)
+    for p in periods:
+        open_ = p.get("open")
+        if not open_:
+            continue
+        close = p.get("close")
+        # close がなく 0000 開始の1件だけなら24時間営業
+        if close is None:
+            bits[:] = 1
+            break
+
+        def week_minute(point):
+            day = (int(point["day"]) + 6) % 7
+            t = point["time"]
+            return day * 24 * 60 + int(t[:2]) * 60 + int(t[2:])
+
+        _set_range(bits, week_minute(open_), week_minute(close) % (7 * 24 * 60))
+    return _pack(bits)
+
+
+def _parse_time(text: str) -> int | None:
+    """「11時30分」「11:30」「7:00 PM」「午後7時」→ 0 時からの分"""
+    m = _TIME_RE.search(text)
+    if not m:
+        return None
+    hour, minute = int(m.group(2)), int(m.group(3) or 0)
+    ampm = (m.group(1) or m.group(4) or "").lower()
+    if ampm in ("pm", "午後") and hour < 12:
+        hour += 12
+    elif ampm in ("am", "午前") and hour == 12:
+        hour = 0
+    return hour * 60 + minute
+
+
+def bitmap_from_weekday_text(lines) -> bytes | None:
+    """weekday_text（「月曜日: 11時00分～22時00分」「Monday: 11:00 AM – 10:00 PM」）から作る"""
+    if isinstance(lines, str):
+        lines = lines.splitlines()
+
+    bits = np.zeros(WEEK_SLOTS, dtype=np.uint8)
+    parsed_days = 0
+    for line in lines:
+        m = _LINE_RE.match(line)
+        if not m:
+            continue
+        head, body = m.group(1).strip(), m.group(2)
+        day = _DAY_NAMES.get(head[:1]) if head[:1] in _DAY_NAMES else _DAY_NAMES.get(head[:3].lower())
+        if day is None:
+            continue
+        parsed_days += 1
+
+        body = body.strip()
+        if any(w in body.lower() for w in _CLOSED_WORDS):
+            continue
+        base = day * 24 * 60
+        if any(w in body.lower() for w in _ALL_DAY_WORDS):
+            _set_range(bits, base, base + 24 * 60)
+            continue
+
+        for part in re.split(r"[,、，]", body):
+            ends = _RANGE_SPLIT_RE.split(part.strip(), maxsplit=1)
+            if len(ends) != 2:
+                continue
+            start, end = _parse_time(ends[0]), _parse_time(ends[1])
+            if start is None or end is None:
+                continue
+            if end <= start:
+                end += 24 * 60   # 深夜まで営業（翌日にまたがる）
+            _set_range(bits, base + start, (base + end) % (7 * 24 * 60))
+
+    return _pack(bits) if parsed_days else None
+
+
+def hours_bitmap(details: dict) -> bytes | None:
+    """Details の opening_hours から作る（periods 優先、なければ weekday_text）。不明なら None"""
+    hours = details.get("opening_hours") or {}
+    return bitmap_from_periods(hours.get("periods")) or bitmap_from_weekday_text(hours.get("weekday_text") or [])
+
+
+# -----------------------------------------------
+# 判定
+# -----------------------------------------------
+def week_slot(when: datetime | None = None) -> int:
+    """日時 → ビット番号（タイムゾーンなしの日時は日本時間とみなす）"""
+    when = when or datetime.now(JST)
+    if when.tzinfo is not None:
+        when = when.astimezone(JST)
+    return when.weekday() * SLOTS_PER_DAY + (when.hour * 60 + when.minute) // SLOT_MINUTES
+
+
+def is_open(bitmap: bytes | None, when: datetime | None = None) -> bool | None:
+    """営業中なら True、営業時間外なら False、不明なら None"""
+    if bitmap is None:
+        return None
+    slot = week_slot(when)
+    return bool(bitmap[slot >> 3] >> (slot & 7) & 1)
+
+
+def open_mask(bitmaps: np.ndarray, known: np.ndarray, when: datetime | None = None) -> np.ndarray:
+    """
+    bitmaps: (店舗数, BITMAP_BYTES) の uint8 配列、known: 営業時間が分かっているか。
+    営業中または不明の店が True（店舗ごとに1ビット参照するだけ）。
+    """
+    slot = week_slot(when)
+    return ((bitmaps[:, slot >> 3] >> (slot & 7)) & 1).astype(bool) | ~known
+
+
+def bitmap_to_hex(bitmap: bytes | None) -> str:
+    return bitmap.hex() if bitmap else ""
+
+
+def bitmap_from_hex(text: str) -> bytes | None:
+    try:
+        raw = bytes.fromhex(text)
+    except ValueError:
+        return None
+    return raw if len(raw) == BITMAP_BYTES else None
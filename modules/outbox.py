@@ -0,0 +1,262 @@
+# modules/outbox.py
+#
+# Notion への保存を write-behind にする（先にローカルの outbox に書いて即応答し、
+# バックグラウンドのスレッドが Notion に反映する）。
+#   - outbox は SQLite に永続化するので、再起動しても未送信の保存は失われない
+#   - 同じ place_id の保存が溜まっている場合は最新の内容にまとめる（1回だけ書き込む）
+#   - 同じ店の保存をまとめるときは感想（comment）を上書きせずにつなげる
+#   - 失敗したら指数バックオフで再試行し、上限回数を超えたら failed として残す（呼び出し元に通知する）
+#   - 反映できた place_id → page_id の対応表も保存し、同じ店のページが2つできないようにする
+import json
+import os
+import sqlite3
+import threading
+import time
+
+NOTION_OUTBOX_PATH = os.getenv("NOTION_OUTBOX_PATH", "data/outbox.db")
+
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_RETRY_BASE = 2.0     # 再試行間隔（秒）の初期値。失敗ごとに2倍
+OUTBOX_RETRY_MAX = 300.0
+
+# upsert_store が使う Details のフィールド（レビュー・写真などは outbox に入れない）
+DETAIL_FIELDS = (
+    "place_id", "name", "formatted_address", "rating", "price_level",
+    "opening_hours", "url", "website", "geometry",
+)
+
+
+def slim_details(details: dict) -> dict:
+    """upsert_store に必要な Details の項目だけを残す（保存待ちの行・チェックポイントを小さくする）"""
+    slim = {k: details[k] for k in DETAIL_FIELDS if k in details}
+    if "opening_hours" in slim:
+        hours = slim["opening_hours"]
+        slim["opening_hours"] = {"weekday_text": hours.get("weekday_text", []), "periods": hours.get("periods", [])}
+    return slim
+
+
+# -----------------------------------------------
+# Outbox
+# -----------------------------------------------
+class NotionOutbox:
+    """Notion 保存の永続キュー + 配送スレッド"""
+
+    def __init__(self, path: str = NOTION_OUTBOX_PATH, writer=None):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._idle = threading.Event()
+        self._idle.set()
+        self._writer = writer
+        self._waiters = {}   # place_id -> [(on_created, on_failed)]（反映後・失敗時の通知。永続化しない）
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "place_id TEXT PRIMARY KEY, payload TEXT NOT NULL, version INTEGER NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, next_attempt REAL NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', last_error TEXT, enqueued_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS pages (place_id TEXT PRIMARY KEY, page_id TEXT NOT NULL)"
+            )
+
+    def _write(self, payload: dict) -> str:
+        if self._writer is None:
+            from modules.notion_client import upsert_store
+            self._writer = upsert_store
+        return self._writer(
+            payload["details"], payload["summary"], payload["tags"],
+            payload["store_type"], payload["recs"], payload["comment"],
+        )
+
+    # ---------------------------
+    # 登録
+    # ---------------------------
+    def enqueue(self, details: dict, summary: str, tags: list, store_type: dict,
+                recs: list, comment: str = "", on_created=None, on_failed=None) -> str | None:
+        """
+        保存を outbox に追加する（upsert_store と同じ引数）。
+        page_id が分かっている店（このプロセスか outbox が反映済み）なら返す。分からなければ None
+        （新規の店とは限らない。Notion にあっても手元の対応表にない店もある）。
+        on_created(page_id) は None を返したときだけ、Notion への反映後に呼ばれる（プロセス内のみ）。
+        on_failed(error) は再試行の上限を超えて保存をあきらめたときに呼ばれる。
+        """
+        from modules.notion_client import known_page_id
+
+        place_id = details["place_id"]
+        comment = comment or ""
+        now = time.time()
+
+        with self._lock, self._conn:
+            # 未送信の同じ店があれば最新の内容で置き換える。感想は前の分を残してつなげる
+            prev = self._conn.execute(
+                "SELECT payload FROM outbox WHERE place_id = ?", (place_id,)
+            ).fetchone()
+            if prev:
+                prev_comment = json.loads(prev[0]).get("comment", "")
+                if prev_comment and prev_comment != comment:
+                    comment = f"{prev_comment}\n{comment}" if comment else prev_comment
+
+            payload = json.dumps({
+                "details": slim_details(details), "summary": summary, "tags": list(tags),
+                "store_type": store_type, "recs": list(recs), "comment": comment,
+            }, ensure_ascii=False)
+
+            # version を進めて配送中の分と区別する
+            self._conn.execute(
+                "INSERT INTO outbox (place_id, payload, version, next_attempt, enqueued_at) "
+                "VALUES (?, ?, 1, ?, ?) "
+                "ON CONFLICT(place_id) DO UPDATE SET payload = excluded.payload, "
+                "version = outbox.version + 1, attempts = 0, next_attempt = excluded.next_attempt, "
+                "status = 'pending', last_error = NULL",
+                (place_id, payload, now, now),
+            )
+            row = self._conn.execute(
+                "SELECT page_id FROM pages WHERE place_id = ?", (place_id,)
+            ).fetchone()
+            page_id = row[0] if row else known_page_id(place_id)
+            if (on_created and page_id is None) or on_failed:
+                self._waiters.setdefault(place_id, []).append((None if page_id else on_created, on_failed))
+
+        self.start()
+        self._wake.set()
+        return page_id
+
+    def page_id_of(self, place_id: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT page_id FROM pages WHERE place_id = ?", (place_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM outbox WHERE status = 'pending'"
+            ).fetchone()[0]
+
+    # ---------------------------
+    # 配送
+    # ---------------------------
+    def start(self):
+        """配送スレッドを起動する（起動済みなら何もしない）"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            # 前回までに反映した対応表を notion_client に戻す（検索の遅延で重複作成しないため）
+            from modules.notion_client import remember_page_id
+            for place_id, page_id in self._conn.execute("SELECT place_id, page_id FROM pages"):
+                remember_page_id(place_id, page_id)
+
+            self._thread = threading.Thread(target=self._run, name="notion-outbox", daemon=True)
+            self._thread.start()
+
+    def _next_due(self):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT place_id, payload, version, attempts, next_attempt FROM outbox "
+                "WHERE status = 'pending' ORDER BY next_attempt LIMIT 1"
+            ).fetchone()
+
+    def _run(self):
+        while True:
+            row = self._next_due()
+            if row is None:
+                self._idle.set()
+                self._wake.wait()
+                self._wake.clear()
+                continue
+
+            wait = row[4] - time.time()
+            if wait > 0:
+                self._idle.set()
+                self._wake.wait(wait)
+                self._wake.clear()
+                continue
+
+            self._idle.clear()
+            self._deliver(*row[:4])
+
+    def _deliver(self, place_id: str, payload: str, version: int, attempts: int):
+        try:
+            page_id = self._write(json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            status = "failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+            delay = min(OUTBOX_RETRY_BASE * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+            print(f"[Outbox] {place_id}: attempt {attempts} failed ({status}): {e}")
+            with self._lock, self._conn:
+                # 配送中に新しい内容が入っていたら、そちらの再試行状態を優先する
+                updated = self._conn.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ?, status = ?, last_error = ? "
+                    "WHERE place_id = ? AND version = ?",
+                    (attempts, time.time() + delay, status, str(e), place_id, version),
+                ).rowcount
+                waiters = self._waiters.pop(place_id, []) if updated and status == "failed" else []
+
+            if updated and status == "failed":
+                print(f"[Outbox] {place_id}: GAVE UP after {attempts} attempts, left as failed: {e}")
+                for _, on_failed in waiters:
+                    if on_failed:
+                        try:
+                            on_failed(e)
+                        except Exception as cb_error:
+                            print(f"[Outbox] on_failed callback failed: {cb_error}")
+            return
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages (place_id, page_id) VALUES (?, ?)", (place_id, page_id)
+            )
+            # 配送中に同じ店が再登録されていれば（version が進んでいれば）残して次回送る
+            self._conn.execute(
+                "DELETE FROM outbox WHERE place_id = ? AND version = ?", (place_id, version)
+            )
+            waiters = self._waiters.pop(place_id, [])
+
+        for on_created, _ in waiters:
+            if not on_created:
+                continue
+            try:
+                on_created(page_id)
+            except Exception as e:
+                print(f"[Outbox] on_created callback failed: {e}")
+
+    def flush(self, timeout: float = 30) -> bool:
+        """今すぐ送れる分を送り終えるまで待つ（終了処理・動作確認用）"""
+        self.start()
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            self._wake.set()
+            time.sleep(0.05)
+            row = self._next_due()
+            if self._idle.is_set() and (row is None or row[4] > time.time()):
+                return True
+        return False
+
+
+# -----------------------------------------------
+# 共有インスタンス
+# -----------------------------------------------
+_shared_outbox = None
+_shared_lock = threading.Lock()
+
+
+def get_outbox() -> NotionOutbox:
+    global _shared_outbox
+
+    with _shared_lock:
+        if _shared_outbox is None:
+            _shared_outbox = NotionOutbox()
+        return _shared_outbox
+
+
+def enqueue_store(details, summary, tags, store_type, recs, comment="",
+                  on_created=None, on_failed=None) -> str | None:
+    """upsert_store の write-behind 版。分かっていれば page_id（分からなければ None）を返す"""
+    return get_outbox().enqueue(details, summary, tags, store_type, recs, comment, on_created, on_failed)
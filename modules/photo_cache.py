@@ -0,0 +1,252 @@
+# modules/photo_cache.py
+#
+# Google Places Photo のローカルプロキシ用キャッシュ。
+# photo_reference ごとに元画像を1回だけ取得し、幅・形式ごとの縮小版をディスクに保存する。
+# 合計サイズが上限を超えたら、最後に使われたのが古いファイルから削除する（LRU）。
+import hashlib
+import hmac
+import io
+import os
+import threading
+from urllib.parse import quote
+
+PHOTO_CACHE_DIR = os.getenv("PHOTO_CACHE_DIR", "data/photos")
+PHOTO_CACHE_MAX_BYTES = int(os.getenv("PHOTO_CACHE_MAX_BYTES", 200 * 1024 * 1024))
+
+# 生成を許可する幅（任意の幅を受け付けるとバリアントが無制限に増えるため）
+PHOTO_WIDTHS = (240, 480, 800, 1024)
+PHOTO_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp"}
+ORIGINAL_MAXWIDTH = max(PHOTO_WIDTHS)
+
+# photo_reference ごとの生成を直列化するロックの本数（キーのハッシュで割り当てる）
+KEY_LOCK_STRIPES = 64
+
+
+# -----------------------------------------------
+# 公開 URL（署名付き）
+# -----------------------------------------------
+def _public_base_url() -> str | None:
+    """プロキシを公開している URL（PUBLIC_BASE_URL、なければ Railway の公開ドメイン）"""
+    base = os.getenv("PUBLIC_BASE_URL")
+    if not base and os.getenv("RAILWAY_PUBLIC_DOMAIN"):
+        base = f"https://{os.getenv('RAILWAY_PUBLIC_DOMAIN')}"
+    return base.rstrip("/") if base else None
+
+
+def _secret() -> bytes | None:
+    """署名の鍵。未設定なら None（署名も受け付けもしない。空の鍵では誰でも署名を作れる）"""
+    secret = os.getenv("PHOTO_URL_SECRET") or os.getenv("LINE_CHANNEL_SECRET")
+    return secret.encode("utf-8") if secret else None
+
+
+def photo_proxy_enabled() -> bool:
+    return _secret() is not None
+
+
+def sign_photo_request(photo_reference: str, width: int, fmt: str) -> str:
+    """自前で発行した URL だけを受け付けるための署名（鍵が未設定なら RuntimeError）"""
+    secret = _secret()
+    if secret is None:
+        raise RuntimeError("PHOTO_URL_SECRET / LINE_CHANNEL_SECRET is not set")
+    msg = f"{photo_reference}|{width}|{fmt}".encode("utf-8")
+    return hmac.new(secret, msg, hashlib.sha256).hexdigest()[:20]
+
+
+def verify_photo_request(photo_reference: str, width: int, fmt: str, sig: str) -> bool:
+    if _secret() is None:
+        return False
+    return hmac.compare_digest(sign_photo_request(photo_reference, width, fmt), sig or "")
+
+
+def snap_width(width: int) -> int:
+    """要求幅以上で最小の許可幅（最大幅を超える場合は最大幅）"""
+    return next((w for w in PHOTO_WIDTHS if w >= width), PHOTO_WIDTHS[-1])
+
+
+def build_proxy_photo_url(photo_reference: str, width: int = 800, fmt: str = "jpeg") -> str | None:
+    """プロキシ経由の写真 URL。公開 URL か署名の鍵が未設定なら None"""
+    base = _public_base_url()
+    if not base or _secret() is None:
+        return None
+
+    width = snap_width(width)
+    sig = sign_photo_request(photo_reference, width, fmt)
+    return f"{base}/photo/{quote(photo_reference, safe='')}?w={width}&fmt={fmt}&sig={sig}"
+
+
+# -----------------------------------------------
+# ディスクキャッシュ
+# -----------------------------------------------
+class PhotoCache:
+    """photo_reference → 元画像 + 縮小版のディスクキャッシュ（合計サイズ上限つき LRU）"""
+
+    def __init__(self, root: str = PHOTO_CACHE_DIR, max_bytes: int = PHOTO_CACHE_MAX_BYTES, fetcher=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._fetch = fetcher or fetch_google_photo
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCK_STRIPES)]
+        os.makedirs(root, exist_ok=True)
+        self._total = sum(os.path.getsize(p) for p in self._all_files())
+
+    # ---------------------------
+    # パス
+    # ---------------------------
+    @staticmethod
+    def _key(photo_reference: str) -> str:
+        return hashlib.sha256(photo_reference.encode("utf-8")).hexdigest()[:32]
+
+    def _dir(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def _all_files(self):
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(".tmp"):
+                    yield os.path.join(dirpath, name)
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        return self._key_locks[int(key[:8], 16) % len(self._key_locks)]
+
+    # ---------------------------
+    # 取得
+    # ---------------------------
+    def get(self, photo_reference: str, width: int, fmt: str = "jpeg") -> tuple[str, str]:
+        """
+        縮小版のファイルパスと ETag を返す（なければ生成）。
+        元画像の取得は photo_reference ごとに1回だけ。
+        """
+        key = self._key(photo_reference)
+        width = snap_width(width)
+        variant = os.path.join(self._dir(key), f"{width}.{fmt}")
+        etag = f"{key}-{width}-{fmt}"
+
+        if os.path.exists(variant):
+            self._touch(variant)
+            return variant, etag
+
+        with self._key_lock(key):
+            if not os.path.exists(variant):
+                original = self._load_original(photo_reference, key)
+                self._write(variant, resize_photo(original, width, fmt))
+                self._evict()
+
+        return variant, etag
+
+    def _load_original(self, photo_reference: str, key: str) -> bytes:
+        path = os.path.join(self._dir(key), "original")
+        if os.path.exists(path):
+            self._touch(path)
+            with open(path, "rb") as f:
+                return f.read()
+
+        data = self._fetch(photo_reference, ORIGINAL_MAXWIDTH)
+        self._write(path, data)
+        return data
+
+    # ---------------------------
+    # 書き込み・LRU
+    # ---------------------------
+    def _write(self, path: str, data: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        with self._lock:
+            # 上書きするときは古いファイルの分を差し引く
+            try:
+                old_size = os.path.getsize(path)
+            except OSError:
+                old_size = 0
+            os.replace(tmp, path)
+            self._total += len(data) - old_size
+
+    @staticmethod
+    def _touch(path: str):
+        """最終利用時刻（mtime）を更新する"""
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """合計サイズが上限を超えていれば、最終利用が古いファイルから削除する"""
+        with self._lock:
+            if self._total <= self.max_bytes:
+                return
+
+            files = []
+            for p in self._all_files():
+                try:
+                    st = os.stat(p)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, p))
+            files.sort()
+
+            total = sum(size for _, size, _ in files)
+            target = self.max_bytes * 0.9  # 毎回の削除を避けるため少し余裕を持たせる
+            for _, size, p in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(p)
+                    total -= size
+                except OSError:
+                    pass
+
+            self._total = total
+
+
+# -----------------------------------------------
+# Google から取得・縮小
+# -----------------------------------------------
+def fetch_google_photo(photo_reference: str, maxwidth: int) -> bytes:
+    """Google Places Photo API から画像を取得する（API キーはサーバー内だけで使う）"""
+    from modules.resilience import request
+
+    res = request(
+        "google_photo", "GET",
+        "https://maps.googleapis.com/maps/api/place/photo",
+        params={
+            "maxwidth": maxwidth,
+            "photo_reference": photo_reference,
+            "key": os.getenv("GOOGLE_API_KEY"),
+        },
+    )
+    if res.status_code != 200 or not res.headers.get("Content-Type", "").startswith("image/"):
+        raise RuntimeError(f"[Google Photo Error] HTTP {res.status_code}")
+    return res.content
+
+
+def resize_photo(data: bytes, width: int, fmt: str) -> bytes:
+    """幅 width 以下に縮小して JPEG / WebP にエンコードする"""
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    img = img.convert("RGB")
+    if img.width > width:
+        img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+
+    out = io.BytesIO()
+    if fmt == "webp":
+        img.save(out, "WEBP", quality=80, method=4)
+    else:
+        img.save(out, "JPEG", quality=82, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+# -----------------------------------------------
+# 共有キャッシュ
+# -----------------------------------------------
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+def get_photo_cache() -> PhotoCache:
+    global _shared_cache
+
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = PhotoCache()
+        return _shared_cache
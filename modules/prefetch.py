@@ -0,0 +1,185 @@
+# modules/prefetch.py
+#
+# 候補一覧を見せている間に、上位の候補の Details 取得（と AI 解析）を先に始めておく。
+# ユーザーが先読み済みの店を選べば、選択後の待ち時間はほぼなくなる。
+#   - 1時間あたりの呼び出し数に上限（予算）を設け、使い切ったら先読みしない
+#   - セッションがキャンセル・期限切れ・別の店の選択になったら残りの先読みを取り消す
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError, TimeoutError as FutureTimeout
+
+from modules.admission import HourlyBudget
+
+# Details を先読みする候補数 / AI 解析まで先読みする候補数（上位から）
+PREFETCH_DETAILS_TOP_N = int(os.getenv("PREFETCH_DETAILS_TOP_N", 3))
+PREFETCH_ANALYZE_TOP_N = int(os.getenv("PREFETCH_ANALYZE_TOP_N", 1))
+
+# 1時間あたりの先読み予算（Details 呼び出し数 / AI 解析数）
+PREFETCH_DETAILS_BUDGET = int(os.getenv("PREFETCH_DETAILS_BUDGET", 300))
+PREFETCH_ANALYZE_BUDGET = int(os.getenv("PREFETCH_ANALYZE_BUDGET", 60))
+
+# 先読み結果を保持する時間（秒）
+PREFETCH_TTL = int(os.getenv("PREFETCH_TTL", 600))
+
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", 4))
+
+
+# -----------------------------------------------
+# 先読みセッション
+# -----------------------------------------------
+class _Session:
+    __slots__ = ("futures", "cancelled", "expires")
+
+    def __init__(self):
+        self.futures = {}        # place_id -> Future（結果: {"details", "analysis"}）
+        self.cancelled = set()   # 取り消した place_id
+        self.expires = time.time() + PREFETCH_TTL
+
+
+class Prefetcher:
+    """セッション（LINE の user_id など）ごとに候補の先読みを管理する"""
+
+    def __init__(self, fetch_details=None, analyze=None, workers: int = PREFETCH_WORKERS):
+        self._fetch_details = fetch_details
+        self._analyze = analyze
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.details_budget = HourlyBudget(PREFETCH_DETAILS_BUDGET)
+        self.analyze_budget = HourlyBudget(PREFETCH_ANALYZE_BUDGET)
+        self.stats = {"scheduled": 0, "hits": 0, "misses": 0, "cancelled": 0, "over_budget": 0}
+
+    # ---------------------------
+    # 依存関数（遅延 import）
+    # ---------------------------
+    def _details(self, place_id):
+        if self._fetch_details is None:
+            from modules.google_api import get_place_details
+            self._fetch_details = get_place_details
+        return self._fetch_details(place_id)
+
+    def _analysis(self, details):
+        if self._analyze is None:
+            from modules.ai_processing import analyze_store
+            self._analyze = analyze_store
+        return self._analyze(
+            details["name"], details.get("types", []), details.get("reviews", []), place_id=details.get("place_id")
+        )
+
+    # ---------------------------
+    # 開始・取り消し
+    # ---------------------------
+    def start(self, key, candidates: list):
+        """候補一覧を表示したタイミングで呼ぶ。同じ key の前回の先読みは取り消す"""
+        self._cleanup()
+        session = _Session()
+
+        with self._lock:
+            old = self._sessions.pop(key, None)
+            self._sessions[key] = session
+        if old:
+            self._cancel_session(old)
+
+        for i, c in enumerate(candidates[:PREFETCH_DETAILS_TOP_N]):
+            place_id = c["place_id"]
+            if not self.details_budget.try_spend():
+                self.stats["over_budget"] += 1
+                break
+
+            with_analysis = i < PREFETCH_ANALYZE_TOP_N
+            session.futures[place_id] = self._executor.submit(
+                self._run, session, place_id, with_analysis
+            )
+            self.stats["scheduled"] += 1
+
+    def _run(self, session: _Session, place_id: str, with_analysis: bool) -> dict:
+        if place_id in session.cancelled:
+            raise CancelledError()
+
+        details = self._details(place_id)
+        analysis = None
+
+        # Details 取得中に取り消された場合は、高い AI 解析を始めない
+        if with_analysis and details and place_id not in session.cancelled:
+            if self.analyze_budget.try_spend():
+                analysis = self._analysis(details)
+            else:
+                self.stats["over_budget"] += 1
+
+        return {"details": details, "analysis": analysis}
+
+    def cancel(self, key):
+        """セッションのキャンセル時に呼ぶ。まだ始まっていない先読みを取り消す"""
+        with self._lock:
+            session = self._sessions.pop(key, None)
+        if session:
+            self._cancel_session(session)
+
+    def _cancel_session(self, session: _Session, keep: str | None = None):
+        for place_id, fut in session.futures.items():
+            if place_id == keep:
+                continue
+            session.cancelled.add(place_id)
+            if fut.cancel():
+                self.stats["cancelled"] += 1
+
+    def _cleanup(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, s in self._sessions.items() if s.expires < now]
+            sessions = [self._sessions.pop(k) for k in expired]
+        for s in sessions:
+            self._cancel_session(s)
+
+    # ---------------------------
+    # 取得
+    # ---------------------------
+    def take(self, key, place_id: str, timeout: float = 30) -> dict | None:
+        """
+        選ばれた店の先読み結果 {"details", "analysis"} を返す（実行中なら完了を待つ）。
+        先読みしていない・失敗した場合は None。他の候補の先読みはここで取り消す。
+        analysis は先読みしていなければ None。
+        """
+        with self._lock:
+            session = self._sessions.pop(key, None)
+        if session is None:
+            self.stats["misses"] += 1
+            return None
+
+        self._cancel_session(session, keep=place_id)
+        fut = session.futures.get(place_id)
+        if fut is None or session.expires < time.time():
+            self.stats["misses"] += 1
+            return None
+
+        try:
+            result = fut.result(timeout=timeout)
+        except (CancelledError, FutureTimeout):
+            result = None
+        except Exception as e:
+            print(f"[Prefetch Error] {place_id}: {e}")
+            result = None
+
+        if not result or not result["details"]:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats["hits"] += 1
+        return result
+
+
+# -----------------------------------------------
+# 共有インスタンス
+# -----------------------------------------------
+_shared_prefetcher = None
+_shared_lock = threading.Lock()
+
+
+def get_prefetcher() -> Prefetcher:
+    global _shared_prefetcher
+
+    with _shared_lock:
+        if _shared_prefetcher is None:
+            _shared_prefetcher = Prefetcher()
+        return _shared_prefetcher
@@ -0,0 +1,347 @@
+# modules/ranking.py
+#
+# Discord /nearby と LINE おすすめ検索で共通のランキングエンジン。
+# 候補を列（配列）単位でまとめてスコア計算し、ヒープで上位 k 件だけを取り出す。
+import heapq
+import numpy as np
+
+from modules.opening_hours import BITMAP_BYTES, hours_bitmap, open_mask
+
+EARTH_RADIUS_KM = 6371
+
+
+# -----------------------------------------------
+# 緯度経度 → 距離（km）のベクトル版
+# -----------------------------------------------
+def calc_distance_array(lat0: float, lng0: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    """基準点から各点までの距離(km)を Haversine 公式でまとめて計算する"""
+    lat0_r = np.radians(lat0)
+    lats_r = np.radians(lats)
+    d_lat = lats_r - lat0_r
+    d_lng = np.radians(lngs - lng0)
+
+    a = np.sin(d_lat / 2) ** 2 + np.cos(lat0_r) * np.cos(lats_r) * np.sin(d_lng / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+# -----------------------------------------------
+# ランキング対象（列指向）
+# -----------------------------------------------
+class CandidateSet:
+    """
+    ランキング対象の店舗を列ごとの配列で保持する。
+    items[i] が元データ（StoreRecord や details）で、各配列の i 番目に対応する。
+    """
+
+    __slots__ = (
+        "items", "place_ids", "lat", "lng", "rating", "user_rating", "tags", "store_types", "subtypes",
+        "open_bits", "hours_known",
+    )
+
+    def __init__(self, items, place_ids, lat, lng, rating, user_rating, tags, store_types, subtypes,
+                 open_bits=None, hours_known=None):
+        self.items = items
+        self.place_ids = place_ids      # list[str]
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lng = np.asarray(lng, dtype=np.float64)
+        self.rating = np.asarray(rating, dtype=np.float64)            # 未評価は 0
+        self.user_rating = np.asarray(user_rating, dtype=np.float64)  # 未評価は 0
+        self.tags = tags                # list[list[str]]（小文字化済み）
+        self.store_types = store_types  # list[str]
+        self.subtypes = subtypes        # list[str]
+        # 営業時間の週ビットマップ (n, BITMAP_BYTES) と、営業時間が分かっているか
+        n = len(items)
+        self.open_bits = np.zeros((n, BITMAP_BYTES), dtype=np.uint8) if open_bits is None else open_bits
+        self.hours_known = np.zeros(n, dtype=bool) if hours_known is None else np.asarray(hours_known, dtype=bool)
+
+    @staticmethod
+    def _stack_bitmaps(bitmaps: list) -> tuple[np.ndarray, np.ndarray]:
+        """bytes | None の列 → (ビットマップ配列, 分かっているか)"""
+        bits = np.zeros((len(bitmaps), BITMAP_BYTES), dtype=np.uint8)
+        known = np.zeros(len(bitmaps), dtype=bool)
+        for i, b in enumerate(bitmaps):
+            if b is not None:
+                bits[i] = np.frombuffer(b, dtype=np.uint8)
+                known[i] = True
+        return bits, known
+
+    def open_mask(self, when=None) -> np.ndarray:
+        """when（既定は現在）に営業中の店が True。営業時間が不明な店も True"""
+        return open_mask(self.open_bits, self.hours_known, when)
+
+    def __len__(self):
+        return len(self.items)
+
+    def subset(self, selector) -> "CandidateSet":
+        """インデックス配列または bool マスクで絞り込んだ CandidateSet を返す"""
+        idx = np.flatnonzero(selector) if np.asarray(selector).dtype == bool else np.asarray(selector)
+        pick = idx.tolist()
+        return CandidateSet(
+            [self.items[i] for i in pick],
+            [self.place_ids[i] for i in pick],
+            self.lat[idx], self.lng[idx], self.rating[idx], self.user_rating[idx],
+            [self.tags[i] for i in pick],
+            [self.store_types[i] for i in pick],
+            [self.subtypes[i] for i in pick],
+            self.open_bits[idx], self.hours_known[idx],
+        )
+
+    @classmethod
+    def from_records(cls, records: list) -> "CandidateSet":
+        """StoreRecord の列から作る（緯度経度のない店は除外）"""
+        items = [r for r in records if r.has_location]
+
+        return cls(
+            items,
+            [r.place_id for r in items],
+            [r.lat for r in items],
+            [r.lng for r in items],
+            [r.rating or 0 for r in items],
+            [r.user_rating or 0 for r in items],
+            [[t.lower() for t in r.tags] for r in items],
+            [r.store_type for r in items],
+            [r.subtype for r in items],
+            *cls._stack_bitmaps([r.open_bits for r in items]),
+        )
+
+    @classmethod
+    def from_analyzed(cls, rows: list) -> "CandidateSet":
+        """
+        (details, store_type, tags, ...) のタプル列から作る。
+        details は get_place_details() の返却値。
+        """
+        items, place_ids, lat, lng, rating, user_rating = [], [], [], [], [], []
+        tags, store_types, subtypes, bitmaps = [], [], [], []
+
+        for row in rows:
+            details, store_type, row_tags = row[0], row[1], row[2]
+            loc = details.get("geometry", {}).get("location", {})
+
+            items.append(row)
+            place_ids.append(details.get("place_id", ""))
+            lat.append(loc.get("lat", 0.0))
+            lng.append(loc.get("lng", 0.0))
+            rating.append(details.get("rating") or 0)
+            user_rating.append(details.get("user_rating") or 0)
+            tags.append([t.lower() for t in row_tags])
+            store_types.append(store_type.get("type", ""))
+            subtypes.append(store_type.get("subtype", ""))
+            bitmaps.append(hours_bitmap(details))
+
+        return cls(
+            items, place_ids, lat, lng, rating, user_rating, tags, store_types, subtypes,
+            *cls._stack_bitmaps(bitmaps),
+        )
+
+
+# -----------------------------------------------
+# 特徴量（name → 関数）
+# -----------------------------------------------
+FEATURES = {}
+
+
+def register_feature(name: str):
+    """
+    特徴量関数を登録するデコレータ。
+    関数は (candidates, context) を受け取り、候補数と同じ長さの配列を返す。
+    context には "distance_km"（基準点からの距離配列）が入っている。
+    """
+    def deco(fn):
+        FEATURES[name] = fn
+        return fn
+    return deco
+
+
+@register_feature("distance")
+def distance_score(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """距離スコア (0〜100)：近いほど高い"""
+    d = ctx["distance_km"] * 1000
+    far = np.maximum(15, 10000 / np.maximum(d, 1))
+    return np.select(
+        [d <= 100, d <= 300, d <= 600, d <= 1000],
+        [100, 80, 60, 40],
+        default=far,
+    )
+
+
+@register_feature("rating")
+def rating_score(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """Google評価 (0〜100)"""
+    return cands.rating * 20
+
+
+@register_feature("rating_bias")
+def rating_bias(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """Google評価の 3.0 からの差（未評価は 0）"""
+    return np.where(cands.rating > 0, cands.rating - 3.0, 0.0)
+
+
+@register_feature("personal_rating")
+def personal_rating_score(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """あなたの個人評価 (0〜100)"""
+    return cands.user_rating * 20
+
+
+@register_feature("tag_match")
+def tag_match_count(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """
+    条件ワードのうちタグに一致した数。
+    context に "tag_match_counts"（TagIndex.match_counts の結果）があればそれを使う。
+    """
+    if "tag_match_counts" in ctx:
+        return ctx["tag_match_counts"]
+
+    conds = [c.lower() for c in ctx.get("conditions", [])]
+    if not conds:
+        return np.zeros(len(cands))
+
+    return np.fromiter(
+        (sum(1 for c in conds if c in tags) for tags in cands.tags),
+        dtype=np.float64, count=len(cands),
+    )
+
+
+@register_feature("type_match")
+def type_match_score(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """店タイプがタグにも含まれていれば 100、そうでなければ 50"""
+    return np.fromiter(
+        (100 if t.lower() in tags else 50 for t, tags in zip(cands.store_types, cands.tags)),
+        dtype=np.float64, count=len(cands),
+    )
+
+
+SITUATION_MAP = {
+    "デート": ["date", "romantic", "couple"],
+    "静か": ["quiet", "study", "relax"],
+    "作業": ["work", "study", "focus"],
+    "一人": ["solo", "casual", "quiet"],
+    "友達": ["friends", "group", "fun"],
+}
+
+
+@register_feature("situation")
+def situation_score(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """
+    シチュエーション適性スコア (0〜100)。
+    context に "situation_similarity"（埋め込みのコサイン類似度）があれば 30〜100 に換算し、
+    類似度のない店（NaN）だけ SITUATION_MAP による文字列判定を使う。
+    """
+    situation = ctx.get("situation", "")
+    keywords = SITUATION_MAP.get(situation, [])
+
+    def score(subtype):
+        if subtype in keywords:
+            return 100
+        return 50 if situation and situation in subtype else 30
+
+    fallback = np.fromiter((score(s) for s in cands.subtypes), dtype=np.float64, count=len(cands))
+
+    sim = ctx.get("situation_similarity")
+    if sim is None:
+        return fallback
+    return np.where(np.isnan(sim), fallback, 30 + 70 * np.clip(sim, 0, 1))
+
+
+@register_feature("semantic")
+def semantic_score(cands: CandidateSet, ctx: dict) -> np.ndarray:
+    """条件文と店舗の埋め込み類似度 (0〜1)。context に "semantic_similarity" がなければ 0"""
+    sim = ctx.get("semantic_similarity")
+    if sim is None:
+        return np.zeros(len(cands))
+    return np.clip(np.nan_to_num(sim), 0, 1)
+
+
+# -----------------------------------------------
+# 重みプロファイル
+# -----------------------------------------------
+# /nearby：条件タグ一致数 + 評価補正 + 条件文との意味的な近さ（同点は距離が近い順）
+NEARBY_WEIGHTS = {
+    "tag_match": 1.0,
+    "rating_bias": 0.5,
+    "semantic": 1.0,
+}
+
+# LINE おすすめ：評価・シチュエーション・距離・個人評価・タイプ一致の加重和
+RECOMMEND_WEIGHTS = {
+    "rating": 0.40,
+    "situation": 0.30,
+    "distance": 0.15,
+    "personal_rating": 0.10,
+    "type_match": 0.05,
+}
+
+# LINE おすすめの事前絞り込み：Nearby Search の評価と距離だけで詳細取得する店を選ぶ
+RECOMMEND_PRERANK_WEIGHTS = {
+    "rating": 0.7,
+    "distance": 0.3,
+}
+
+
+# -----------------------------------------------
+# 上位 k 件の選択（ヒープ）
+# -----------------------------------------------
+def top_k(scores: np.ndarray, k: int, tiebreak: np.ndarray | None = None) -> list[int]:
+    """
+    scores の大きい順に k 件のインデックスを返す（O(n log k)）。
+    tiebreak を渡すと同点時にその値が小さい方を優先する。
+    """
+    s = scores.tolist()
+    if tiebreak is None:
+        return heapq.nlargest(k, range(len(s)), key=s.__getitem__)
+
+    t = tiebreak.tolist()
+    return heapq.nlargest(k, range(len(s)), key=lambda i: (s[i], -t[i]))
+
+
+# -----------------------------------------------
+# ランキングエンジン
+# -----------------------------------------------
+class RankingEngine:
+    """重み付き特徴量の和で候補をスコアリングし、上位 k 件を返す"""
+
+    def __init__(self, weights: dict[str, float]):
+        unknown = set(weights) - set(FEATURES)
+        if unknown:
+            raise ValueError(f"unknown ranking features: {sorted(unknown)}")
+        self.weights = dict(weights)
+
+    def score(self, cands: CandidateSet, context: dict) -> tuple[np.ndarray, np.ndarray]:
+        """全候補のスコア配列と距離配列(km)を返す"""
+        distance_km = calc_distance_array(context["lat"], context["lng"], cands.lat, cands.lng)
+        ctx = dict(context, distance_km=distance_km)
+
+        scores = np.zeros(len(cands))
+        for name, weight in self.weights.items():
+            if weight:
+                scores += weight * FEATURES[name](cands, ctx)
+
+        return scores, distance_km
+
+    def rank(self, cands: CandidateSet, context: dict, k: int = 3) -> list[dict]:
+        """
+        context: {"lat", "lng", "conditions", "situation", "max_distance_km", "open_at", ...}
+        返却値: [{"item": 元データ, "score": float, "distance": km}, ...]（スコア順）
+        max_distance_km を指定するとそれより遠い候補は除外する。
+        """
+        if not len(cands):
+            return []
+
+        scores, distance_km = self.score(cands, context)
+
+        max_km = context.get("max_distance_km")
+        if max_km is not None:
+            scores = np.where(distance_km <= max_km, scores, -np.inf)
+
+        # open_at（datetime）を指定するとその時刻に営業していない店は除外する（営業時間が不明な店は残す）
+        if context.get("open_at") is not None:
+            scores = np.where(cands.open_mask(context["open_at"]), scores, -np.inf)
+
+        return [
+            {
+                "item": cands.items[i],
+                "score": float(scores[i]),
+                "distance": float(distance_km[i]),
+            }
+            for i in top_k(scores, k, tiebreak=distance_km)
+            if np.isfinite(scores[i])
+        ]
@@ -0,0 +1,228 @@
+# modules/refresher.py
+#
+# 保存済み店舗の Google 由来の項目（評価・料金・営業時間・公式サイト）を少しずつ最新にする。
+# これまでは /save し直すしかなく、そのたびに LLM 解析も走っていた。
+#   - 古い順（Notion の last_edited_time の昇順）に見ていく。最近確認した店は飛ばす
+#   - 変化のなかった店は last_edited_time が古いままなので、前回止まった位置（resume cursor）から続きを見る。
+#     最後まで見たら先頭に戻る
+#   - Details は安い階層（contact / atmosphere）だけを取得し、保存値と比べて変わった項目だけを PATCH
+#   - Google / Notion の呼び出し数は1時間あたりの予算内に収める（使い切ったら次の周期に持ち越し）
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from modules.admission import HourlyBudget
+
+REFRESH_INTERVAL = int(os.getenv("REFRESH_INTERVAL", 600))                 # 周期（秒）
+REFRESH_GOOGLE_BUDGET = int(os.getenv("REFRESH_GOOGLE_BUDGET", 60))        # Details 呼び出し数/時
+REFRESH_NOTION_BUDGET = int(os.getenv("REFRESH_NOTION_BUDGET", 60))        # query + PATCH 数/時
+REFRESH_MIN_AGE_HOURS = float(os.getenv("REFRESH_MIN_AGE_HOURS", 24 * 7))  # これより新しい店は見ない
+REFRESH_STATE_PATH = os.getenv("REFRESH_STATE_PATH", "data/refresh_state.json")
+
+# 取得する階層と、比べる項目（StoreRecord の属性 → Details から値を取り出す関数）
+REFRESH_TIERS = ("contact", "atmosphere")
+REFRESH_PROPERTIES = ["店名", "place_id", "評価", "料金", "営業時間", "公式サイト", "営業時間コード"]
+
+
+def _compare_fields():
+    from modules.notion_client import hours_text
+    return {
+        "評価": ("rating", lambda d: d.get("rating")),
+        "料金": ("price_level", lambda d: d.get("price_level")),
+        "営業時間": ("hours", hours_text),
+        "公式サイト": ("website", lambda d: d.get("website")),
+    }
+
+
+class StoreRefresher:
+    def __init__(self, google_budget: int = REFRESH_GOOGLE_BUDGET, notion_budget: int = REFRESH_NOTION_BUDGET,
+                 min_age_hours: float = REFRESH_MIN_AGE_HOURS, state_path: str | None = REFRESH_STATE_PATH):
+        self.google_budget = HourlyBudget(google_budget)
+        self.notion_budget = HourlyBudget(notion_budget)
+        self.min_age = min_age_hours * 3600
+        self.state_path = state_path
+        self._checked = {}   # place_id -> 最後に確認した時刻（変化なしでも記録して、次は後回しにする）
+        self._cursor = None  # 次の周期で見始める last_edited_time（None なら先頭から）
+        self._thread = None
+        self._lock = threading.RLock()
+        self.stats = {"checked": 0, "changed": 0, "unchanged": 0, "failed": 0, "runs": 0}
+
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, encoding="utf-8") as f:
+                    state = json.load(f)
+                # 以前の形式は place_id -> 時刻 の dict だけ
+                if "checked" in state and isinstance(state["checked"], dict):
+                    self._checked = state["checked"]
+                    self._cursor = state.get("cursor")
+                else:
+                    self._checked = state
+            except (OSError, ValueError) as e:
+                print(f"[Refresh] failed to load {state_path}: {e}")
+
+    def _count(self, *keys):
+        with self._lock:
+            for key in keys:
+                self.stats[key] += 1
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        if os.path.dirname(self.state_path):
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        # 確認してから min_age 以上たったものは、古い順の並びで自然に対象に戻るので捨ててよい
+        cutoff = time.time() - self.min_age
+        self._checked = {k: v for k, v in self._checked.items() if v > cutoff}
+        tmp = f"{self.state_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"checked": self._checked, "cursor": self._cursor}, f)
+        os.replace(tmp, self.state_path)
+
+    # ---------------------------
+    # 1店舗
+    # ---------------------------
+    def _changed_props(self, record, details: dict) -> dict:
+        from modules.notion_client import google_detail_props, OPENING_CODE_PROPERTY
+
+        new_props = google_detail_props(details)
+        changed = {}
+        for name, (attr, value_of) in _compare_fields().items():
+            current, fresh = getattr(record, attr), value_of(details)
+            # 数値は Notion から float で返るので数値として比べる
+            if isinstance(current, (int, float)) and isinstance(fresh, (int, float)):
+                same = float(current) == float(fresh)
+            else:
+                same = (current or None) == (fresh or None)
+            if not same:
+                changed[name] = new_props[name]
+
+        # 営業時間が変わった（またはビットマップをまだ保存していない）ならビットマップも書く
+        code = new_props.get(OPENING_CODE_PROPERTY)
+        if code and ("営業時間" in changed or (not record.opening_code and code["rich_text"][0]["text"]["content"])):
+            changed[OPENING_CODE_PROPERTY] = code
+        return changed
+
+    def refresh_record(self, record) -> bool | None:
+        """1店舗を確認する。更新したら True、変化なしなら False、予算切れなら None"""
+        from modules.google_api import get_place_details, invalidate_place_details
+        from modules.notion_client import patch_page_properties, notify_page_updated, NotionWriteError
+
+        if not self.google_budget.try_spend():
+            return None
+
+        # キャッシュではなく最新の値と比べる
+        invalidate_place_details(record.place_id, REFRESH_TIERS)
+        details = get_place_details(record.place_id, REFRESH_TIERS)
+        if not details:
+            self._count("checked", "failed")
+            return False
+
+        changed = self._changed_props(record, details)
+        if changed:
+            if not self.notion_budget.try_spend():
+                return None
+            try:
+                page = patch_page_properties(record.page_id, changed)
+            except NotionWriteError as e:
+                print(f"[Refresh] {record.name}: {e}")
+                self._count("checked", "failed")
+                return False
+            print(f"[Refresh] {record.name}: updated {', '.join(changed)}")
+            # スナップショット・索引などにも更新後のページを知らせる
+            notify_page_updated(page)
+            self._count("checked", "changed")
+        else:
+            self._count("checked", "unchanged")
+
+        with self._lock:
+            self._checked[record.place_id] = time.time()
+        return bool(changed)
+
+    # ---------------------------
+    # 1周期
+    # ---------------------------
+    def run_once(self) -> dict:
+        """前回止まった位置から古い順に、予算の範囲で確認する。今回の件数を返す"""
+        from modules.notion_client import iter_entries, NotionReadError
+        from modules.store_record import StoreRecord
+
+        now = time.time()
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.min_age)
+        sorts = [{"timestamp": "last_edited_time", "direction": "ascending"}]
+
+        with self._lock:
+            before = dict(self.stats)
+            self.stats["runs"] += 1
+
+            query_filter = {"timestamp": "last_edited_time", "last_edited_time": {"before": cutoff.isoformat()}}
+            if self._cursor:
+                # 同じ時刻の店を取りこぼさないよう、cursor の時刻そのものから見る（確認済みは _checked で飛ばす）
+                query_filter = {"and": [query_filter, {
+                    "timestamp": "last_edited_time", "last_edited_time": {"on_or_after": self._cursor},
+                }]}
+
+            # query の1ページ（100件）ごとに Notion の予算を1使う
+            seen = 0
+            finished = True
+            try:
+                for page in iter_entries(filter=query_filter, properties=REFRESH_PROPERTIES, sorts=sorts):
+                    if seen % 100 == 0 and not self.notion_budget.try_spend():
+                        finished = False
+                        break
+                    seen += 1
+
+                    record = StoreRecord.from_page(page)
+                    if record.last_edited:
+                        self._cursor = record.last_edited
+                    if not record.place_id or now - self._checked.get(record.place_id, 0) < self.min_age:
+                        continue
+                    if self.refresh_record(record) is None:
+                        finished = False
+                        break
+            except NotionReadError as e:
+                # query が途中で失敗したら、次の周期は止まった位置から
+                print(f"[Refresh] query failed: {e}")
+                finished = False
+
+            # 最後まで見たら次は先頭から
+            if finished:
+                self._cursor = None
+            self._save_state()
+
+            return {k: self.stats[k] - before[k] for k in ("checked", "changed", "unchanged", "failed")}
+
+    def start(self, interval: float = REFRESH_INTERVAL):
+        """interval 秒ごとに run_once を実行するスレッドを起動する"""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    result = self.run_once()
+                    if result["checked"]:
+                        print(f"[Refresh] {result}")
+                except Exception as e:
+                    print(f"[Refresh] run failed: {e}")
+                time.sleep(interval)
+
+        self._thread = threading.Thread(target=loop, name="store-refresher", daemon=True)
+        self._thread.start()
+
+
+# -----------------------------------------------
+# 共有インスタンス
+# -----------------------------------------------
+_shared_refresher = None
+_shared_lock = threading.Lock()
+
+
+def get_refresher() -> StoreRefresher:
+    global _shared_refresher
+
+    with _shared_lock:
+        if _shared_refresher is None:
+            _shared_refresher = StoreRefresher()
+        return _shared_refresher
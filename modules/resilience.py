@@ -0,0 +1,259 @@
+# modules/resilience.py
+#
+# 外部 API（Google / Notion / OpenAI）呼び出しの共通ポリシー。
+#   - タイムアウト: 1回の応答待ちの上限
+#   - 再試行: 冪等な呼び出しだけ、ジッター付き指数バックオフで再試行
+#   - サーキットブレーカー: 連続して失敗したら一定時間すぐ失敗させる（待たせない）
+#   - ヘッジ: Places の読み取りは、一定時間応答がなければ同じリクエストをもう1本出し、先に成功した方の結果を使う。
+#     元の呼び出し・ヘッジはそれぞれ上限つきのスレッドで実行し、空きがなければ待たない
+#     （元の呼び出しは呼び出し元のスレッドでそのまま実行、ヘッジは出さない）
+# ブレーカーの状態は is_available() で参照でき、AI 解析を省いた縮退応答などに使う。
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# HTTP ステータスのうち、再試行してよいもの
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailable(Exception):
+    """ブレーカーが開いている、または再試行しても失敗した"""
+
+
+# -----------------------------------------------
+# ポリシー
+# -----------------------------------------------
+class Policy:
+    def __init__(self, timeout: float, retries: int = 2, backoff_base: float = 0.3,
+                 backoff_max: float = 3.0, hedge_after: float | None = None,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+
+def _env_float(name: str, default: float | None) -> float | None:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return float(value) if value else None
+
+
+POLICIES = {
+    # Places の読み取り（Text / Nearby Search・Details）。応答が遅ければヘッジする
+    "google_places": Policy(
+        timeout=_env_float("GOOGLE_TIMEOUT", 5.0),
+        hedge_after=_env_float("GOOGLE_HEDGE_AFTER", 1.5),
+    ),
+    "google_geocode": Policy(timeout=_env_float("GOOGLE_TIMEOUT", 5.0)),
+    "google_photo": Policy(timeout=10.0, retries=1),
+    "notion": Policy(timeout=_env_float("NOTION_TIMEOUT", 10.0), backoff_base=0.5),
+    # LLM は1回が長く高いので再試行は1回まで
+    "openai": Policy(timeout=_env_float("OPENAI_TIMEOUT", 30.0), retries=1, backoff_base=1.0),
+}
+
+
+# -----------------------------------------------
+# サーキットブレーカー
+# -----------------------------------------------
+class CircuitBreaker:
+    """
+    closed: 通常 / open: 即失敗（reset_timeout 経過まで）/ half_open: 試しに1本だけ通す
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"[Breaker] {self.name}: closed")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f"[Breaker] {self.name}: open ({self._failures} consecutive failures)")
+                self._opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    with _breakers_lock:
+        if upstream not in _breakers:
+            policy = POLICIES[upstream]
+            _breakers[upstream] = CircuitBreaker(upstream, policy.failure_threshold, policy.reset_timeout)
+        return _breakers[upstream]
+
+
+def is_available(upstream: str) -> bool:
+    """ブレーカーが開いていなければ True（縮退応答の判定用）"""
+    return get_breaker(upstream).state != "open"
+
+
+def breaker_states() -> dict:
+    with _breakers_lock:
+        names = list(_breakers)
+    return {name: get_breaker(name).state for name in names}
+
+
+# -----------------------------------------------
+# 呼び出し
+# -----------------------------------------------
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", 8))                  # ヘッジ（2本目）を出すスレッド数
+HEDGE_PRIMARY_WORKERS = int(os.getenv("HEDGE_PRIMARY_WORKERS", 32))  # ヘッジ対象の元の呼び出しを出すスレッド数
+
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+_primary_executor = ThreadPoolExecutor(max_workers=HEDGE_PRIMARY_WORKERS, thread_name_prefix="hedge-primary")
+_primary_slots = threading.BoundedSemaphore(HEDGE_PRIMARY_WORKERS)
+hedge_stats = {"launched": 0, "skipped": 0, "used": 0, "inline": 0}
+_hedge_stats_lock = threading.Lock()
+
+
+def _count_hedge(key: str):
+    with _hedge_stats_lock:
+        hedge_stats[key] += 1
+
+
+def _backoff(policy: Policy, attempt: int) -> float:
+    """full jitter: 0〜min(max, base * 2^attempt) の一様乱数"""
+    return random.uniform(0, min(policy.backoff_max, policy.backoff_base * 2 ** attempt))
+
+
+def _run_in_slot(slots: threading.BoundedSemaphore, fn):
+    try:
+        return fn()
+    finally:
+        slots.release()
+
+
+def _hedged(fn, hedge_after: float):
+    """
+    fn() を実行し、hedge_after 秒たっても終わっていなければもう1本出して、先に成功した方の結果を返す
+    （両方失敗したら元の呼び出しの例外）。負けた方は最後まで走るが、結果は捨てる。
+    元の呼び出し用のスレッドが埋まっていれば呼び出し元のスレッドでそのまま実行し（ヘッジなし）、
+    ヘッジ用のスレッドが埋まっていればヘッジは出さない。
+    """
+    if not _primary_slots.acquire(blocking=False):
+        _count_hedge("inline")
+        return fn()
+
+    primary = _primary_executor.submit(_run_in_slot, _primary_slots, fn)
+    done, pending = wait([primary], timeout=hedge_after)
+    if not done:
+        if _hedge_slots.acquire(blocking=False):
+            _count_hedge("launched")
+            pending.add(_hedge_executor.submit(_run_in_slot, _hedge_slots, fn))
+        else:
+            _count_hedge("skipped")
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    while True:
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    _count_hedge("used")
+                return future.result()
+        if not pending:
+            # 両方失敗（またはヘッジなしで失敗）
+            raise primary.exception()
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+
+def call(upstream: str, fn, idempotent: bool = True, is_failure=None):
+    """
+    fn() をポリシーに従って呼ぶ。
+    idempotent=False の呼び出しは再試行・ヘッジしない。
+    is_failure(result) が True の結果は失敗として扱う（HTTP 5xx など）。最後の結果はそのまま返す。
+    ブレーカーが開いていれば UpstreamUnavailable を送出する。
+    """
+    policy = POLICIES[upstream]
+    breaker = get_breaker(upstream)
+    attempts = 1 + (policy.retries if idempotent else 0)
+
+    for attempt in range(attempts):
+        if not breaker.allow():
+            raise UpstreamUnavailable(f"{upstream} circuit open")
+
+        try:
+            if idempotent and policy.hedge_after is not None:
+                result = _hedged(fn, policy.hedge_after)
+            else:
+                result = fn()
+        except Exception as e:
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                raise UpstreamUnavailable(f"{upstream}: {e}") from e
+            print(f"[Retry] {upstream}: {type(e).__name__}, retry {attempt + 1}/{attempts - 1}")
+        else:
+            if is_failure is None or not is_failure(result):
+                breaker.record_success()
+                return result
+            breaker.record_failure()
+            if attempt + 1 >= attempts:
+                return result
+            print(f"[Retry] {upstream}: failed response, retry {attempt + 1}/{attempts - 1}")
+
+        time.sleep(_backoff(policy, attempt))
+
+
+def request(upstream: str, method: str, url: str, idempotent: bool | None = None, **kwargs):
+    """
+    requests による HTTP 呼び出し（タイムアウト・再試行・ブレーカー・ヘッジつき）。
+    idempotent を省略した場合は GET / PATCH / PUT / DELETE を冪等とみなす。
+    """
+    import requests
+
+    if idempotent is None:
+        idempotent = method.upper() in ("GET", "PATCH", "PUT", "DELETE")
+    kwargs.setdefault("timeout", POLICIES[upstream].timeout)
+
+    return call(
+        upstream,
+        lambda: requests.request(method, url, **kwargs),
+        idempotent=idempotent,
+        is_failure=lambda res: res.status_code in RETRY_STATUS,
+    )
@@ -0,0 +1,118 @@
+# modules/review_store.py
+#
+# 店ごとの口コミ履歴と、前回の解析結果（構造化したもの）を SQLite に残す。
+# Google が返す口コミは数件だけで、解析のたびに同じ本文を LLM に送り直していた。
+#   - 口コミは place_id + 投稿者 + 投稿時刻で重複を除いて貯める（古い口コミも失われない）
+#   - まだ解析に反映していない口コミだけを取り出し、前回の結果と一緒に渡して差分で更新する
+#   - 解析に成功したときだけ「反映済み」にする（失敗したら次回また渡す）
+import json
+import os
+import sqlite3
+import threading
+import time
+
+REVIEW_STORE_PATH = os.getenv("REVIEW_STORE_PATH", "data/reviews.db")
+REVIEW_INCREMENT_MAX = int(os.getenv("REVIEW_INCREMENT_MAX", 20))   # 1回の差分解析に渡す口コミ数の上限
+
+
+def review_key(review: dict) -> tuple[str, int]:
+    """重複判定のキー（投稿者, 投稿時刻）"""
+    return review.get("author_name") or "", int(review.get("time") or 0)
+
+
+class ReviewStore:
+    def __init__(self, path: str = REVIEW_STORE_PATH):
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS reviews ("
+                "place_id TEXT NOT NULL, author TEXT NOT NULL, time INTEGER NOT NULL, "
+                "rating REAL, text TEXT NOT NULL, summarized INTEGER NOT NULL DEFAULT 0, "
+                "added_at REAL NOT NULL, PRIMARY KEY (place_id, author, time))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS analyses ("
+                "place_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    # ---------------------------
+    # 口コミ
+    # ---------------------------
+    def add_reviews(self, place_id: str, reviews: list) -> int:
+        """口コミを追加する（既にあるものは無視）。新しく増えた件数を返す"""
+        rows = [
+            (place_id, *review_key(r), r.get("rating"), r.get("text", ""), time.time())
+            for r in reviews if r.get("text")
+        ]
+        if not rows:
+            return 0
+
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO reviews (place_id, author, time, rating, text, added_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            return self._conn.total_changes - before
+
+    def pending_reviews(self, place_id: str, limit: int = REVIEW_INCREMENT_MAX) -> list[dict]:
+        """まだ解析に反映していない口コミ（新しい順に limit 件）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT author, time, rating, text FROM reviews "
+                "WHERE place_id = ? AND summarized = 0 ORDER BY time DESC LIMIT ?",
+                (place_id, limit),
+            ).fetchall()
+        return [{"author_name": a, "time": t, "rating": rt, "text": tx} for a, t, rt, tx in rows]
+
+    def review_count(self, place_id: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM reviews WHERE place_id = ?", (place_id,)
+            ).fetchone()[0]
+
+    # ---------------------------
+    # 解析結果
+    # ---------------------------
+    def get_analysis(self, place_id: str) -> dict | None:
+        """前回の解析結果（LLM が返した JSON そのまま）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM analyses WHERE place_id = ?", (place_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_analysis(self, place_id: str, data: dict, reviews: list):
+        """解析結果を保存し、その解析に渡した口コミを反映済みにする"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO analyses (place_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(place_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (place_id, json.dumps(data, ensure_ascii=False), time.time()),
+            )
+            self._conn.executemany(
+                "UPDATE reviews SET summarized = 1 WHERE place_id = ? AND author = ? AND time = ?",
+                [(place_id, *review_key(r)) for r in reviews],
+            )
+
+
+# -----------------------------------------------
+# 共有インスタンス
+# -----------------------------------------------
+_shared_store = None
+_shared_lock = threading.Lock()
+
+
+def get_review_store() -> ReviewStore:
+    global _shared_store
+
+    with _shared_lock:
+        if _shared_store is None:
+            _shared_store = ReviewStore()
+        return _shared_store
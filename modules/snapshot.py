@@ -0,0 +1,437 @@
+# modules/snapshot.py
+#
+# 保存済み店舗のバイナリスナップショット（Webhook ワーカーを複数プロセスで動かすとき用）。
+# 各ワーカーが店舗一覧とインデックスをそれぞれ持つ代わりに、1つのファイルを read-only で memory-map して共有する。
+#   - 列ごとの配列（lat / lng / rating / user_rating / price_level）
+#   - タグのビットマップ（店舗 × タグ語彙）
+#   - 営業時間のビットマップ（店舗 × 15分枠、modules/opening_hours.py）
+#   - 文字列テーブル（page_id / place_id / 店名 / 店タイプ / サブタイプ / タグ語彙）
+# 書き込みは一時ファイルに書いてから os.replace で差し替える。読み手はファイルの変化を見て開き直すだけで、
+# 古い mmap は参照がなくなった時点で解放される（読み途中の処理はそのまま古い版を読み切る）。
+# 書き出しは SNAPSHOT_WRITER=1 のプロセスだけが行う（main.py）。
+# スナップショットは最大 SNAPSHOT_EXPORT_INTERVAL 秒（保存があれば SNAPSHOT_DEBOUNCE 秒 + 書き出し時間）古い。
+# 同じプロセスで保存した店は recent_records() で補えるが、他のプロセスで保存した店は次の書き出しまで出てこない。
+#
+#   python -m modules.snapshot export [path] [--force]
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+from modules.opening_hours import BITMAP_BYTES, bitmap_to_hex
+
+STORE_SNAPSHOT_PATH = os.getenv("STORE_SNAPSHOT_PATH", "data/stores.snap")
+SNAPSHOT_CHECK_INTERVAL = float(os.getenv("SNAPSHOT_CHECK_INTERVAL", 5))       # 差し替えの確認間隔（秒）
+SNAPSHOT_EXPORT_INTERVAL = int(os.getenv("SNAPSHOT_EXPORT_INTERVAL", 900))     # 書き出し間隔（秒）、0 で無効
+SNAPSHOT_DEBOUNCE = float(os.getenv("SNAPSHOT_DEBOUNCE", 30))                  # 保存後に書き出すまでの待ち（秒）
+SNAPSHOT_RECENT_MARGIN = float(os.getenv("SNAPSHOT_RECENT_MARGIN", 600))       # 書き出し後も保存を覚えておく時間（秒）
+SNAPSHOT_MIN_RATIO = float(os.getenv("SNAPSHOT_MIN_RATIO", 0.5))               # 今のファイルより極端に少なければ差し替えない
+
+SNAPSHOT_PROPERTIES = ["店名", "place_id", "lat", "lng", "評価", "料金", "Tags", "店タイプ", "サブタイプ",
+                       "営業時間", "営業時間コード"]
+
+_MAGIC = b"GSNAP001"
+_ALIGN = 64
+_STRING_COLUMNS = ("page_id", "place_id", "name", "store_type", "subtype")
+
+
+# -----------------------------------------------
+# 書き出し
+# -----------------------------------------------
+class _StringTable:
+    """重複をまとめた文字列の表（オフセット配列 + UTF-8 のバイト列）"""
+
+    def __init__(self):
+        self._ids = {}
+        self._blobs = []
+
+    def add(self, text: str) -> int:
+        text = text or ""
+        sid = self._ids.get(text)
+        if sid is None:
+            sid = self._ids[text] = len(self._blobs)
+            self._blobs.append(text.encode("utf-8"))
+        return sid
+
+    def arrays(self) -> tuple[np.ndarray, np.ndarray]:
+        offsets = np.zeros(len(self._blobs) + 1, dtype=np.uint32)
+        np.cumsum([len(b) for b in self._blobs], out=offsets[1:])
+        return offsets, np.frombuffer(b"".join(self._blobs), dtype=np.uint8)
+
+
+def write_snapshot(records: list, path: str = STORE_SNAPSHOT_PATH) -> int:
+    """StoreRecord の列をスナップショットに書き出す（位置情報のない店は除く）。書いた件数を返す"""
+    from modules.tag_index import normalize_tag
+
+    records = [r for r in records if r.has_location]
+    n = len(records)
+    strings = _StringTable()
+
+    vocab = {}
+    row_tags = []
+    for r in records:
+        ids = []
+        for t in r.tags:
+            t = normalize_tag(t)
+            if t:
+                ids.append(vocab.setdefault(t, len(vocab)))
+        row_tags.append(ids)
+
+    tag_bits = np.zeros((n, max(1, (len(vocab) + 7) // 8)), dtype=np.uint8)
+    for row, ids in enumerate(row_tags):
+        for t in ids:
+            tag_bits[row, t >> 3] |= 1 << (t & 7)
+
+    sections = {
+        "lat": np.array([r.lat for r in records], dtype=np.float64),
+        "lng": np.array([r.lng for r in records], dtype=np.float64),
+        "rating": np.array([r.rating or 0 for r in records], dtype=np.float32),
+        "user_rating": np.array([r.user_rating or 0 for r in records], dtype=np.float32),
+        "price_level": np.array([-1 if r.price_level is None else r.price_level for r in records], dtype=np.int8),
+        "tag_bits": tag_bits,
+    }
+    open_bits = [r.open_bits for r in records]
+    sections["hours_known"] = np.array([b is not None for b in open_bits], dtype=np.uint8)
+    sections["open_bits"] = np.frombuffer(
+        b"".join(b or bytes(BITMAP_BYTES) for b in open_bits), dtype=np.uint8
+    ).reshape(n, BITMAP_BYTES)
+    for col in _STRING_COLUMNS:
+        sections[col] = np.array([strings.add(getattr(r, col)) for r in records], dtype=np.uint32)
+    sections["vocab"] = np.array([strings.add(t) for t in vocab], dtype=np.uint32)
+    sections["str_offsets"], sections["str_blob"] = strings.arrays()
+
+    # ヘッダ（JSON）のあとに各配列を 64 バイト境界で並べる
+    layout, offset = {}, 0
+    for name, arr in sections.items():
+        layout[name] = {"offset": offset, "dtype": arr.dtype.str, "shape": list(arr.shape)}
+        offset += -(-arr.nbytes // _ALIGN) * _ALIGN
+    header = json.dumps({"count": n, "tags": len(vocab), "created_at": time.time(), "sections": layout}).encode()
+    data_start = -(-(len(_MAGIC) + 4 + len(header)) // _ALIGN) * _ALIGN
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        f.write(_MAGIC + struct.pack("<I", len(header)) + header)
+        for name, arr in sections.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(np.ascontiguousarray(arr).tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return n
+
+
+class SnapshotRejected(Exception):
+    """取得した件数が今のスナップショットより極端に少ないので差し替えなかった"""
+
+
+def export_snapshot(path: str = STORE_SNAPSHOT_PATH, force: bool = False) -> int:
+    """
+    Notion から必要な項目だけを取得してスナップショットを書き出す。
+    取得に失敗したら（NotionReadError）、または件数が今のファイルの SNAPSHOT_MIN_RATIO 未満なら
+    （SnapshotRejected、force で無視）今のファイルを残す。欠けたスナップショットを全ワーカーが読まないように。
+    """
+    from modules.notion_client import fetch_all_records
+
+    records = [r for r in fetch_all_records(properties=SNAPSHOT_PROPERTIES) if r.has_location]
+    if not force:
+        try:
+            current = StoreSnapshot(path).count
+        except (OSError, ValueError):
+            current = 0
+        if len(records) < current * SNAPSHOT_MIN_RATIO:
+            raise SnapshotRejected(f"fetched {len(records)} stores, current snapshot has {current}")
+    return write_snapshot(records, path)
+
+
+# -----------------------------------------------
+# 読み込み
+# -----------------------------------------------
+class StoreSnapshot:
+    """memory-map したスナップショット（read-only）。行番号 = 店舗"""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stat = os.fstat(f.fileno())
+
+        if self._mm[:len(_MAGIC)] != _MAGIC:
+            raise ValueError(f"not a store snapshot: {path}")
+        (header_len,) = struct.unpack_from("<I", self._mm, len(_MAGIC))
+        header_end = len(_MAGIC) + 4 + header_len
+        header = json.loads(self._mm[len(_MAGIC) + 4:header_end])
+        data_start = -(-header_end // _ALIGN) * _ALIGN
+
+        self.count = header["count"]
+        self.created_at = header["created_at"]
+        self._cols = {}
+        for name, s in header["sections"].items():
+            dtype = np.dtype(s["dtype"])
+            size = int(np.prod(s["shape"]))
+            self._cols[name] = np.frombuffer(
+                self._mm, dtype=dtype, count=size, offset=data_start + s["offset"]
+            ).reshape(s["shape"])
+
+        self.lat = self._cols["lat"]
+        self.lng = self._cols["lng"]
+        self.rating = self._cols["rating"]
+        self.user_rating = self._cols["user_rating"]
+        self.price_level = self._cols["price_level"]
+        # 営業時間の列がない古いファイルは「すべて不明」として扱う
+        self.open_bits = self._cols.get("open_bits", np.zeros((self.count, BITMAP_BYTES), dtype=np.uint8))
+        self.hours_known = self._cols.get("hours_known", np.zeros(self.count, dtype=np.uint8)).astype(bool)
+        self._vocab = None
+
+    def __len__(self):
+        return self.count
+
+    def string(self, sid: int) -> str:
+        offsets = self._cols["str_offsets"]
+        return bytes(self._cols["str_blob"][offsets[sid]:offsets[sid + 1]]).decode("utf-8")
+
+    def column(self, name: str, rows) -> list[str]:
+        """文字列の列（page_id / place_id / name / store_type / subtype）の指定行"""
+        ids = self._cols[name]
+        return [self.string(ids[i]) for i in rows]
+
+    @property
+    def vocab(self) -> list[str]:
+        if self._vocab is None:
+            self._vocab = [self.string(sid) for sid in self._cols["vocab"]]
+        return self._vocab
+
+    def tags_of(self, row: int) -> tuple:
+        bits = np.unpackbits(self._cols["tag_bits"][row], bitorder="little")
+        return tuple(self.vocab[t] for t in np.flatnonzero(bits[:len(self.vocab)]))
+
+    # ---------------------------
+    # 絞り込み
+    # ---------------------------
+    def select(self, lat: float, lng: float, radius_km: float | None, min_rating: float | None = None) -> np.ndarray:
+        """bbox_filter / rating_filter と同じ条件に合う行番号（radius_km が None なら距離では絞らない）"""
+        mask = np.ones(self.count, dtype=bool)
+        if radius_km:
+            d_lat = radius_km / 111.32
+            d_lng = radius_km / (111.32 * max(np.cos(np.radians(lat)), 0.01))
+            mask &= (np.abs(self.lat - lat) <= d_lat) & (np.abs(self.lng - lng) <= d_lng)
+        if min_rating:
+            mask &= self.rating >= min_rating
+        return np.flatnonzero(mask)
+
+    def _word_mask(self, word: str, rows: np.ndarray) -> np.ndarray:
+        """条件ワード1つに部分一致するタグを持つか（TagIndex の partial と同じ）"""
+        from modules.tag_index import normalize_tag
+
+        w = normalize_tag(word)
+        hit = np.zeros(len(rows), dtype=bool)
+        if not w:
+            return hit
+        bits = self._cols["tag_bits"][rows]
+        for t, tag in enumerate(self.vocab):
+            if w in tag:
+                hit |= ((bits[:, t >> 3] >> (t & 7)) & 1).astype(bool)
+        return hit
+
+    def match_counts(self, words: list[str], rows: np.ndarray) -> np.ndarray:
+        counts = np.zeros(len(rows))
+        for w in words:
+            counts += self._word_mask(w, rows)
+        return counts
+
+    def query_mask(self, words: list[str], rows: np.ndarray, op: str = "and") -> np.ndarray:
+        masks = [self._word_mask(w, rows) for w in words]
+        if not masks:
+            return np.zeros(len(rows), dtype=bool)
+        return np.logical_and.reduce(masks) if op == "and" else np.logical_or.reduce(masks)
+
+    # ---------------------------
+    # ランキング用
+    # ---------------------------
+    def records(self, rows) -> list:
+        """指定行の StoreRecord（文字列はここで初めてデコードする）"""
+        from modules.store_record import StoreRecord
+
+        out = []
+        for i in rows:
+            price = int(self.price_level[i])
+            out.append(StoreRecord(
+                page_id=self.string(self._cols["page_id"][i]),
+                place_id=self.string(self._cols["place_id"][i]),
+                name=self.string(self._cols["name"][i]),
+                lat=float(self.lat[i]), lng=float(self.lng[i]),
+                rating=float(self.rating[i]) or None,
+                price_level=None if price < 0 else price,
+                user_rating=float(self.user_rating[i]) or None,
+                store_type=self.string(self._cols["store_type"][i]),
+                subtype=self.string(self._cols["subtype"][i]),
+                tags=self.tags_of(i),
+                opening_code=bitmap_to_hex(self.open_bits[i].tobytes()) if self.hours_known[i] else "",
+            ))
+        return out
+
+    def candidates(self, rows):
+        """指定行の CandidateSet"""
+        from modules.ranking import CandidateSet
+        return CandidateSet.from_records(self.records(rows))
+
+
+# -----------------------------------------------
+# 共有インスタンス（ファイルが差し替わったら開き直す）
+# -----------------------------------------------
+_shared_snapshot = None
+_shared_checked_at = 0.0
+_shared_lock = threading.Lock()
+
+
+def get_store_snapshot(path: str = STORE_SNAPSHOT_PATH) -> StoreSnapshot | None:
+    """最新のスナップショット（なければ None）。確認は SNAPSHOT_CHECK_INTERVAL ごと"""
+    global _shared_snapshot, _shared_checked_at
+
+    with _shared_lock:
+        if time.time() - _shared_checked_at < SNAPSHOT_CHECK_INTERVAL:
+            return _shared_snapshot
+        _shared_checked_at = time.time()
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            _shared_snapshot = None
+            return None
+
+        current = _shared_snapshot
+        if current is None or (st.st_ino, st.st_mtime_ns) != (current.stat.st_ino, current.stat.st_mtime_ns):
+            try:
+                _shared_snapshot = StoreSnapshot(path)
+            except (OSError, ValueError) as e:
+                print(f"[Snapshot] failed to open {path}: {e}")
+        return _shared_snapshot
+
+
+# -----------------------------------------------
+# スナップショットより新しい保存（このプロセスで upsert_store したもの）
+# -----------------------------------------------
+_recent = {}        # page_id → (保存時刻, StoreRecord)
+_recent_lock = threading.Lock()
+_recent_listening = False
+
+
+def _on_upsert(record):
+    with _recent_lock:
+        _recent[record.page_id] = (time.time(), record)
+
+
+def watch_recent_upserts():
+    """upsert_store された店を覚え始める（スナップショットを読むプロセスで起動時に呼ぶ）"""
+    global _recent_listening
+
+    with _recent_lock:
+        if _recent_listening:
+            return
+        _recent_listening = True
+
+    from modules.notion_client import add_upsert_listener
+    add_upsert_listener(_on_upsert)
+
+
+def recent_records(snapshot: StoreSnapshot) -> list:
+    """
+    snapshot に入っていないかもしれない保存（書き出し開始前の取得と競合しうるので、
+    作成時刻より SNAPSHOT_RECENT_MARGIN 秒以上前の保存だけを捨てる）
+    """
+    cutoff = snapshot.created_at - SNAPSHOT_RECENT_MARGIN
+    with _recent_lock:
+        for page_id in [p for p, (saved_at, _) in _recent.items() if saved_at < cutoff]:
+            del _recent[page_id]
+        return [record for _, record in _recent.values() if record.has_location]
+
+
+def _record_word_hit(record, word: str) -> bool:
+    """StoreSnapshot._word_mask と同じ判定を StoreRecord 1件に対して行う"""
+    from modules.tag_index import normalize_tag
+
+    w = normalize_tag(word)
+    return bool(w) and any(w in normalize_tag(t) for t in record.tags)
+
+
+def snapshot_candidates(snapshot: StoreSnapshot, lat: float, lng: float, radius_km: float | None,
+                        min_rating: float | None, words: list[str], match_all: bool = False):
+    """
+    条件に合う店の CandidateSet と条件ワードのタグ一致数。
+    スナップショットの行に、書き出し後にこのプロセスで保存した店（recent_records）を重ねる
+    （他のプロセスで保存した店は次の書き出しまで出てこない）。
+    """
+    from modules.ranking import CandidateSet
+
+    rows = snapshot.select(lat, lng, radius_km, min_rating)
+    # match_all：全条件を満たす店だけに絞り込む
+    if match_all and words:
+        rows = rows[snapshot.query_mask(words, rows, op="and")]
+
+    recent = []
+    if _recent:
+        d_lat = (radius_km or 0) / 111.32
+        d_lng = (radius_km or 0) / (111.32 * max(np.cos(np.radians(lat)), 0.01))
+        for r in recent_records(snapshot):
+            if radius_km and (abs(r.lat - lat) > d_lat or abs(r.lng - lng) > d_lng):
+                continue
+            if min_rating and (r.rating or 0) < min_rating:
+                continue
+            if match_all and words and not all(_record_word_hit(r, w) for w in words):
+                continue
+            recent.append(r)
+
+    if not recent:
+        return snapshot.candidates(rows), snapshot.match_counts(words, rows)
+
+    # 保存し直した店はスナップショットの行より新しい内容を使う
+    replaced = {r.page_id for r in recent}
+    rows = rows[np.array([p not in replaced for p in snapshot.column("page_id", rows)], dtype=bool)]
+    counts = np.concatenate([
+        snapshot.match_counts(words, rows),
+        [sum(_record_word_hit(r, w) for w in words) for r in recent],
+    ])
+    return CandidateSet.from_records(snapshot.records(rows) + recent), counts
+
+
+def start_snapshot_exporter(interval: float = SNAPSHOT_EXPORT_INTERVAL, path: str = STORE_SNAPSHOT_PATH):
+    """
+    Notion からスナップショットを書き出すスレッドを起動する（書き手は1プロセスだけ。main.py は SNAPSHOT_WRITER=1 のときだけ呼ぶ）。
+    interval 秒ごと、または upsert_store があってから SNAPSHOT_DEBOUNCE 秒後に書き出す。
+    """
+    from modules.notion_client import add_upsert_listener
+
+    dirty = threading.Event()
+    add_upsert_listener(lambda record: dirty.set())
+
+    def loop():
+        while True:
+            try:
+                started = time.monotonic()
+                n = export_snapshot(path)
+                print(f"[Snapshot] exported {n} stores in {time.monotonic() - started:.1f}s")
+            except Exception as e:
+                # 失敗したら今のファイルのまま（次の周期か保存のあとにやり直す）
+                print(f"[Snapshot] export failed, keep the current snapshot: {e}")
+
+            dirty.clear()
+            if dirty.wait(interval):
+                # 保存が続くときはまとめて1回にする
+                time.sleep(SNAPSHOT_DEBOUNCE)
+
+    threading.Thread(target=loop, name="snapshot-exporter", daemon=True).start()
+
+
+if __name__ == "__main__":
+    import sys
+
+    args = [a for a in sys.argv[1:] if a != "--force"]
+    if not args or args[0] != "export":
+        print("usage: python -m modules.snapshot export [path] [--force]")
+        sys.exit(1)
+    target = args[1] if len(args) > 1 else STORE_SNAPSHOT_PATH
+    print(f"exported {export_snapshot(target, force='--force' in sys.argv)} stores to {target}")
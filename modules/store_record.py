@@ -0,0 +1,126 @@
+# modules/store_record.py
+#
+# Notion ページ（入れ子の dict）を、必要な項目だけ持つ軽量な StoreRecord に変換する。
+# fetch_all_entries() の生 JSON はユーザー情報・アイコン・rich_text の装飾まで含むため、
+# /nearby や各種インデックスはこの形を使う。
+import sys
+
+
+# -----------------------------------------------
+# Notion プロパティの取り出し
+# -----------------------------------------------
+def _plain(prop: dict | None) -> str:
+    """title / rich_text プロパティを文字列にする"""
+    if not prop:
+        return ""
+    parts = prop.get("title") or prop.get("rich_text") or []
+    return "".join(p.get("plain_text") or p.get("text", {}).get("content", "") for p in parts)
+
+
+def _number(prop: dict | None):
+    return prop.get("number") if prop else None
+
+
+def _select(prop: dict | None) -> str:
+    return ((prop or {}).get("select") or {}).get("name", "")
+
+
+def _multi_select(prop: dict | None) -> tuple:
+    # タグは店舗間で共通の文字列が多いので intern して共有する
+    return tuple(sys.intern(t["name"]) for t in (prop or {}).get("multi_select", []))
+
+
+def _url(prop: dict | None):
+    return prop.get("url") if prop else None
+
+
+# -----------------------------------------------
+# StoreRecord
+# -----------------------------------------------
+class StoreRecord:
+    """保存済み店舗1件分（Notion ページから必要な項目だけを取り出したもの）"""
+
+    __slots__ = (
+        "page_id", "place_id", "name", "address",
+        "lat", "lng", "rating", "price_level", "user_rating",
+        "store_type", "subtype", "tags",
+        "summary", "comment", "recommendations", "hours",
+        "url", "website", "last_edited", "opening_code", "_open_bits",
+    )
+
+    def __init__(self, page_id, place_id, name, address="",
+                 lat=None, lng=None, rating=None, price_level=None, user_rating=None,
+                 store_type="", subtype="", tags=(),
+                 summary="", comment="", recommendations="", hours="",
+                 url=None, website=None, last_edited=None, opening_code=""):
+        self.page_id = page_id
+        self.place_id = place_id
+        self.name = name
+        self.address = address
+        self.lat = lat
+        self.lng = lng
+        self.rating = rating
+        self.price_level = price_level
+        self.user_rating = user_rating
+        self.store_type = store_type
+        self.subtype = subtype
+        self.tags = tags
+        self.summary = summary
+        self.comment = comment
+        self.recommendations = recommendations
+        self.hours = hours
+        self.url = url
+        self.website = website
+        self.last_edited = last_edited
+        self.opening_code = opening_code   # 営業時間ビットマップ（16進）。保存時に作ったもの
+        self._open_bits = False
+
+    def __repr__(self):
+        return f"StoreRecord(name={self.name!r}, place_id={self.place_id!r})"
+
+    @property
+    def has_location(self) -> bool:
+        return self.lat is not None and self.lng is not None
+
+    @property
+    def open_bits(self) -> bytes | None:
+        """営業時間の週ビットマップ（modules.opening_hours）。保存済みのものがなければ営業時間の文字列から作る"""
+        if self._open_bits is False:
+            from modules.opening_hours import bitmap_from_hex, bitmap_from_weekday_text
+            self._open_bits = (
+                bitmap_from_hex(self.opening_code) if self.opening_code
+                else bitmap_from_weekday_text(self.hours) if self.hours else None
+            )
+        return self._open_bits
+
+    @classmethod
+    def from_page(cls, page: dict) -> "StoreRecord":
+        """Notion ページ（{"id", "properties", ...}）から作る"""
+        props = page["properties"]
+        return cls(
+            page_id=page["id"],
+            place_id=_plain(props.get("place_id")),
+            name=_plain(props.get("店名")),
+            address=_plain(props.get("住所")),
+            lat=_number(props.get("lat")),
+            lng=_number(props.get("lng")),
+            rating=_number(props.get("評価")),
+            price_level=_number(props.get("料金")),
+            user_rating=_number(props.get("個人評価")),
+            store_type=sys.intern(_select(props.get("店タイプ"))),
+            subtype=_plain(props.get("サブタイプ")),
+            tags=_multi_select(props.get("Tags")),
+            summary=_plain(props.get("印象")),
+            comment=_plain(props.get("感想")),
+            recommendations=_plain(props.get("おすすめメニュー")),
+            hours=_plain(props.get("営業時間")),
+            url=_url(props.get("URL")),
+            website=_url(props.get("公式サイト")),
+            last_edited=page.get("last_edited_time"),
+            opening_code=_plain(props.get("営業時間コード")),
+        )
+
+
+def project_pages(pages: list) -> list[StoreRecord]:
+    """Notion ページの列を StoreRecord の列に変換する"""
+    return [StoreRecord.from_page(p) for p in pages]
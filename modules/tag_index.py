@@ -0,0 +1,216 @@
+# modules/tag_index.py
+#
+# 保存済み店舗の Tags に対する転置インデックス。
+# 正規化したタグ → 店舗スロットのビットセット（Python int）を持ち、
+# 条件検索を AND / OR のビット演算で行う。
+import bisect
+import os
+import threading
+import time
+import unicodedata
+import numpy as np
+
+TAG_INDEX_TTL = int(os.getenv("TAG_INDEX_TTL", 600))  # 共有インデックスの再構築間隔（秒）
+
+
+# -----------------------------------------------
+# タグの正規化（全角/半角・大文字小文字の揺れを吸収）
+# -----------------------------------------------
+def normalize_tag(tag: str) -> str:
+    return unicodedata.normalize("NFKC", tag).strip().lower()
+
+
+# -----------------------------------------------
+# ビットセット → bool 配列
+# -----------------------------------------------
+def bitset_to_array(bits: int, size: int) -> np.ndarray:
+    """スロット i のビットが立っていれば True となる長さ size の配列を返す"""
+    if size == 0:
+        return np.zeros(0, dtype=bool)
+    raw = bits.to_bytes((size + 7) // 8, "little")
+    return np.unpackbits(np.frombuffer(raw, dtype=np.uint8), bitorder="little")[:size].astype(bool)
+
+
+class TagIndex:
+    """
+    正規化タグ → 店舗スロットのビットセット。
+    店舗 ID（Notion ページ ID）ごとに固定のスロット番号を割り当てる。
+    """
+
+    def __init__(self):
+        self._slots = {}      # store_id -> slot
+        self._ids = []        # slot -> store_id
+        self._tags = []       # slot -> frozenset[正規化タグ]
+        self._postings = {}   # 正規化タグ -> ビットセット
+        self._vocab = []      # 正規化タグ（ソート済み、前方一致用）
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._ids)
+
+    # ---------------------------
+    # 更新
+    # ---------------------------
+    def upsert(self, store_id: str, tags: list[str]):
+        """店舗のタグを登録／差し替える（差分だけポスティングを更新）"""
+        new_tags = frozenset(normalize_tag(t) for t in tags if t and t.strip())
+
+        with self._lock:
+            slot = self._slots.get(store_id)
+            if slot is None:
+                slot = len(self._ids)
+                self._slots[store_id] = slot
+                self._ids.append(store_id)
+                self._tags.append(frozenset())
+
+            old_tags = self._tags[slot]
+            if old_tags == new_tags:
+                return
+
+            bit = 1 << slot
+            for t in old_tags - new_tags:
+                bits = self._postings[t] & ~bit
+                if bits:
+                    self._postings[t] = bits
+                else:
+                    del self._postings[t]
+                    self._vocab.pop(bisect.bisect_left(self._vocab, t))
+
+            for t in new_tags - old_tags:
+                if t not in self._postings:
+                    self._postings[t] = 0
+                    bisect.insort(self._vocab, t)
+                self._postings[t] |= bit
+
+            self._tags[slot] = new_tags
+
+    def upsert_record(self, record):
+        """StoreRecord からタグを登録する"""
+        self.upsert(record.page_id, record.tags)
+
+    def remove(self, store_id: str):
+        """店舗をインデックスから外す（スロット番号は再利用しない）"""
+        if store_id in self._slots:
+            self.upsert(store_id, [])
+
+    # ---------------------------
+    # 参照
+    # ---------------------------
+    def slot(self, store_id: str) -> int:
+        """店舗のスロット番号（未登録なら -1）"""
+        return self._slots.get(store_id, -1)
+
+    def ids(self, bits: int) -> list[str]:
+        """ビットセットに含まれる店舗 ID を返す"""
+        out = []
+        while bits:
+            low = bits & -bits
+            out.append(self._ids[low.bit_length() - 1])
+            bits ^= low
+        return out
+
+    def match(self, word: str, mode: str = "partial") -> int:
+        """
+        条件ワード1つに一致する店舗のビットセット。
+        mode: "exact"（完全一致）/ "prefix"（前方一致）/ "partial"（部分一致）
+        """
+        w = normalize_tag(word)
+        if not w:
+            return 0
+
+        with self._lock:
+            if mode == "exact":
+                return self._postings.get(w, 0)
+
+            if mode == "prefix":
+                bits = 0
+                i = bisect.bisect_left(self._vocab, w)
+                while i < len(self._vocab) and self._vocab[i].startswith(w):
+                    bits |= self._postings[self._vocab[i]]
+                    i += 1
+                return bits
+
+            bits = 0
+            for t in self._vocab:
+                if w in t:
+                    bits |= self._postings[t]
+            return bits
+
+    def query(self, words: list[str], op: str = "and", mode: str = "partial") -> int:
+        """複数の条件ワードを AND / OR で組み合わせたビットセット"""
+        sets = [self.match(w, mode) for w in words if normalize_tag(w)]
+        if not sets:
+            return 0
+
+        bits = sets[0]
+        for s in sets[1:]:
+            bits = bits & s if op == "and" else bits | s
+        return bits
+
+    def slots_of(self, store_ids: list[str]) -> np.ndarray:
+        """店舗 ID の列をスロット番号の配列に変換する（未登録は -1）"""
+        return np.fromiter(
+            (self._slots.get(i, -1) for i in store_ids), dtype=np.int64, count=len(store_ids)
+        )
+
+    def query_mask(self, words: list[str], slots: np.ndarray, op: str = "and", mode: str = "partial") -> np.ndarray:
+        """slots の各店舗が query(words, op) に含まれるかの bool 配列"""
+        size = len(self._ids)
+        hit = np.append(bitset_to_array(self.query(words, op, mode), size), False)
+        return hit[slots]
+
+    def match_counts(self, words: list[str], slots: np.ndarray, mode: str = "partial") -> np.ndarray:
+        """
+        slots（スロット番号の配列、未登録は -1）の各店舗について
+        一致した条件ワードの数を返す。
+        """
+        size = len(self._ids)
+        counts = np.zeros(size + 1)  # 末尾は未登録（-1）用
+        for w in words:
+            counts[:size] += bitset_to_array(self.match(w, mode), size)
+        return counts[slots]
+
+
+# -----------------------------------------------
+# 共有インデックス（Notion DB 全件 + upsert で差分更新）
+# -----------------------------------------------
+_shared_index = None
+_shared_built_at = 0.0
+_shared_lock = threading.Lock()
+
+
+def get_shared_tag_index() -> TagIndex:
+    """
+    保存済み店舗全件のタグインデックスを返す。
+    初回（または TTL 経過後）に Notion から Tags だけを取得して構築し、
+    以降は upsert_store で差分更新する。
+    作り直しの取得に失敗したら前のインデックスを使い続ける（初回の失敗は NotionReadError）。
+    """
+    global _shared_index, _shared_built_at
+
+    with _shared_lock:
+        if _shared_index is None or time.time() - _shared_built_at > TAG_INDEX_TTL:
+            from modules.notion_client import fetch_all_records, add_upsert_listener, NotionReadError
+
+            try:
+                records = fetch_all_records(properties=["Tags"])
+            except NotionReadError as e:
+                if _shared_index is None:
+                    raise
+                print(f"[TagIndex] rebuild failed, keep the current index: {e}")
+                return _shared_index
+
+            index = TagIndex()
+            for record in records:
+                index.upsert_record(record)
+
+            _shared_index = index
+            _shared_built_at = time.time()
+            add_upsert_listener(_on_upsert)
+
+        return _shared_index
+
+
+def _on_upsert(record):
+    if _shared_index is not None:
+        _shared_index.upsert_record(record)
@@ -6,6 +6,16 @@ import os
 
 # Google Places Photo URL 生成
 def build_photo_url(photo_reference, maxwidth=800):
+    """
+    写真 URL を返す。公開 URL（PUBLIC_BASE_URL / RAILWAY_PUBLIC_DOMAIN）があれば
+    自前の /photo プロキシ（縮小・キャッシュ済み、API キーを含まない）を使う。
+    """
+    from modules.photo_cache import build_proxy_photo_url
+
+    proxy_url = build_proxy_photo_url(photo_reference, maxwidth)
+    if proxy_url:
+        return proxy_url
+
     key = os.getenv("GOOGLE_API_KEY")
     return (
         "https://maps.googleapis.com/maps/api/place/photo"
@@ -0,0 +1,43 @@
+# tests/test_local_classifier.py
+from modules.local_classifier import classify_store_locally, LOCAL_CLASSIFIER_THRESHOLD
+
+
+def _classify(name, types=("restaurant", "food")):
+    return classify_store_locally(name, list(types), [])
+
+
+def test_burger_is_not_bar():
+    result = _classify("モスバーガー 渋谷店")
+    assert result["store_type"]["type"] == "fastfood"
+
+
+def test_barbecue_is_not_bar():
+    result = _classify("BBQ Barbecue House")
+    assert result["store_type"]["type"] != "bar"
+
+
+def test_latin_word_boundary():
+    assert _classify("The Republic Kitchen")["store_type"]["type"] != "bar"
+    assert _classify("Bar Lupin")["store_type"]["type"] == "bar"
+
+
+def test_name_only_hit_stays_below_threshold():
+    assert _classify("モスバーガー 渋谷店")["confidence"] < LOCAL_CLASSIFIER_THRESHOLD
+    assert _classify("Bar Lupin")["confidence"] < LOCAL_CLASSIFIER_THRESHOLD
+
+
+def test_name_hit_with_agreeing_google_type():
+    result = _classify("Bar Lupin", ("bar", "point_of_interest"))
+    assert result["store_type"]["type"] == "bar"
+    assert result["confidence"] >= LOCAL_CLASSIFIER_THRESHOLD
+
+
+def test_google_type_only_without_reviews_passes_threshold():
+    result = classify_store_locally("Tanaka", ["cafe", "food"], [])
+    assert result["store_type"]["type"] == "cafe"
+    assert result["confidence"] >= LOCAL_CLASSIFIER_THRESHOLD
+
+
+def test_reviews_without_subtype_evidence_stay_below_threshold():
+    reviews = [{"text": "また来たいです。"}]
+    assert classify_store_locally("Tanaka", ["cafe", "food"], reviews)["confidence"] < LOCAL_CLASSIFIER_THRESHOLD
@@ -0,0 +1,24 @@
+# tests/test_opening_hours.py
+from datetime import datetime
+
+from modules.opening_hours import JST, _parse_time, bitmap_from_weekday_text, is_open
+
+
+def test_parse_time_suffix():
+    assert _parse_time("11時30分") == 11 * 60 + 30
+    assert _parse_time("7:00 PM") == 19 * 60
+    assert _parse_time("12:00 AM") == 0
+
+
+def test_parse_time_leading_gozen_gogo():
+    assert _parse_time("午後7時") == 19 * 60
+    assert _parse_time("午後7:30") == 19 * 60 + 30
+    assert _parse_time("午前11時") == 11 * 60
+    assert _parse_time("午前12時") == 0
+
+
+def test_weekday_text_with_leading_gogo():
+    bitmap = bitmap_from_weekday_text(["月曜日: 午前11時～午後10時"])
+    # 2024-01-01 は月曜日
+    assert is_open(bitmap, datetime(2024, 1, 1, 21, 0, tzinfo=JST)) is True
+    assert is_open(bitmap, datetime(2024, 1, 1, 10, 0, tzinfo=JST)) is False